@@ -1,5 +1,7 @@
+import copy
 import logging
 import os
+import time
 
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
@@ -8,9 +10,9 @@ from slicer.util import VTKObservationMixin
 import SimpleITK as sitk
 import sitkUtils
 import numpy as np
-from skimage.restoration import unwrap_phase
 
-from math import sqrt, pow
+from SimpleNeedleTrackingLib import NeedleTrackingEngine, ImageGeometry, TrackingFrame, TrackingParameters, TrackingWorker, StageProfiler, DebugImageWriter, IGTLImageReceiver, TipHistory, RobotTipPrior, \
+  TrackingResult, TrackingStatistics, FAILURE_NOT_INITIALIZED, FAILURE_FRAME_SKIPPED, getSpawnContext
 
 
 class SimpleNeedleTracking(ScriptedLoadableModule):
@@ -138,6 +140,30 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.tipPredictionSelector.setToolTip('Select the tip prediction node')
     trackingFormLayout.addRow('Tip prediction:', self.tipPredictionSelector)
 
+    # Tip predictions of other needles tracked in the same frame (one tracked tip node per needle)
+    self.otherTipPredictionsSelector = slicer.qMRMLCheckableNodeComboBox()
+    self.otherTipPredictionsSelector.nodeTypes = ['vtkMRMLLinearTransformNode']
+    self.otherTipPredictionsSelector.addEnabled = False
+    self.otherTipPredictionsSelector.removeEnabled = False
+    self.otherTipPredictionsSelector.showHidden = False
+    self.otherTipPredictionsSelector.showChildNodeTypes = False
+    self.otherTipPredictionsSelector.setMRMLScene(slicer.mrmlScene)
+    self.otherTipPredictionsSelector.setToolTip('Check the tip prediction nodes of other needles to track in the same frames (tracked tips: CurrentTrackedTipTransform_2, _3, ...)')
+    trackingFormLayout.addRow('Other needles:', self.otherTipPredictionsSelector)
+
+    # Robot pose (tip prediction of the first needle from the robot)
+    self.robotPoseSelector = slicer.qMRMLNodeComboBox()
+    self.robotPoseSelector.nodeTypes = ['vtkMRMLLinearTransformNode']
+    self.robotPoseSelector.selectNodeUponCreation = False
+    self.robotPoseSelector.addEnabled = False
+    self.robotPoseSelector.removeEnabled = False
+    self.robotPoseSelector.noneEnabled = True
+    self.robotPoseSelector.showHidden = False
+    self.robotPoseSelector.showChildNodeTypes = False
+    self.robotPoseSelector.setMRMLScene(slicer.mrmlScene)
+    self.robotPoseSelector.setToolTip('Select the robot needle pose (CurrentPositionTransform of ProstateBRPInterface) to predict the tip of the first needle from the robot. None: tip prediction node only')
+    trackingFormLayout.addRow('Robot pose:', self.robotPoseSelector)
+
     # Start/Stop tracking 
     trackingHBoxLayout = qt.QHBoxLayout()    
     self.startTrackingButton = qt.QPushButton('Start Tracking')
@@ -164,6 +190,22 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.debugFlagCheckBox.checked = False
     self.debugFlagCheckBox.setToolTip('If checked, output images at intermediate steps')
     advancedFormLayout.addRow('Debug', self.debugFlagCheckBox)
+
+    # Debug frame interval (debug images of every N-th frame)
+    self.debugIntervalWidget = ctk.ctkSliderWidget()
+    self.debugIntervalWidget.singleStep = 1
+    self.debugIntervalWidget.setDecimals(0)
+    self.debugIntervalWidget.minimum = 1
+    self.debugIntervalWidget.maximum = 100
+    self.debugIntervalWidget.value = 1
+    self.debugIntervalWidget.setToolTip('Set frame interval of the debug images: only every N-th frame is pushed to the scene and written to the Debug directory.')
+    advancedFormLayout.addRow('Debug Interval:', self.debugIntervalWidget)
+
+    # Debug compression check box
+    self.debugCompressionCheckBox = qt.QCheckBox()
+    self.debugCompressionCheckBox.checked = False
+    self.debugCompressionCheckBox.setToolTip('If checked, compress the debug image files (written in the background)')
+    advancedFormLayout.addRow('Compress Debug:', self.debugCompressionCheckBox)
     
     # Mask threshold
     self.maskThresholdWidget = ctk.ctkSliderWidget()
@@ -213,6 +255,342 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.errorThresholdWidget.setToolTip('Set error threshold value (mm) for valid tip detection.')
     advancedFormLayout.addRow('Error Threshold:', self.errorThresholdWidget)
 
+    # ROI unwrap check box (unwrap only a window around the predicted tip)
+    self.roiUnwrapCheckBox = qt.QCheckBox()
+    self.roiUnwrapCheckBox.checked = False
+    self.roiUnwrapCheckBox.setToolTip('If checked, crop phase image and mask to the ROI (plus margin) before unwrapping')
+    advancedFormLayout.addRow('Unwrap ROI only:', self.roiUnwrapCheckBox)
+
+    # ROI margin
+    self.roiMarginWidget = ctk.ctkSliderWidget()
+    self.roiMarginWidget.singleStep = 1
+    self.roiMarginWidget.setDecimals(0)
+    self.roiMarginWidget.minimum = 0
+    self.roiMarginWidget.maximum = 50
+    self.roiMarginWidget.value = 10
+    self.roiMarginWidget.setToolTip('Set margin (px) added around the ROI window when unwrapping ROI only.')
+    advancedFormLayout.addRow('ROI Margin:', self.roiMarginWidget)
+
+    # Adaptive ROI check box (shrink ROI while detections are consistent, grow on misses)
+    self.roiAdaptiveCheckBox = qt.QCheckBox()
+    self.roiAdaptiveCheckBox.checked = False
+    self.roiAdaptiveCheckBox.setToolTip('If checked, start with the ROI size, shrink the ROI while detections are consistent and grow it on misses')
+    advancedFormLayout.addRow('Adaptive ROI:', self.roiAdaptiveCheckBox)
+
+    # Adaptive ROI size range
+    self.roiRangeWidget = ctk.ctkRangeWidget()
+    self.roiRangeWidget.singleStep = 1
+    self.roiRangeWidget.setDecimals(0)
+    self.roiRangeWidget.minimum = 3
+    self.roiRangeWidget.maximum = 100
+    self.roiRangeWidget.minimumValue = 11
+    self.roiRangeWidget.maximumValue = 45
+    self.roiRangeWidget.setToolTip('Set minimum and maximum ROI window size (px) of the adaptive ROI.')
+    advancedFormLayout.addRow('Adaptive ROI Range:', self.roiRangeWidget)
+
+    # Phase difference mode
+    self.phaseDifferenceUnwrap = qt.QRadioButton('Unwrap')
+    self.phaseDifferenceComplex = qt.QRadioButton('Complex')
+    self.phaseDifferenceUnwrap.checked = 1
+    self.phaseDifferenceUnwrap.setToolTip('Unwrap the phase image and subtract the unwrapped base phase')
+    self.phaseDifferenceComplex.setToolTip('Multiply the image by the conjugate base image and take the angle in the ROI window (no unwrapping of the phase image)')
+    self.phaseDifferenceButtonGroup = qt.QButtonGroup()
+    self.phaseDifferenceButtonGroup.addButton(self.phaseDifferenceUnwrap)
+    self.phaseDifferenceButtonGroup.addButton(self.phaseDifferenceComplex)
+    phaseDifferenceHBoxLayout = qt.QHBoxLayout()
+    phaseDifferenceHBoxLayout.addWidget(self.phaseDifferenceUnwrap)
+    phaseDifferenceHBoxLayout.addWidget(self.phaseDifferenceComplex)
+    advancedFormLayout.addRow('Phase Difference:', phaseDifferenceHBoxLayout)
+
+    # Unwrap difference check box (complex phase difference only)
+    self.unwrapDifferenceCheckBox = qt.QCheckBox()
+    self.unwrapDifferenceCheckBox.checked = False
+    self.unwrapDifferenceCheckBox.setToolTip('If checked, unwrap the phase difference map in the ROI window (Complex mode only). Not needed while the needle-induced phase shift stays under pi.')
+    advancedFormLayout.addRow('Unwrap Difference:', self.unwrapDifferenceCheckBox)
+
+    # Unwrap mode (whole stack or slice by slice)
+    self.unwrapMode3D = qt.QRadioButton('3D')
+    self.unwrapModeSlice = qt.QRadioButton('Slice')
+    self.unwrapMode3D.checked = 1
+    self.unwrapMode3D.setToolTip('Unwrap the phase of all slices together in 3D')
+    self.unwrapModeSlice.setToolTip('Unwrap each slice in 2D (independent thin slices), slices are unwrapped concurrently with more than one worker')
+    self.unwrapModeButtonGroup = qt.QButtonGroup()
+    self.unwrapModeButtonGroup.addButton(self.unwrapMode3D)
+    self.unwrapModeButtonGroup.addButton(self.unwrapModeSlice)
+    unwrapModeHBoxLayout = qt.QHBoxLayout()
+    unwrapModeHBoxLayout.addWidget(self.unwrapMode3D)
+    unwrapModeHBoxLayout.addWidget(self.unwrapModeSlice)
+    advancedFormLayout.addRow('Unwrap Mode:', unwrapModeHBoxLayout)
+
+    # Unwrap workers (Slice mode only)
+    self.unwrapWorkersWidget = ctk.ctkSliderWidget()
+    self.unwrapWorkersWidget.singleStep = 1
+    self.unwrapWorkersWidget.setDecimals(0)
+    self.unwrapWorkersWidget.minimum = 1
+    self.unwrapWorkersWidget.maximum = 16
+    self.unwrapWorkersWidget.value = 1
+    self.unwrapWorkersWidget.setToolTip('Set number of slices unwrapped concurrently (Slice mode only). Keep 1 unless UnwrapBenchmark shows a gain on this host.')
+    advancedFormLayout.addRow('Unwrap Workers:', self.unwrapWorkersWidget)
+
+    # Unwrap pool (Slice mode with more than one worker)
+    self.unwrapPoolThread = qt.QRadioButton('Thread')
+    self.unwrapPoolProcess = qt.QRadioButton('Process')
+    self.unwrapPoolThread.checked = 1
+    self.unwrapPoolThread.setToolTip('Unwrap slices on worker threads (low overhead)')
+    self.unwrapPoolProcess.setToolTip('Unwrap slices in worker processes. Warning: adds overhead (processes spawned on first use, slices pickled to and from them every frame)')
+    self.unwrapPoolButtonGroup = qt.QButtonGroup()
+    self.unwrapPoolButtonGroup.addButton(self.unwrapPoolThread)
+    self.unwrapPoolButtonGroup.addButton(self.unwrapPoolProcess)
+    unwrapPoolHBoxLayout = qt.QHBoxLayout()
+    unwrapPoolHBoxLayout.addWidget(self.unwrapPoolThread)
+    unwrapPoolHBoxLayout.addWidget(self.unwrapPoolProcess)
+    advancedFormLayout.addRow('Unwrap Pool:', unwrapPoolHBoxLayout)
+    # Worker processes need a Python interpreter (PythonSlicer)
+    if getSpawnContext() is None:
+      self.unwrapPoolProcess.enabled = False
+      self.unwrapPoolProcess.setToolTip('Not available: PythonSlicer interpreter not found')
+
+    # Tip prediction mode
+    self.predictionModeFixed = qt.QRadioButton('Fixed')
+    self.predictionModeKalman = qt.QRadioButton('Kalman')
+    self.predictionModeFixed.checked = 1
+    self.predictionModeFixed.setToolTip('Center the ROI on the tip prediction node')
+    self.predictionModeKalman.setToolTip('Center and size the ROI with a constant-velocity Kalman filter of the detected tips (the tip prediction node seeds the first detection)')
+    self.predictionModeButtonGroup = qt.QButtonGroup()
+    self.predictionModeButtonGroup.addButton(self.predictionModeFixed)
+    self.predictionModeButtonGroup.addButton(self.predictionModeKalman)
+    predictionModeHBoxLayout = qt.QHBoxLayout()
+    predictionModeHBoxLayout.addWidget(self.predictionModeFixed)
+    predictionModeHBoxLayout.addWidget(self.predictionModeKalman)
+    advancedFormLayout.addRow('Tip Prediction:', predictionModeHBoxLayout)
+
+    # Mahalanobis gate (Kalman prediction only)
+    self.mahalanobisGateWidget = ctk.ctkSliderWidget()
+    self.mahalanobisGateWidget.singleStep = 0.1
+    self.mahalanobisGateWidget.minimum = 1
+    self.mahalanobisGateWidget.maximum = 10
+    self.mahalanobisGateWidget.value = 3.4
+    self.mahalanobisGateWidget.setToolTip('Set gate (standard deviations) of the Mahalanobis distance from the Kalman prediction for valid tip detection. The error threshold (from the Kalman prediction) still applies.')
+    advancedFormLayout.addRow('Mahalanobis Gate:', self.mahalanobisGateWidget)
+
+    # Rolling baseline check box (blend tracked frames into the base images)
+    self.baselineRollingCheckBox = qt.QCheckBox()
+    self.baselineRollingCheckBox.checked = False
+    self.baselineRollingCheckBox.setToolTip('If checked, blend frames with all needles tracked into the base images (outside the needle exclusion zone) to follow slow motion and B0 drift')
+    advancedFormLayout.addRow('Rolling Baseline:', self.baselineRollingCheckBox)
+
+    # Rolling baseline weight
+    self.baselineWeightWidget = ctk.ctkSliderWidget()
+    self.baselineWeightWidget.singleStep = 0.01
+    self.baselineWeightWidget.minimum = 0.01
+    self.baselineWeightWidget.maximum = 0.5
+    self.baselineWeightWidget.value = 0.05
+    self.baselineWeightWidget.setToolTip('Set weight of a frame in the rolling baseline (exponential moving average).')
+    advancedFormLayout.addRow('Baseline Weight:', self.baselineWeightWidget)
+
+    # Rolling baseline needle exclusion zone
+    self.baselineExclusionWidget = ctk.ctkSliderWidget()
+    self.baselineExclusionWidget.singleStep = 1
+    self.baselineExclusionWidget.setDecimals(0)
+    self.baselineExclusionWidget.minimum = 0
+    self.baselineExclusionWidget.maximum = 100
+    self.baselineExclusionWidget.value = 20
+    self.baselineExclusionWidget.setToolTip('Set half width (mm) of the zone around each tracked tip that is not blended into the rolling baseline.')
+    advancedFormLayout.addRow('Baseline Exclusion:', self.baselineExclusionWidget)
+
+    # Rolling baseline update interval
+    self.baselineIntervalWidget = ctk.ctkSliderWidget()
+    self.baselineIntervalWidget.singleStep = 1
+    self.baselineIntervalWidget.setDecimals(0)
+    self.baselineIntervalWidget.minimum = 1
+    self.baselineIntervalWidget.maximum = 50
+    self.baselineIntervalWidget.value = 1
+    self.baselineIntervalWidget.setToolTip('Set number of frames between rolling baseline updates. In Unwrap mode each update unwraps the base phase again.')
+    advancedFormLayout.addRow('Baseline Interval:', self.baselineIntervalWidget)
+
+    # Temporal smoothing of the tracked tips
+    self.smoothingModeNone = qt.QRadioButton('None')
+    self.smoothingModeMedian = qt.QRadioButton('Median')
+    self.smoothingModeAlphaBeta = qt.QRadioButton('Alpha-beta')
+    self.smoothingModeOneEuro = qt.QRadioButton('One-euro')
+    self.smoothingModeNone.checked = 1
+    self.smoothingModeNone.setToolTip('Send the detected tips')
+    self.smoothingModeMedian.setToolTip('Send the median of the recent tips (robust to single-frame jumps, lags while inserting)')
+    self.smoothingModeAlphaBeta.setToolTip('Send the tips of an alpha-beta (position/velocity) filter of the recent tips')
+    self.smoothingModeOneEuro.setToolTip('Send the tips of a one-euro filter: smooth when the needle is at rest, responsive while inserting')
+    self.smoothingModeButtonGroup = qt.QButtonGroup()
+    self.smoothingModeButtonGroup.addButton(self.smoothingModeNone)
+    self.smoothingModeButtonGroup.addButton(self.smoothingModeMedian)
+    self.smoothingModeButtonGroup.addButton(self.smoothingModeAlphaBeta)
+    self.smoothingModeButtonGroup.addButton(self.smoothingModeOneEuro)
+    smoothingModeHBoxLayout = qt.QHBoxLayout()
+    smoothingModeHBoxLayout.addWidget(self.smoothingModeNone)
+    smoothingModeHBoxLayout.addWidget(self.smoothingModeMedian)
+    smoothingModeHBoxLayout.addWidget(self.smoothingModeAlphaBeta)
+    smoothingModeHBoxLayout.addWidget(self.smoothingModeOneEuro)
+    advancedFormLayout.addRow('Tip Smoothing:', smoothingModeHBoxLayout)
+
+    # Number of recent tips of the smoothing filter
+    self.smoothingWindowWidget = ctk.ctkSliderWidget()
+    self.smoothingWindowWidget.singleStep = 1
+    self.smoothingWindowWidget.setDecimals(0)
+    self.smoothingWindowWidget.minimum = 3
+    self.smoothingWindowWidget.maximum = 15
+    self.smoothingWindowWidget.value = 5
+    self.smoothingWindowWidget.setToolTip('Set number of recent tips used by the smoothing filter and the outlier rejection.')
+    advancedFormLayout.addRow('Smoothing Window:', self.smoothingWindowWidget)
+
+    # Outlier rejection distance (smoothing only)
+    self.outlierDistanceWidget = ctk.ctkSliderWidget()
+    self.outlierDistanceWidget.singleStep = 0.5
+    self.outlierDistanceWidget.minimum = 0
+    self.outlierDistanceWidget.maximum = 50
+    self.outlierDistanceWidget.value = 10
+    self.outlierDistanceWidget.setToolTip('Set distance (mm) from the median of the recent tips above which a detection is rejected as outlier (0: no rejection). Used with tip smoothing only.')
+    advancedFormLayout.addRow('Outlier Distance:', self.outlierDistanceWidget)
+
+    # Insertion depth beyond the robot pose (robot pose only)
+    self.insertionDepthWidget = ctk.ctkSliderWidget()
+    self.insertionDepthWidget.singleStep = 1
+    self.insertionDepthWidget.minimum = 0
+    self.insertionDepthWidget.maximum = 200
+    self.insertionDepthWidget.value = 0
+    self.insertionDepthWidget.setToolTip('Set commanded insertion depth (mm) of the needle tip beyond the robot pose along the needle axis (0: the robot pose is the tip).')
+    advancedFormLayout.addRow('Insertion Depth:', self.insertionDepthWidget)
+
+    # Age after which the robot pose is stale (robot pose only)
+    self.robotPoseTimeoutWidget = ctk.ctkSliderWidget()
+    self.robotPoseTimeoutWidget.singleStep = 0.1
+    self.robotPoseTimeoutWidget.minimum = 0.1
+    self.robotPoseTimeoutWidget.maximum = 10
+    self.robotPoseTimeoutWidget.value = 2
+    self.robotPoseTimeoutWidget.setToolTip('Set time (s) after the last robot pose update from which the last detected tip is used as tip prediction instead.')
+    advancedFormLayout.addRow('Robot Pose Timeout:', self.robotPoseTimeoutWidget)
+
+    # Skip frames where the robot tip is outside the image (robot pose only)
+    self.robotSkipFramesCheckBox = qt.QCheckBox()
+    self.robotSkipFramesCheckBox.checked = True
+    self.robotSkipFramesCheckBox.setToolTip('If checked, do not track frames while the robot tip prediction lies farther than the error threshold outside the image')
+    advancedFormLayout.addRow('Skip Frames Outside Image:', self.robotSkipFramesCheckBox)
+
+    # Tracking mode (synchronous or in a background worker)
+    self.trackingModeSync = qt.QRadioButton('Synchronous')
+    self.trackingModeThread = qt.QRadioButton('Thread')
+    self.trackingModeProcess = qt.QRadioButton('Process')
+    self.trackingModeSync.checked = 1
+    self.trackingModeSync.setToolTip('Track each frame in the image update callback')
+    self.trackingModeThread.setToolTip('Track in a background thread; frames arriving while busy replace the pending one')
+    self.trackingModeProcess.setToolTip('Track in a background process; frames arriving while busy replace the pending one')
+    self.trackingModeButtonGroup = qt.QButtonGroup()
+    self.trackingModeButtonGroup.addButton(self.trackingModeSync)
+    self.trackingModeButtonGroup.addButton(self.trackingModeThread)
+    self.trackingModeButtonGroup.addButton(self.trackingModeProcess)
+    trackingModeHBoxLayout = qt.QHBoxLayout()
+    trackingModeHBoxLayout.addWidget(self.trackingModeSync)
+    trackingModeHBoxLayout.addWidget(self.trackingModeThread)
+    trackingModeHBoxLayout.addWidget(self.trackingModeProcess)
+    advancedFormLayout.addRow('Tracking Mode:', trackingModeHBoxLayout)
+    # Worker processes need a Python interpreter (PythonSlicer): Process mode is disabled without it
+    if getSpawnContext() is None:
+      self.trackingModeProcess.enabled = False
+      self.trackingModeProcess.setToolTip('Not available: PythonSlicer interpreter not found')
+
+    # Image source (volume nodes or OpenIGTLink IMAGE messages received by the module)
+    self.imageSourceScene = qt.QRadioButton('Scene')
+    self.imageSourceIGTL = qt.QRadioButton('OpenIGTLink')
+    self.imageSourceScene.checked = 1
+    self.imageSourceScene.setToolTip('Track when the second volume node is modified')
+    self.imageSourceIGTL.setToolTip('Receive magnitude/phase IMAGE messages directly (no MRML scene), paired by timestamp. The first received frame sets the base images.')
+    self.imageSourceButtonGroup = qt.QButtonGroup()
+    self.imageSourceButtonGroup.addButton(self.imageSourceScene)
+    self.imageSourceButtonGroup.addButton(self.imageSourceIGTL)
+    imageSourceHBoxLayout = qt.QHBoxLayout()
+    imageSourceHBoxLayout.addWidget(self.imageSourceScene)
+    imageSourceHBoxLayout.addWidget(self.imageSourceIGTL)
+    advancedFormLayout.addRow('Image Source:', imageSourceHBoxLayout)
+
+    # OpenIGTLink server of the images
+    self.igtlHostLineEdit = qt.QLineEdit()
+    self.igtlHostLineEdit.setToolTip('Host name of the OpenIGTLink server sending the images')
+    self.igtlPortSpinBox = qt.QSpinBox()
+    self.igtlPortSpinBox.minimum = 1
+    self.igtlPortSpinBox.maximum = 65535
+    self.igtlPortSpinBox.value = 18944
+    self.igtlPortSpinBox.setToolTip('Port of the OpenIGTLink server sending the images')
+    igtlServerHBoxLayout = qt.QHBoxLayout()
+    igtlServerHBoxLayout.addWidget(self.igtlHostLineEdit)
+    igtlServerHBoxLayout.addWidget(self.igtlPortSpinBox)
+    advancedFormLayout.addRow('IGTL Server:', igtlServerHBoxLayout)
+
+    # OpenIGTLink device names of the first/second images
+    self.igtlFirstDeviceLineEdit = qt.QLineEdit()
+    self.igtlFirstDeviceLineEdit.setToolTip('Device name of the magnitude/real images (empty: name of the first volume node)')
+    self.igtlSecondDeviceLineEdit = qt.QLineEdit()
+    self.igtlSecondDeviceLineEdit.setToolTip('Device name of the phase/imaginary images (empty: name of the second volume node)')
+    igtlDevicesHBoxLayout = qt.QHBoxLayout()
+    igtlDevicesHBoxLayout.addWidget(self.igtlFirstDeviceLineEdit)
+    igtlDevicesHBoxLayout.addWidget(self.igtlSecondDeviceLineEdit)
+    advancedFormLayout.addRow('IGTL Devices:', igtlDevicesHBoxLayout)
+
+    ## Profiling                      
+    ####################################
+
+    profilingCollapsibleButton = ctk.ctkCollapsibleButton()
+    profilingCollapsibleButton.text = 'Profiling'
+    profilingCollapsibleButton.collapsed=1
+    self.layout.addWidget(profilingCollapsibleButton)
+    profilingFormLayout = qt.QFormLayout(profilingCollapsibleButton)
+
+    # Profiling check box (collect per-stage latency statistics)
+    self.profilingCheckBox = qt.QCheckBox()
+    self.profilingCheckBox.checked = False
+    self.profilingCheckBox.setToolTip('If checked, collect rolling latency percentiles of each tracking stage')
+    profilingFormLayout.addRow('Profile stages:', self.profilingCheckBox)
+
+    # Stage latency table
+    self.profilingTable = qt.QTableWidget()
+    self.profilingTable.setColumnCount(6)
+    self.profilingTable.setHorizontalHeaderLabels(['Stage', 'N', 'Mean (ms)', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)'])
+    self.profilingTable.verticalHeader().visible = False
+    self.profilingTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+    self.profilingTable.setMinimumHeight(150)
+    profilingFormLayout.addRow(self.profilingTable)
+
+    # Reset statistics
+    self.resetProfilingButton = qt.QPushButton('Reset')
+    self.resetProfilingButton.toolTip = 'Clear collected stage latencies'
+    profilingFormLayout.addRow('', self.resetProfilingButton)
+
+    # Tracked tip history (all results of the session)
+    self.exportTipHistoryButton = qt.QPushButton('Export...')
+    self.exportTipHistoryButton.toolTip = 'Save tracked tips, failures and blob statistics of all frames as .npy or .csv file'
+    self.clearTipHistoryButton = qt.QPushButton('Clear')
+    self.clearTipHistoryButton.toolTip = 'Remove all records of the tip history'
+    tipHistoryHBoxLayout = qt.QHBoxLayout()
+    tipHistoryHBoxLayout.addWidget(self.exportTipHistoryButton)
+    tipHistoryHBoxLayout.addWidget(self.clearTipHistoryButton)
+    profilingFormLayout.addRow('Tip history:', tipHistoryHBoxLayout)
+
+    # Tracking health counters of the session (frames received/processed/dropped, success rate, failures per reason)
+    self.healthTable = qt.QTableWidget()
+    self.healthTable.setColumnCount(2)
+    self.healthTable.setHorizontalHeaderLabels(['Counter', 'Value'])
+    self.healthTable.verticalHeader().visible = False
+    self.healthTable.horizontalHeader().setStretchLastSection(True)
+    self.healthTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+    self.healthTable.setMinimumHeight(150)
+    profilingFormLayout.addRow(self.healthTable)
+
+    # Export/reset tracking health counters
+    self.exportHealthButton = qt.QPushButton('Export...')
+    self.exportHealthButton.toolTip = 'Save tracking health counters of the session as .json or .csv file'
+    self.resetHealthButton = qt.QPushButton('Reset')
+    self.resetHealthButton.toolTip = 'Clear tracking health counters (also cleared when tracking starts)'
+    healthHBoxLayout = qt.QHBoxLayout()
+    healthHBoxLayout.addWidget(self.exportHealthButton)
+    healthHBoxLayout.addWidget(self.resetHealthButton)
+    profilingFormLayout.addRow('Tracking health:', healthHBoxLayout)
+
     self.layout.addStretch(1)
     
     ####################################
@@ -235,12 +613,54 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.sceneViewButton_yellow.connect("toggled(bool)", self.updateParameterNodeFromGUI)
     self.sceneViewButton_green.connect("toggled(bool)", self.updateParameterNodeFromGUI)
     self.tipPredictionSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateParameterNodeFromGUI)
+    self.otherTipPredictionsSelector.connect('checkedNodesChanged()', self.updateParameterNodeFromGUI)
+    self.robotPoseSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateParameterNodeFromGUI)
     self.maskThresholdWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
     self.maskClosingWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
     self.roiSizeWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
     self.blobThresholdWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
     self.errorThresholdWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
     self.debugFlagCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.debugIntervalWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
+    self.debugCompressionCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.roiUnwrapCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.roiMarginWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
+    self.roiAdaptiveCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.roiRangeWidget.connect("valuesChanged(double,double)", self.updateParameterNodeFromGUI)
+    self.phaseDifferenceUnwrap.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.phaseDifferenceComplex.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.unwrapMode3D.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.unwrapModeSlice.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.unwrapWorkersWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
+    self.unwrapPoolThread.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.unwrapPoolProcess.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.unwrapDifferenceCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.predictionModeFixed.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.predictionModeKalman.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.mahalanobisGateWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
+    self.baselineRollingCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.baselineWeightWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
+    self.baselineExclusionWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
+    self.baselineIntervalWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
+    self.smoothingModeNone.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.smoothingModeMedian.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.smoothingModeAlphaBeta.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.smoothingModeOneEuro.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.smoothingWindowWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
+    self.outlierDistanceWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
+    self.insertionDepthWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
+    self.robotPoseTimeoutWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
+    self.robotSkipFramesCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.trackingModeSync.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.trackingModeThread.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.trackingModeProcess.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.imageSourceScene.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.imageSourceIGTL.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.igtlHostLineEdit.connect("textChanged(QString)", self.updateParameterNodeFromGUI)
+    self.igtlPortSpinBox.connect("valueChanged(int)", self.updateParameterNodeFromGUI)
+    self.igtlFirstDeviceLineEdit.connect("textChanged(QString)", self.updateParameterNodeFromGUI)
+    self.igtlSecondDeviceLineEdit.connect("textChanged(QString)", self.updateParameterNodeFromGUI)
+    self.profilingCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
     
     # Connect UI buttons to event calls
     self.startTrackingButton.connect('clicked(bool)', self.startTracking)
@@ -248,9 +668,16 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.firstVolumeSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateButtons)
     self.secondVolumeSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateButtons)
     self.tipPredictionSelector.connect('currentNodeChanged(vtkMRMLNode*)', self.updateButtons)
+    self.profilingCheckBox.connect('toggled(bool)', self.onProfilingToggled)
+    self.resetProfilingButton.connect('clicked(bool)', self.onResetProfiling)
+    self.exportTipHistoryButton.connect('clicked(bool)', self.onExportTipHistory)
+    self.clearTipHistoryButton.connect('clicked(bool)', self.onClearTipHistory)
+    self.exportHealthButton.connect('clicked(bool)', self.onExportHealth)
+    self.resetHealthButton.connect('clicked(bool)', self.onResetHealth)
 
     # Internal variables
     self.isTrackingOn = False
+    self.tipPredictions = None
     self.firstVolume = None
     self.secondVolume = None
     self.sliceIndex = None
@@ -261,6 +688,56 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.sliceIndex = None
     self.blobThreshold = None
     self.debugFlag = None
+    self.debugInterval = None
+    self.debugCompression = None
+    self.roiUnwrap = None
+    self.roiMargin = None
+    self.roiMode = None
+    self.roiMinimum = None
+    self.roiMaximum = None
+    self.phaseDifferenceMode = None
+    self.unwrapMode = None
+    self.unwrapWorkers = None
+    self.unwrapPool = None
+    self.unwrapDifference = None
+    self.predictionMode = None
+    self.mahalanobisGate = None
+    self.baselineMode = None
+    self.baselineWeight = None
+    self.baselineExclusion = None
+    self.baselineInterval = None
+    self.smoothingMode = None
+    self.smoothingWindow = None
+    self.outlierDistance = None
+    self.robotPose = None
+    self.insertionDepth = None
+    self.robotPoseTimeout = None
+    self.robotSkipFrames = None
+    self.trackingMode = None
+    self.imageSource = None
+    self.trackingParameters = None
+    self.workerParameters = None
+    self.isBaseFrameReceived = False
+
+    # Timer to collect results of the background tracking worker (on the main thread)
+    self.workerResultsTimer = qt.QTimer()
+    self.workerResultsTimer.setInterval(10)
+    self.workerResultsTimer.connect('timeout()', self.onWorkerResultsTimer)
+
+    # Timer to take frames received from OpenIGTLink (on the main thread)
+    self.receivedFrameTimer = qt.QTimer()
+    self.receivedFrameTimer.setInterval(5)
+    self.receivedFrameTimer.connect('timeout()', self.onReceivedFrameTimer)
+
+    # Timer to refresh the stage latency table
+    self.profilingTimer = qt.QTimer()
+    self.profilingTimer.setInterval(1000)
+    self.profilingTimer.connect('timeout()', self.updateProfilingTable)
+
+    # Timer to refresh the tracking health table while tracking
+    self.healthTimer = qt.QTimer()
+    self.healthTimer.setInterval(1000)
+    self.healthTimer.connect('timeout()', self.updateHealthTable)
 
     # Initialize module logic
     self.logic = SimpleNeedleTrackingLogic()
@@ -273,6 +750,12 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
 
   # Called when the application closes and the module widget is destroyed.
   def cleanup(self):
+    self.workerResultsTimer.stop()
+    self.profilingTimer.stop()
+    self.healthTimer.stop()
+    self.receivedFrameTimer.stop()
+    self.logic.stopWorker()
+    self.logic.stopReceiver()
     self.removeObservers()
 
   # Called each time the user opens this module.
@@ -335,12 +818,60 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.sceneViewButton_yellow.checked = (self._parameterNode.GetParameter('SceneView') == 'Yellow')
     self.sceneViewButton_green.checked = (self._parameterNode.GetParameter('SceneView') == 'Green')
     self.tipPredictionSelector.setCurrentNode(self._parameterNode.GetNodeReference('TipPrediction'))
+    otherTipPredictions = [self._parameterNode.GetNthNodeReference('OtherTipPrediction', n) for n in range(self._parameterNode.GetNumberOfNodeReferences('OtherTipPrediction'))]
+    for node in self.otherTipPredictionsSelector.nodes():
+      self.otherTipPredictionsSelector.setCheckState(node, qt.Qt.Checked if node in otherTipPredictions else qt.Qt.Unchecked)
+    self.robotPoseSelector.setCurrentNode(self._parameterNode.GetNodeReference('RobotPose'))
     self.maskThresholdWidget.value = float(self._parameterNode.GetParameter('MaskThreshold'))
     self.maskClosingWidget.value = float(self._parameterNode.GetParameter('MaskClosing'))
     self.roiSizeWidget.value = float(self._parameterNode.GetParameter('ROISize'))
     self.blobThresholdWidget.value = float(self._parameterNode.GetParameter('BlobThreshold'))
     self.errorThresholdWidget.value = float(self._parameterNode.GetParameter('ErrorThreshold'))
     self.debugFlagCheckBox.checked = (self._parameterNode.GetParameter('Debug') == 'True')
+    self.debugIntervalWidget.value = float(self._parameterNode.GetParameter('DebugInterval'))
+    self.debugCompressionCheckBox.checked = (self._parameterNode.GetParameter('DebugCompression') == 'True')
+    self.roiUnwrapCheckBox.checked = (self._parameterNode.GetParameter('ROIUnwrap') == 'True')
+    self.roiMarginWidget.value = float(self._parameterNode.GetParameter('ROIMargin'))
+    self.roiAdaptiveCheckBox.checked = (self._parameterNode.GetParameter('ROIMode') == 'Adaptive')
+    self.roiRangeWidget.setValues(float(self._parameterNode.GetParameter('ROIMinimum')), float(self._parameterNode.GetParameter('ROIMaximum')))
+    self.phaseDifferenceUnwrap.checked = (self._parameterNode.GetParameter('PhaseDifferenceMode') == 'Unwrap')
+    self.phaseDifferenceComplex.checked = (self._parameterNode.GetParameter('PhaseDifferenceMode') == 'Complex')
+    self.unwrapMode3D.checked = (self._parameterNode.GetParameter('UnwrapMode') == '3D')
+    self.unwrapModeSlice.checked = (self._parameterNode.GetParameter('UnwrapMode') == 'Slice')
+    self.unwrapWorkersWidget.value = float(self._parameterNode.GetParameter('UnwrapWorkers'))
+    unwrapPool = self._parameterNode.GetParameter('UnwrapPool') if self.unwrapPoolProcess.enabled else 'Thread'
+    self.unwrapPoolThread.checked = (unwrapPool == 'Thread')
+    self.unwrapPoolProcess.checked = (unwrapPool == 'Process')
+    self.unwrapDifferenceCheckBox.checked = (self._parameterNode.GetParameter('UnwrapDifference') == 'True')
+    self.predictionModeFixed.checked = (self._parameterNode.GetParameter('PredictionMode') == 'Fixed')
+    self.predictionModeKalman.checked = (self._parameterNode.GetParameter('PredictionMode') == 'Kalman')
+    self.mahalanobisGateWidget.value = float(self._parameterNode.GetParameter('MahalanobisGate'))
+    self.baselineRollingCheckBox.checked = (self._parameterNode.GetParameter('BaselineMode') == 'Rolling')
+    self.baselineWeightWidget.value = float(self._parameterNode.GetParameter('BaselineWeight'))
+    self.baselineExclusionWidget.value = float(self._parameterNode.GetParameter('BaselineExclusion'))
+    self.baselineIntervalWidget.value = float(self._parameterNode.GetParameter('BaselineInterval'))
+    self.smoothingModeNone.checked = (self._parameterNode.GetParameter('SmoothingMode') == 'None')
+    self.smoothingModeMedian.checked = (self._parameterNode.GetParameter('SmoothingMode') == 'Median')
+    self.smoothingModeAlphaBeta.checked = (self._parameterNode.GetParameter('SmoothingMode') == 'AlphaBeta')
+    self.smoothingModeOneEuro.checked = (self._parameterNode.GetParameter('SmoothingMode') == 'OneEuro')
+    self.smoothingWindowWidget.value = float(self._parameterNode.GetParameter('SmoothingWindow'))
+    self.outlierDistanceWidget.value = float(self._parameterNode.GetParameter('OutlierDistance'))
+    self.insertionDepthWidget.value = float(self._parameterNode.GetParameter('InsertionDepth'))
+    self.robotPoseTimeoutWidget.value = float(self._parameterNode.GetParameter('RobotPoseTimeout'))
+    self.robotSkipFramesCheckBox.checked = (self._parameterNode.GetParameter('RobotSkipFrames') == 'True')
+    trackingMode = self._parameterNode.GetParameter('TrackingMode')
+    if (trackingMode == 'Process') and (not self.trackingModeProcess.enabled):
+      trackingMode = 'Sync'
+    self.trackingModeSync.checked = (trackingMode == 'Sync')
+    self.trackingModeThread.checked = (trackingMode == 'Thread')
+    self.trackingModeProcess.checked = (trackingMode == 'Process')
+    self.imageSourceScene.checked = (self._parameterNode.GetParameter('ImageSource') == 'Scene')
+    self.imageSourceIGTL.checked = (self._parameterNode.GetParameter('ImageSource') == 'OpenIGTLink')
+    self.igtlHostLineEdit.text = self._parameterNode.GetParameter('IGTLHost')
+    self.igtlPortSpinBox.value = int(float(self._parameterNode.GetParameter('IGTLPort')))
+    self.igtlFirstDeviceLineEdit.text = self._parameterNode.GetParameter('IGTLFirstDevice')
+    self.igtlSecondDeviceLineEdit.text = self._parameterNode.GetParameter('IGTLSecondDevice')
+    self.profilingCheckBox.checked = (self._parameterNode.GetParameter('Profiling') == 'True')
     
     # Update buttons states
     self.updateButtons()
@@ -359,12 +890,47 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self._parameterNode.SetParameter('InputMode', 'MagPhase' if self.inputModeMagPhase.checked else 'RealImag')
     self._parameterNode.SetParameter('SceneView', self.getSelectedView())
     self._parameterNode.SetNodeReferenceID('TipPrediction', self.tipPredictionSelector.currentNodeID)
+    self._parameterNode.RemoveNodeReferenceIDs('OtherTipPrediction')
+    for node in self.otherTipPredictionsSelector.checkedNodes():
+      self._parameterNode.AddNodeReferenceID('OtherTipPrediction', node.GetID())
+    self._parameterNode.SetNodeReferenceID('RobotPose', self.robotPoseSelector.currentNodeID)
     self._parameterNode.SetParameter('MaskThreshold', str(self.maskThresholdWidget.value))
     self._parameterNode.SetParameter('MaskClosing', str(self.maskClosingWidget.value))
     self._parameterNode.SetParameter('ROISize', str(self.roiSizeWidget.value))
     self._parameterNode.SetParameter('BlobThreshold', str(self.blobThresholdWidget.value))
     self._parameterNode.SetParameter('ErrorThreshold', str(self.errorThresholdWidget.value))
     self._parameterNode.SetParameter('Debug', 'True' if self.debugFlagCheckBox.checked else 'False')
+    self._parameterNode.SetParameter('DebugInterval', str(self.debugIntervalWidget.value))
+    self._parameterNode.SetParameter('DebugCompression', 'True' if self.debugCompressionCheckBox.checked else 'False')
+    self._parameterNode.SetParameter('ROIUnwrap', 'True' if self.roiUnwrapCheckBox.checked else 'False')
+    self._parameterNode.SetParameter('ROIMargin', str(self.roiMarginWidget.value))
+    self._parameterNode.SetParameter('ROIMode', 'Adaptive' if self.roiAdaptiveCheckBox.checked else 'Fixed')
+    self._parameterNode.SetParameter('ROIMinimum', str(self.roiRangeWidget.minimumValue))
+    self._parameterNode.SetParameter('ROIMaximum', str(self.roiRangeWidget.maximumValue))
+    self._parameterNode.SetParameter('PhaseDifferenceMode', 'Complex' if self.phaseDifferenceComplex.checked else 'Unwrap')
+    self._parameterNode.SetParameter('UnwrapMode', 'Slice' if self.unwrapModeSlice.checked else '3D')
+    self._parameterNode.SetParameter('UnwrapWorkers', str(self.unwrapWorkersWidget.value))
+    self._parameterNode.SetParameter('UnwrapPool', 'Process' if self.unwrapPoolProcess.checked else 'Thread')
+    self._parameterNode.SetParameter('UnwrapDifference', 'True' if self.unwrapDifferenceCheckBox.checked else 'False')
+    self._parameterNode.SetParameter('PredictionMode', 'Kalman' if self.predictionModeKalman.checked else 'Fixed')
+    self._parameterNode.SetParameter('MahalanobisGate', str(self.mahalanobisGateWidget.value))
+    self._parameterNode.SetParameter('BaselineMode', 'Rolling' if self.baselineRollingCheckBox.checked else 'Fixed')
+    self._parameterNode.SetParameter('BaselineWeight', str(self.baselineWeightWidget.value))
+    self._parameterNode.SetParameter('BaselineExclusion', str(self.baselineExclusionWidget.value))
+    self._parameterNode.SetParameter('BaselineInterval', str(self.baselineIntervalWidget.value))
+    self._parameterNode.SetParameter('SmoothingMode', self.getSelectedSmoothingMode())
+    self._parameterNode.SetParameter('SmoothingWindow', str(self.smoothingWindowWidget.value))
+    self._parameterNode.SetParameter('OutlierDistance', str(self.outlierDistanceWidget.value))
+    self._parameterNode.SetParameter('InsertionDepth', str(self.insertionDepthWidget.value))
+    self._parameterNode.SetParameter('RobotPoseTimeout', str(self.robotPoseTimeoutWidget.value))
+    self._parameterNode.SetParameter('RobotSkipFrames', 'True' if self.robotSkipFramesCheckBox.checked else 'False')
+    self._parameterNode.SetParameter('TrackingMode', self.getSelectedTrackingMode())
+    self._parameterNode.SetParameter('ImageSource', 'OpenIGTLink' if self.imageSourceIGTL.checked else 'Scene')
+    self._parameterNode.SetParameter('IGTLHost', self.igtlHostLineEdit.text)
+    self._parameterNode.SetParameter('IGTLPort', str(self.igtlPortSpinBox.value))
+    self._parameterNode.SetParameter('IGTLFirstDevice', self.igtlFirstDeviceLineEdit.text)
+    self._parameterNode.SetParameter('IGTLSecondDevice', self.igtlSecondDeviceLineEdit.text)
+    self._parameterNode.SetParameter('Profiling', 'True' if self.profilingCheckBox.checked else 'False')
     self._parameterNode.EndModify(wasModified)
                         
   # Update button states
@@ -385,6 +951,89 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
       selectedView = ('Green')
     return selectedView
   
+  # Get selected tracking mode
+  def getSelectedTrackingMode(self):
+    if (self.trackingModeThread.checked == True):
+      return 'Thread'
+    elif (self.trackingModeProcess.checked == True):
+      return 'Process'
+    return 'Sync'
+
+  def getSelectedSmoothingMode(self):
+    if (self.smoothingModeMedian.checked == True):
+      return 'Median'
+    elif (self.smoothingModeAlphaBeta.checked == True):
+      return 'AlphaBeta'
+    elif (self.smoothingModeOneEuro.checked == True):
+      return 'OneEuro'
+    return 'None'
+
+  # Enable/disable stage profiling
+  def onProfilingToggled(self, checked):
+    self.logic.setProfilingEnabled(checked)
+    if checked:
+      self.profilingTimer.start()
+    else:
+      self.profilingTimer.stop()
+      self.updateProfilingTable()
+
+  # Clear stage latency statistics
+  def onResetProfiling(self):
+    self.logic.resetStageStatistics()
+    self.updateProfilingTable()
+
+  # Save the tip history (.npy or .csv, by file extension)
+  def onExportTipHistory(self):
+    path = qt.QFileDialog.getSaveFileName(None, 'Export tip history', os.path.join(self.logic.path, 'TipHistory.npy'), 'NumPy files (*.npy);;CSV files (*.csv)')
+    if path:
+      count = self.logic.exportTipHistory(path)
+      print('Tip history: %d records saved to %s' %(count, path))
+
+  # Remove all records of the tip history
+  def onClearTipHistory(self):
+    self.logic.clearTipHistory()
+
+  # Show rolling stage latency statistics in the table
+  def updateProfilingTable(self):
+    statistics = self.logic.getStageStatistics()
+    self.profilingTable.setRowCount(len(statistics))
+    for (row, (stage, values)) in enumerate(statistics.items()):
+      self.profilingTable.setItem(row, 0, qt.QTableWidgetItem(stage))
+      self.profilingTable.setItem(row, 1, qt.QTableWidgetItem('%d' %(values['count'])))
+      for (column, key) in enumerate(['mean', 'p50', 'p95', 'p99']):
+        self.profilingTable.setItem(row, column+2, qt.QTableWidgetItem('%.2f' %(values[key])))
+
+  # Save the tracking health counters (.json or .csv, by file extension)
+  def onExportHealth(self):
+    path = qt.QFileDialog.getSaveFileName(None, 'Export tracking health', os.path.join(self.logic.path, 'TrackingStatistics.json'), 'JSON files (*.json);;CSV files (*.csv)')
+    if path:
+      self.logic.exportTrackingStatistics(path)
+      print('Tracking health saved to %s' %(path))
+
+  # Clear the tracking health counters
+  def onResetHealth(self):
+    self.logic.resetTrackingStatistics()
+    self.updateHealthTable()
+
+  # Show tracking health counters of the session in the table
+  def updateHealthTable(self):
+    statistics = self.logic.getTrackingStatistics()
+    rows = [('Status', statistics['status']),
+            ('Received', '%d (%.1f/s)' %(statistics['received'], statistics['receivedRate'])),
+            ('Processed', '%d (%.1f/s)' %(statistics['processed'], statistics['processedRate'])),
+            ('Dropped', '%d' %(statistics['dropped'])),
+            ('Skipped', '%d' %(statistics['skipped'])),
+            ('Pending', '%d' %(statistics['pending'])),
+            ('Success rate', '%.1f%% (recent %.1f%%)' %(100.0*statistics['successRate'], 100.0*statistics['recentSuccessRate'])),
+            ('Recent drop rate', '%.1f%%' %(100.0*statistics['recentDropRate'])),
+            ('Latency (ms)', '%.1f' %(statistics['recentLatency'])),
+            ('Lag (ms)', '%.1f' %(statistics['recentLag']))]
+    rows += [(reason, '%d' %(count)) for (reason, count) in statistics['failures'].items()]
+    self.healthTable.setRowCount(len(rows))
+    for (row, (name, value)) in enumerate(rows):
+      self.healthTable.setItem(row, 0, qt.QTableWidgetItem(name))
+      self.healthTable.setItem(row, 1, qt.QTableWidgetItem(value))
+
   # Get current slice index displayed in selected viewer
   def getSliceIndex(self, selectedView):   
     layoutManager = slicer.app.layoutManager()
@@ -404,12 +1053,73 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.blobThreshold = float(self.blobThresholdWidget.value)
     self.errorThreshold = float(self.errorThresholdWidget.value)
     self.debugFlag = self.debugFlagCheckBox.checked
+    self.debugInterval = int(self.debugIntervalWidget.value)
+    self.debugCompression = self.debugCompressionCheckBox.checked
+    self.roiUnwrap = self.roiUnwrapCheckBox.checked
+    self.roiMargin = int(self.roiMarginWidget.value)
+    self.roiMode = 'Adaptive' if self.roiAdaptiveCheckBox.checked else 'Fixed'
+    self.roiMinimum = int(self.roiRangeWidget.minimumValue)
+    self.roiMaximum = int(self.roiRangeWidget.maximumValue)
+    self.phaseDifferenceMode = 'Complex' if self.phaseDifferenceComplex.checked else 'Unwrap'
+    self.unwrapMode = 'Slice' if self.unwrapModeSlice.checked else '3D'
+    self.unwrapWorkers = int(self.unwrapWorkersWidget.value)
+    self.unwrapPool = 'Process' if self.unwrapPoolProcess.checked else 'Thread'
+    self.unwrapDifference = self.unwrapDifferenceCheckBox.checked
+    self.predictionMode = 'Kalman' if self.predictionModeKalman.checked else 'Fixed'
+    self.mahalanobisGate = float(self.mahalanobisGateWidget.value)
+    self.baselineMode = 'Rolling' if self.baselineRollingCheckBox.checked else 'Fixed'
+    self.baselineWeight = float(self.baselineWeightWidget.value)
+    self.baselineExclusion = float(self.baselineExclusionWidget.value)
+    self.baselineInterval = int(self.baselineIntervalWidget.value)
+    self.smoothingMode = self.getSelectedSmoothingMode()
+    self.smoothingWindow = int(self.smoothingWindowWidget.value)
+    self.outlierDistance = float(self.outlierDistanceWidget.value)
+    self.insertionDepth = float(self.insertionDepthWidget.value)
+    self.robotPoseTimeout = float(self.robotPoseTimeoutWidget.value)
+    self.robotSkipFrames = self.robotSkipFramesCheckBox.checked
+    self.trackingMode = self.getSelectedTrackingMode()
+    self.imageSource = 'OpenIGTLink' if self.imageSourceIGTL.checked else 'Scene'
     # Get selected nodes
     self.firstVolume = self.firstVolumeSelector.currentNode()
     self.secondVolume = self.secondVolumeSelector.currentNode()    
     self.tipPrediction = self.tipPredictionSelector.currentNode()
+    self.tipPredictions = [self.tipPrediction] + [node for node in self.otherTipPredictionsSelector.checkedNodes() if node != self.tipPrediction]
+    # New tracking session
+    self.logic.resetTrackingStatistics()
+    self.healthTimer.start()
+    self.robotPose = self.robotPoseSelector.currentNode()
+    if self.robotPose is not None:
+      # Tip prediction of the first needle from the robot pose, observed for freshness
+      self.logic.startRobotCoupling(self.robotPose, self.insertionDepth, self.robotPoseTimeout, self.errorThreshold if self.robotSkipFrames else None)
+      self.addObserver(self.robotPose, slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onRobotPoseModified)
+    self.trackingParameters = TrackingParameters(inputMode=self.inputMode, maskThreshold=self.maskThreshold, maskClosing=self.maskClosing, roiSize=self.roiSize,
+                                                 blobThreshold=self.blobThreshold, errorThreshold=self.errorThreshold, debugFlag=self.debugFlag, roiUnwrap=self.roiUnwrap,
+                                                 roiMargin=self.roiMargin, phaseDifferenceMode=self.phaseDifferenceMode, unwrapDifference=self.unwrapDifference,
+                                                 predictionMode=self.predictionMode, mahalanobisGate=self.mahalanobisGate, roiMode=self.roiMode, roiMinimum=self.roiMinimum,
+                                                 roiMaximum=self.roiMaximum, baselineMode=self.baselineMode, baselineWeight=self.baselineWeight,
+                                                 baselineExclusion=self.baselineExclusion, baselineInterval=self.baselineInterval, unwrapMode=self.unwrapMode,
+                                                 unwrapWorkers=self.unwrapWorkers, unwrapPool=self.unwrapPool, smoothingMode=self.smoothingMode,
+                                                 smoothingWindow=self.smoothingWindow, outlierDistance=self.outlierDistance)
+    if self.trackingMode == 'Sync':
+      if self.debugFlag:
+        self.logic.startDebugWriter(self.debugInterval, self.debugCompression)
+    else:
+      # Debug images cannot be pushed to the scene from the worker
+      self.workerParameters = copy.copy(self.trackingParameters)
+      self.workerParameters.debugFlag = False
+    if self.imageSource == 'OpenIGTLink':
+      # Frames are taken from the OpenIGTLink receiver, the first one sets the base images (see onReceivedFrameTimer)
+      self.isBaseFrameReceived = False
+      self.logic.startReceiver(self.igtlHostLineEdit.text, int(self.igtlPortSpinBox.value), self.igtlFirstDeviceLineEdit.text or self.firstVolume.GetName(),
+                               self.igtlSecondDeviceLineEdit.text or self.secondVolume.GetName())
+      self.receivedFrameTimer.start()
+      return
     # Set base images
-    self.logic.updateBaseImages(self.firstVolume, self.secondVolume, self.inputMode, self.maskThreshold, self.maskClosing, self.debugFlag)
+    if self.trackingMode == 'Sync':
+      self.logic.updateBaseImages(self.firstVolume, self.secondVolume, self.trackingParameters)
+    else:
+      self.logic.startWorker(self.firstVolume, self.secondVolume, self.workerParameters, self.trackingMode)
+      self.workerResultsTimer.start()
     # Create listener to sequence node
     self.addObserver(self.secondVolume, self.secondVolume.ImageDataModifiedEvent, self.receivedImage)
   
@@ -418,16 +1128,72 @@ class SimpleNeedleTrackingWidget(ScriptedLoadableModuleWidget, VTKObservationMix
     self.updateButtons()
     #TODO: Should something else be refreshed/updated?
     print('UI: stopTracking()')
-    self.removeObserver(self.secondVolume, self.secondVolume.ImageDataModifiedEvent, self.receivedImage)
+    if self.robotPose is not None:
+      self.removeObserver(self.robotPose, slicer.vtkMRMLTransformNode.TransformModifiedEvent, self.onRobotPoseModified)
+      self.logic.stopRobotCoupling()
+    if self.imageSource == 'OpenIGTLink':
+      self.receivedFrameTimer.stop()
+      self.logic.stopReceiver()
+    else:
+      self.removeObserver(self.secondVolume, self.secondVolume.ImageDataModifiedEvent, self.receivedImage)
+    if self.trackingMode != 'Sync':
+      self.workerResultsTimer.stop()
+      self.logic.stopWorker()
+      self.onWorkerResultsTimer()
+    self.logic.stopDebugWriter()
+    self.healthTimer.stop()
+    self.updateHealthTable()
+    print(self.logic.trackingStatistics.formatStatistics())
   
   def receivedImage(self, caller=None, event=None):
     if self.isTrackingOn:
       print('UI: receivedImage()')
+      if self.trackingMode != 'Sync':
+        # Snapshot frame and hand it to the background worker
+        self.logic.submitFrame(self.firstVolume, self.secondVolume, self.tipPredictions)
+        return
       # Execute one tracking cycle
-      if self.logic.getNeedle(self.firstVolume, self.secondVolume, self.sliceIndex, self.tipPrediction, self.inputMode, self.roiSize, self.blobThreshold, self.errorThreshold, self.debugFlag):
-        print('Tracking successful')
+      results = self.logic.getNeedles(self.firstVolume, self.secondVolume, self.sliceIndex, self.tipPredictions, self.trackingParameters)
+      self.printResults(results)
+
+  # Robot pose node modified (pose received from the robot)
+  def onRobotPoseModified(self, caller=None, event=None):
+    if self.isTrackingOn:
+      self.logic.updateRobotPose(self.robotPose)
+
+  # Track the latest frame received from OpenIGTLink (the first frame sets the base images)
+  def onReceivedFrameTimer(self):
+    frame = self.logic.takeReceivedFrame()
+    if (frame is None) or (not self.isTrackingOn):
+      return
+    if not self.isBaseFrameReceived:
+      print('UI: base frame received')
+      self.isBaseFrameReceived = True
+      if self.trackingMode == 'Sync':
+        self.logic.setBaseFrame(frame, self.trackingParameters)
+      else:
+        self.logic.startWorkerFromFrame(frame, self.workerParameters, self.trackingMode)
+        self.workerResultsTimer.start()
+      return
+    if self.trackingMode != 'Sync':
+      self.logic.submitReceivedFrame(frame, self.tipPredictions)
+      return
+    results = self.logic.getNeedlesFromArrays(frame.firstArray, frame.secondArray, frame.geometry, frame.timestamp, frame.stageTimes['pull'], self.tipPredictions,
+                                              self.trackingParameters)
+    self.printResults(results)
+
+  # Apply results of the background tracking worker to the tracked tip nodes
+  def onWorkerResultsTimer(self):
+    for results in self.logic.applyWorkerResults(self.tipPredictions):
+      self.printResults(results)
+
+  # Print result of each needle (failure reason if tracking failed)
+  def printResults(self, results):
+    for (needle, result) in enumerate(results):
+      if result.success:
+        print('Needle %d: Tracking successful' %(needle+1))
       else:
-        print('Tracking failed')
+        print('Needle %d: Tracking failed: %s' %(needle+1, result.reason))
       
     
 ################################################################################################################################################
@@ -440,18 +1206,14 @@ class SimpleNeedleTrackingLogic(ScriptedLoadableModuleLogic):
     ScriptedLoadableModuleLogic.__init__(self)
     self.cliParamNode = None
     print('Logic: __init__')
-    
-    # Phase rescaling filter
-    self.phaseRescaleFilter = sitk.RescaleIntensityImageFilter()
-    self.phaseRescaleFilter.SetOutputMaximum(2*np.pi)
-    self.phaseRescaleFilter.SetOutputMinimum(0)
-    
-    # ROI filter
-    self.roiFilter = sitk.RegionOfInterestImageFilter()
 
-    # Image file writer
+    # Slicer-free tracking engine (this class only transfers data from/to the MRML scene)
+    self.engine = NeedleTrackingEngine()
+    self.engine.debugCallback = self.pushDebugImage
+
+    # Background writer of the debug images
     self.path = os.path.join(os.path.dirname(os.path.abspath(__file__)),'Debug')
-    self.fileWriter = sitk.ImageFileWriter()
+    self.debugWriter = DebugImageWriter(self.path)
 
     # Check if tracked tip node exists, if not, create a new one
     try:
@@ -461,12 +1223,31 @@ class SimpleNeedleTrackingLogic(ScriptedLoadableModuleLogic):
         slicer.mrmlScene.AddNode(self.tipTrackedNode)
         self.tipTrackedNode.SetName('CurrentTrackedTipTransform')
         print('Created Tracked Tip TransformNode')
+    # Tracked tip nodes of all needles (CurrentTrackedTipTransform, CurrentTrackedTipTransform_2, ...)
+    self.tipTrackedNodes = [self.tipTrackedNode]
+
+    # Background tracking worker (asynchronous tracking modes)
+    self.worker = None
 
-    # Base ITK images
-    self.sitk_base_m = None
-    self.sitk_base_p = None
-    self.sitk_mask = None
-    self.count = None
+    # OpenIGTLink image receiver (OpenIGTLink image source)
+    self.receiver = None
+
+    # Rolling per-stage latency statistics (opt-in)
+    self.profiler = StageProfiler()
+
+    # Results of all tracked frames (one record per frame and needle)
+    self.tipHistory = TipHistory()
+
+    # Health counters of the tracking session (frames received/processed/dropped, failures per reason)
+    self.trackingStatistics = TrackingStatistics()
+    self.receiverDroppedFrames = 0  # Frames dropped by the OpenIGTLink receiver already counted
+
+    # Tip prediction of the first needle from the robot pose (None: tip prediction nodes only)
+    self.robotPrior = None
+    self.robotSkipMargin = None
+
+    # Float32 conversion buffers of non-float volumes (per node ID)
+    self.volumeBuffers = {}
     
   # Initialize parameter node with default settings
   def setDefaultParameters(self, parameterNode):
@@ -482,6 +1263,64 @@ class SimpleNeedleTrackingLogic(ScriptedLoadableModuleLogic):
         parameterNode.SetParameter('ErrorThreshold', '15.0')   
     if not parameterNode.GetParameter('Debug'):
         parameterNode.SetParameter('Debug', 'False')   
+    if not parameterNode.GetParameter('DebugInterval'):
+        parameterNode.SetParameter('DebugInterval', '1')   
+    if not parameterNode.GetParameter('DebugCompression'):
+        parameterNode.SetParameter('DebugCompression', 'False')   
+    if not parameterNode.GetParameter('ROIUnwrap'):
+        parameterNode.SetParameter('ROIUnwrap', 'False')   
+    if not parameterNode.GetParameter('ROIMargin'):
+        parameterNode.SetParameter('ROIMargin', '10')   
+    if not parameterNode.GetParameter('ROIMode'):
+        parameterNode.SetParameter('ROIMode', 'Fixed')   
+    if not parameterNode.GetParameter('ROIMinimum'):
+        parameterNode.SetParameter('ROIMinimum', '11')   
+    if not parameterNode.GetParameter('ROIMaximum'):
+        parameterNode.SetParameter('ROIMaximum', '45')   
+    if not parameterNode.GetParameter('PhaseDifferenceMode'):
+        parameterNode.SetParameter('PhaseDifferenceMode', 'Unwrap')   
+    if not parameterNode.GetParameter('UnwrapMode'):
+        parameterNode.SetParameter('UnwrapMode', '3D')   
+    if not parameterNode.GetParameter('UnwrapWorkers'):
+        parameterNode.SetParameter('UnwrapWorkers', '1')   
+    if not parameterNode.GetParameter('UnwrapPool'):
+        parameterNode.SetParameter('UnwrapPool', 'Thread')   
+    if not parameterNode.GetParameter('UnwrapDifference'):
+        parameterNode.SetParameter('UnwrapDifference', 'False')   
+    if not parameterNode.GetParameter('PredictionMode'):
+        parameterNode.SetParameter('PredictionMode', 'Fixed')   
+    if not parameterNode.GetParameter('MahalanobisGate'):
+        parameterNode.SetParameter('MahalanobisGate', '3.4')   
+    if not parameterNode.GetParameter('BaselineMode'):
+        parameterNode.SetParameter('BaselineMode', 'Fixed')   
+    if not parameterNode.GetParameter('BaselineWeight'):
+        parameterNode.SetParameter('BaselineWeight', '0.05')   
+    if not parameterNode.GetParameter('BaselineExclusion'):
+        parameterNode.SetParameter('BaselineExclusion', '20')   
+    if not parameterNode.GetParameter('BaselineInterval'):
+        parameterNode.SetParameter('BaselineInterval', '1')   
+    if not parameterNode.GetParameter('SmoothingMode'):
+        parameterNode.SetParameter('SmoothingMode', 'None')   
+    if not parameterNode.GetParameter('SmoothingWindow'):
+        parameterNode.SetParameter('SmoothingWindow', '5')   
+    if not parameterNode.GetParameter('OutlierDistance'):
+        parameterNode.SetParameter('OutlierDistance', '10')   
+    if not parameterNode.GetParameter('InsertionDepth'):
+        parameterNode.SetParameter('InsertionDepth', '0')   
+    if not parameterNode.GetParameter('RobotPoseTimeout'):
+        parameterNode.SetParameter('RobotPoseTimeout', '2')   
+    if not parameterNode.GetParameter('RobotSkipFrames'):
+        parameterNode.SetParameter('RobotSkipFrames', 'True')   
+    if not parameterNode.GetParameter('TrackingMode'):
+        parameterNode.SetParameter('TrackingMode', 'Sync')   
+    if not parameterNode.GetParameter('ImageSource'):
+        parameterNode.SetParameter('ImageSource', 'Scene')   
+    if not parameterNode.GetParameter('IGTLHost'):
+        parameterNode.SetParameter('IGTLHost', 'localhost')   
+    if not parameterNode.GetParameter('IGTLPort'):
+        parameterNode.SetParameter('IGTLPort', '18944')   
+    if not parameterNode.GetParameter('Profiling'):
+        parameterNode.SetParameter('Profiling', 'False')   
           
   # Create Slicer node and push ITK image to it
   def pushitkToSlicer(self, sitkImage, name, debugFlag=False):
@@ -493,280 +1332,358 @@ class SimpleNeedleTrackingLogic(ScriptedLoadableModuleLogic):
       node.SetName(name)
     sitkUtils.PushVolumeToSlicer(sitkImage, node)
     if (debugFlag==True):
-      self.fileWriter.Execute(sitkImage, os.path.join(self.path, name)+'.nrrd', False, 0)
+      # Written in the background as <name>_<frame>.nrrd (frame 0: base images)
+      self.debugWriter.put(sitkImage, name, self.engine.count)
 
-  # Return sitk Image from numpy array
-  def numpyToitk(self, array, sitkReference, type=None):
-    image = sitk.GetImageFromArray(array, isVector=False)
-    if (type is None):
-      image = sitk.Cast(image, sitkReference.GetPixelID())
-    else:
-      image = sitk.Cast(image, type)
-    image.CopyInformation(sitkReference)
-    return image
-  
-  # Return blank itk Image with same information from reference volume
-  def createBlankItk(self, sitkReference, type=None):
-    if (type is None):
-      image = sitk.Image(sitkReference.GetSize(), sitkReference.GetPixelID())
-    else:
-      image = sitk.Image(sitkReference.GetSize(), type)  
-    image.CopyInformation(sitkReference)
-    return image
-
-  # Unwrap phase images with implementation from scikit-image (module: restoration)
-  def unwrap_phase_array(self, array_p, array_mask):
-    array_p_masked = np.ma.array(array_p, mask=np.logical_not(array_mask).astype(int))  # Mask phase image (inverted mask)
-    if array_p.shape[0] == 1: # 2D image in a 3D array: make it 2D array for improved performance
-        array_p_unwraped = np.ma.copy(array_p_masked)  # Initialize unwraped array as the original
-        array_p_unwraped[0,:,:] = unwrap_phase(array_p_masked[0,:,:], wrap_around=(False,False))               
-    else:
-        array_p_unwraped = unwrap_phase(array_p_masked, wrap_around=(False,False,False))   
-    return array_p_unwraped
-  
-  def realImagToMagPhase(self, realVolume, imagVolume):
-    # Pull the real/imaginary volumes from the MRML scene and convert them to magnitude/phase volumes
-    sitk_real = sitkUtils.PullVolumeFromSlicer(realVolume)
-    sitk_imag = sitkUtils.PullVolumeFromSlicer(imagVolume)
-    numpy_real = sitk.GetArrayFromImage(sitk_real)
-    numpy_imag = sitk.GetArrayFromImage(sitk_imag)
-    numpy_comp = numpy_real + 1.0j * numpy_imag
-    numpy_magn = np.absolute(numpy_comp)
-    numpy_phase = np.angle(numpy_comp)
-    sitk_magn = self.numpyToitk(numpy_magn, sitk_real)
-    sitk_phase = self.numpyToitk(numpy_phase, sitk_real)
-    return (sitk_magn, sitk_phase)
-
-
-  # Update the stored base images
-  def updateBaseImages(self, firstVolume, secondVolume, inputMode, maskThreshold, maskClosing, debugFlag=False):
-    # Initialize sequence counter
-    self.count = 0
-    # Get itk images from MRML volume nodes 
-    if (inputMode == 'RealImag'): # Convert to magnitude/phase
-      (self.sitk_base_m, self.sitk_base_p) = self.realImagToMagPhase(firstVolume, secondVolume)
-    else:                         # Already as magnitude/phase
-      self.sitk_base_m = sitkUtils.PullVolumeFromSlicer(firstVolume)
-      self.sitk_base_p = sitkUtils.PullVolumeFromSlicer(secondVolume)
-    # Force 32Float
-    self.sitk_base_m = sitk.Cast(self.sitk_base_m, sitk.sitkFloat32)
-    self.sitk_base_p = sitk.Cast(self.sitk_base_p, sitk.sitkFloat32)
-    # Phase scaling to angle interval [0 to 2*pi]
-    self.sitk_base_p = self.phaseRescaleFilter.Execute(self.sitk_base_p)
-    # Get base mask: Generate bool mask from magnitude image to remove background
-    self.sitk_mask = (self.sitk_base_m > maskThreshold)
-    closingFilter = sitk.BinaryMorphologicalClosingImageFilter()    # Closing to fill bigger holes
-    closingFilter.SetKernelRadius(maskClosing)
-    self.sitk_mask = closingFilter.Execute(self.sitk_mask)  
-    # Unwrapped base phase
-    numpy_base_p = sitk.GetArrayFromImage(self.sitk_base_p)
-    numpy_mask = sitk.GetArrayFromImage(self.sitk_mask)
-    self.numpy_base_unwraped_p = self.unwrap_phase_array(numpy_base_p, numpy_mask)# REscale MARIANA
-    # Push debug images to Slicer
-    if debugFlag:
-      self.pushitkToSlicer(self.sitk_base_m, 'debug_base_m', debugFlag)
-      self.pushitkToSlicer(self.sitk_base_p, 'debug_base_p', debugFlag)
-      self.pushitkToSlicer(self.sitk_mask, 'debug_mask', debugFlag)
-      sitk_base_unwraped_p = self.numpyToitk(self.numpy_base_unwraped_p, self.sitk_base_p)
-      self.pushitkToSlicer(sitk_base_unwraped_p, 'debug_base_unwraped_p', debugFlag)
-  
-  
-  def getNeedle(self, firstVolume, secondVolume, sliceIndex, tipPrediction, inputMode, roiSize, blobThreshold, errorThreshold, debugFlag=False):
-    print('Logic: getNeedle()')    
-    if (self.sitk_base_m is None) or (self.sitk_base_p is None):
-      print('ERROR: Mag/Phase base images were not initialized')    
-      return False
-    # Increment sequence counter
-    self.count += 1    
-    # Get itk images from MRML volume nodes 
-    if (inputMode == 'RealImag'): # Convert to magnitude/phase
-      (sitk_img_m, sitk_img_p) = self.realImagToMagPhase(firstVolume, secondVolume)
-    else:                         # Already as magnitude/phase
-      sitk_img_m = sitkUtils.PullVolumeFromSlicer(firstVolume)
-      sitk_img_p = sitkUtils.PullVolumeFromSlicer(secondVolume)
-    # Force 32Float
-    sitk_img_m = sitk.Cast(sitk_img_m, sitk.sitkFloat32)
-    sitk_img_p = sitk.Cast(sitk_img_p, sitk.sitkFloat32)
-    numpy_mask = sitk.GetArrayFromImage(self.sitk_mask)
-    # Phase scaling to angle interval [0 to 2*pi]
-    sitk_img_p = self.phaseRescaleFilter.Execute(sitk_img_p) # Rescale MARIANA
-    # Push debug images to Slicer     
-    if debugFlag:
-      self.pushitkToSlicer(sitk_img_m, 'debug_img_m', debugFlag)
-      self.pushitkToSlicer(sitk_img_p, 'debug_img_p', debugFlag)
-
-    ######################################
-    ##                                  ##
-    ## Step 1: Unwrap phase image       ##
-    ##                                  ##
-    ######################################
-
-    # Unwrapped img phase
-    numpy_img_p = sitk.GetArrayFromImage(sitk_img_p)
-    numpy_mask = sitk.GetArrayFromImage(self.sitk_mask)
-    numpy_img_unwraped_p = self.unwrap_phase_array(numpy_img_p, numpy_mask)
-
-    # Plot
-    if debugFlag:
-      sitk_img_unwraped_p = self.numpyToitk(numpy_img_unwraped_p, self.sitk_base_p)
-      self.pushitkToSlicer(sitk_img_unwraped_p, 'debug_img_unwraped_p', debugFlag)
-
-    ######################################
-    ##                                  ##
-    ## Step 2: Get phase difference     ##
-    ##                                  ##
-    ######################################
-
-    # Get phase difference
-    numpy_diff_p = numpy_img_unwraped_p - self.numpy_base_unwraped_p
-
-    # Set background to mean phase value
-    numpy_diff_p = numpy_diff_p.filled(numpy_diff_p.mean())
-    sitk_diff_p = self.numpyToitk(numpy_diff_p, sitk_img_p)
-    sitk_diff_p = self.phaseRescaleFilter.Execute(sitk_diff_p)
-
-    # Plot
-    if debugFlag:
-      self.pushitkToSlicer(sitk_diff_p, 'debug_phase_diff', debugFlag)
-    
-    ######################################
-    ##                                  ##
-    ## Step 3: Select ROI               ##
-    ##                                  ##
-    ######################################
-    
-    # Get tip predicted coordinates: 3D Slicer (RAS)
+  # Debug callback of the tracking engine
+  def pushDebugImage(self, sitkImage, name):
+    self.pushitkToSlicer(sitkImage, name, True)
+
+  # Start writing debug images of every frameInterval-th frame to the Debug directory
+  def startDebugWriter(self, frameInterval=1, compression=False):
+    self.debugWriter.frameInterval = max(int(frameInterval), 1)
+    self.debugWriter.compression = compression
+    self.debugWriter.start()
+
+  # Write the remaining debug images and stop the debug writer
+  def stopDebugWriter(self):
+    if self.debugWriter.isRunning():
+      self.debugWriter.stop()
+      print(self.debugWriter.formatStatistics())
+
+  # Hand the debug images of the frame to the debug writer
+  def endDebugFrame(self):
+    dropped = self.debugWriter.endFrame()
+    if dropped:
+      print('WARNING: Debug writer queue full: %d images dropped (%d in total)' %(dropped, self.debugWriter.droppedImages))
+
+  # Return geometry of a volume node in ITK convention (LPS) from its IJKToRAS matrix
+  def getVolumeGeometry(self, volume):
+    directionMatrix = vtk.vtkMatrix4x4()
+    volume.GetIJKToRASDirectionMatrix(directionMatrix)
+    rasToLPS = (-1.0, -1.0, 1.0)
+    direction = [rasToLPS[row]*directionMatrix.GetElement(row, column) for row in range(3) for column in range(3)]
+    origin = volume.GetOrigin()
+    return ImageGeometry(volume.GetSpacing(), (-origin[0], -origin[1], origin[2]), direction)
+
+  # Return float32 voxel array of a volume node and its geometry without going through an ITK image
+  # Float32 volumes are returned as views of the node's image data (no copy), other scalar types are converted into a
+  # buffer cached per node and updated in place. The array is only valid until the next image update and must not be modified.
+  def pullVolumeArray(self, volume):
+    array = slicer.util.arrayFromVolume(volume)
+    if array.dtype != np.float32:
+      buffer = self.volumeBuffers.get(volume.GetID())
+      if (buffer is None) or (buffer.shape != array.shape):
+        buffer = np.empty(array.shape, dtype=np.float32)
+        self.volumeBuffers[volume.GetID()] = buffer
+      np.copyto(buffer, array, casting='unsafe')
+      array = buffer
+    return (array, self.getVolumeGeometry(volume))
+
+  # Return tip prediction point in 3D Slicer coordinates (RAS)
+  def getTipPredictionRAS(self, tipPrediction):
     transformMatrix = vtk.vtkMatrix4x4()
     tipPrediction.GetMatrixTransformToWorld(transformMatrix)
-    tipHorizontal = transformMatrix.GetElement(0,3) # Right-Left
-    tipSlice = transformMatrix.GetElement(1,3)      # Anterior-Posteriot
-    tipVertical = transformMatrix.GetElement(2,3)   # Inferior-Superior
-    tipRAS = (tipHorizontal, tipSlice, tipVertical)
-
-    # Convert to pixel coordinates in ITK (LPS)
-    tipIndex = sitk_img_p.TransformPhysicalPointToIndex((-tipHorizontal, -tipSlice, tipVertical))
-    sliceDepth = sitk_img_p.GetDepth()
-    
-    # Define ROI filter size/index (pixels)
-    self.roiFilter.SetSize((roiSize,roiSize,sliceDepth))
-    roiIndex = (round(tipIndex[0]-0.5*roiSize), round(tipIndex[1]-0.5*roiSize), 0)
-    self.roiFilter.SetIndex(roiIndex)
+    return (transformMatrix.GetElement(0,3), transformMatrix.GetElement(1,3), transformMatrix.GetElement(2,3))
 
-    try:
-      sitk_roi = self.roiFilter.Execute(sitk_diff_p)
-    except:
-      print('Invalid ROI')
-      return False
-    sitk_roi = self.phaseRescaleFilter.Execute(sitk_roi)
-    # Plot
-    if debugFlag:
-      self.pushitkToSlicer(sitk_roi, 'debug_roi', debugFlag)    
-    
-    ####################################
-    ##                                ##
-    ## Step 4: Image gradient         ##
-    ##                                ##
-    ####################################
-    
-    # 3D Gradient Filter only works with >=4 slices
-    # Perform 2D gradient in each slice instead
-    # TODO: Maybe there is another function for this?
-    sitk_phaseGradientVolume = self.createBlankItk(sitk_roi, type=sitk.sitkFloat32)
-    gradientFilter = sitk.GradientMagnitudeRecursiveGaussianImageFilter()
-    for slice in range(sliceDepth):
-      sitk_phaseGradient = gradientFilter.Execute(sitk_roi[:,:,slice])
-      sitk_phaseGradientVolume[:,:,slice] = sitk_phaseGradient # Put slice in the volume
-    sitk_phaseGradientVolume = self.phaseRescaleFilter.Execute(sitk_phaseGradientVolume)
-    # Plot
-    if debugFlag:
-      self.pushitkToSlicer(sitk_phaseGradientVolume, 'debug_phase_gradient', debugFlag)    
-
-    # Get gradient mean intensity value
-    imgStats = sitk.StatisticsImageFilter()
-    imgStats.Execute(sitk_phaseGradientVolume)
-    meanValue = imgStats.GetMean()
-    if debugFlag:
-      print('Gradient mean intensity = %s' %(meanValue))
-    # If intensity is high, we probably have only noise
-    if meanValue >= 1.2:
-      print('Probably empty phase diff, gradient mostly noise')
-      return False      
+  # Return tip prediction points (RAS) of the tip prediction nodes, the first one from the robot pose (or the last detection
+  # while the pose is stale) when the robot is coupled
+  def getTipPredictionsRAS(self, tipPredictions):
+    tipRASs = [self.getTipPredictionRAS(tipPrediction) for tipPrediction in tipPredictions]
+    if (self.robotPrior is not None) and tipRASs:
+      previousSource = self.robotPrior.source
+      (tipRAS, source) = self.robotPrior.getTipPrediction()
+      if source != previousSource:
+        print('Robot coupling: tip prediction from %s' %(source or 'tip prediction node'))
+      if tipRAS is not None:
+        tipRASs[0] = tipRAS
+    return tipRASs
 
-    ####################################
-    ##                                ##
-    ## Step 5: Blob detection         ##
-    ##                                ##
-    ####################################
+  # Start predicting the tip of the first needle from the robot pose node
+  # insertionDepth: commanded insertion depth (mm) along the needle axis, maximumAge: time (s) after which the pose is stale,
+  # skipMargin: frames are skipped while the robot tip lies more than skipMargin (mm) outside the image (None: no skipping)
+  def startRobotCoupling(self, poseNode, insertionDepth, maximumAge, skipMargin=None):
+    self.robotPrior = RobotTipPrior(insertionDepth, maximumAge)
+    self.robotSkipMargin = skipMargin
+    # The current pose may be old: it is used once the robot updates it
+    self.updateRobotPose(poseNode, stale=True)
 
-    # Threshold roi to create blobs
-    sitk_blobs = (sitk_phaseGradientVolume > blobThreshold)
-    # Plot
-    if debugFlag:
-      self.pushitkToSlicer(sitk_blobs, 'debug_blobs', debugFlag)  
-          
-    # Label blobs
-    stats = sitk.LabelShapeStatisticsImageFilter()
-    stats.Execute(sitk.ConnectedComponent(sitk_blobs))
-    num_blobs = stats.GetNumberOfLabels()
-
-    # Check number of blobs found      
-    if num_blobs == 0:
-      print('No centroids found')
-      return False
-    # Select center of tip blob
-    elif num_blobs == 1:
-      center = stats.GetCentroid(1)
-      if debugFlag:
-        print('Label %s: -> Size: %s, Center: %s, Flatness: %s, Elongation: %s' %(1, stats.GetNumberOfPixels(1), stats.GetCentroid(1), stats.GetFlatness(1), stats.GetElongation(1)))
-    else:               # More than one - find most likely tip
-      # Get blobs sizes, insertion depth and centroid physical coordinates
-      labels_size = []
-      labels_centroid = []
-      labels_depth = []
-      for l in stats.GetLabels():
-          if (stats.GetElongation(l) < 4): 
-              labels_size.append(stats.GetNumberOfPixels(l))
-              labels_centroid.append(stats.GetCentroid(l))    
-              labels_depth.append(stats.GetCentroid(l)[2])
-          if debugFlag:
-              print('Label %s: -> Size: %s, Center: %s, Flatness: %s, Elongation: %s' %(l, stats.GetNumberOfPixels(l), stats.GetCentroid(l), stats.GetFlatness(l), stats.GetElongation(l)))
-      # Find two largest blobs
-      sorted_by_size = np.argsort(labels_size) 
-      first_largest_index = sorted_by_size[-1]
-      second_largest_index = sorted_by_size[-2]
-      if(labels_size[second_largest_index]/labels_size[first_largest_index] >= 0.15): # Check if both blobs are comparable size
-        biggest_depth = max([labels_depth[first_largest_index], labels_depth[second_largest_index]])
-        label_index = labels_depth.index(biggest_depth)       # Get deepest inserted from the two
-      else:
-        label_index = first_largest_index                     # Get significantly largest
-      # Get selected centroid center
-      center = labels_centroid[label_index]
-      if debugFlag:
-        print('Chosen label: %i' %(label_index+1))
+  # Stop predicting the tip from the robot pose
+  def stopRobotCoupling(self):
+    if self.robotPrior is not None:
+      print('Robot coupling: %d frames skipped (robot tip outside the image)' %(self.robotPrior.skippedFrames))
+      self.robotPrior = None
 
+  # Update the robot pose from the pose node (stale: pose of unknown age)
+  def updateRobotPose(self, poseNode, stale=False):
+    if self.robotPrior is None:
+      return
+    transformMatrix = vtk.vtkMatrix4x4()
+    poseNode.GetMatrixTransformToWorld(transformMatrix)
+    self.robotPrior.setPose([[transformMatrix.GetElement(row, column) for column in range(4)] for row in range(4)], stale=stale)
 
-    ####################################
-    ##                                ##
-    ## Step 6: Get tip physical point ##
-    ##                                ##
-    ####################################
-    
-    # Convert to 3D Slicer coordinates (RAS)
-    centerRAS = (-center[0], -center[1], center[2])
-    if debugFlag:
-      print(centerRAS)
-
-    # Calculate prediction error
-    predError = sqrt(pow((tipRAS[0]-centerRAS[0]),2)+pow((tipRAS[1]-centerRAS[1]),2)+pow((tipRAS[2]-centerRAS[2]),2))
-    # Check error threshold
-    if(predError>errorThreshold):
-      print('Tip too far from prediction')
+  # Return True if the frame is not tracked: the robot tip prediction (fresh pose) lies outside the image
+  # shape: array shape [slice, row, column] of the frame
+  def isFrameSkipped(self, tipRASs, geometry, shape):
+    if (self.robotPrior is None) or (self.robotSkipMargin is None) or (self.robotPrior.source != RobotTipPrior.SOURCE_ROBOT):
       return False
-    
-    # Push coordinates to tip Node
-    transformMatrix.SetElement(0,3, centerRAS[0])
-    transformMatrix.SetElement(1,3, centerRAS[1])
-    transformMatrix.SetElement(2,3, centerRAS[2])
-    self.tipTrackedNode.SetMatrixTransformToParent(transformMatrix)
-
+    if RobotTipPrior.isInsideImage(tipRASs[0], geometry, shape, self.robotSkipMargin):
+      return False
+    self.robotPrior.skippedFrames += 1
+    self.trackingStatistics.addSkippedFrames()
+    print(FAILURE_FRAME_SKIPPED)
     return True
+
+  # Keep the tracked tip of the first needle as fallback tip prediction of the robot coupling
+  def updateRobotDetection(self, results):
+    if (self.robotPrior is not None) and results[0].success:
+      self.robotPrior.setDetection(results[0].tip)
+
+  # Return tracked tip node of the needle (CurrentTrackedTipTransform_<needle+1> for the second needle on), create it if needed
+  def getTrackedTipNode(self, needle):
+    while len(self.tipTrackedNodes) <= needle:
+      name = 'CurrentTrackedTipTransform_%d' %(len(self.tipTrackedNodes)+1)
+      try:
+        node = slicer.util.getNode(name)
+      except:
+        node = slicer.vtkMRMLLinearTransformNode()
+        slicer.mrmlScene.AddNode(node)
+        node.SetName(name)
+        print('Created Tracked Tip TransformNode %s' %(name))
+      self.tipTrackedNodes.append(node)
+    return self.tipTrackedNodes[needle]
+
+  # Push tip coordinates to tracked tip node of the needle (orientation taken from the tip prediction node, if any)
+  def setTrackedTip(self, tipRAS, tipPrediction=None, needle=0):
+    tipTrackedNode = self.getTrackedTipNode(needle)
+    transformMatrix = vtk.vtkMatrix4x4()
+    if tipPrediction is not None:
+      tipPrediction.GetMatrixTransformToWorld(transformMatrix)
+    else:
+      tipTrackedNode.GetMatrixTransformToParent(transformMatrix)
+    transformMatrix.SetElement(0,3, tipRAS[0])
+    transformMatrix.SetElement(1,3, tipRAS[1])
+    transformMatrix.SetElement(2,3, tipRAS[2])
+    tipTrackedNode.SetMatrixTransformToParent(transformMatrix)
+
+  # Copy current volume data into a frame that can be processed outside the main thread
+  # tipPredictions: tip prediction nodes of all tracked needles
+  def snapshotFrame(self, firstVolume, secondVolume, tipPredictions=None):
+    pullStart = time.perf_counter()
+    (firstArray, geometry) = self.pullVolumeArray(firstVolume)
+    (secondArray, _) = self.pullVolumeArray(secondVolume)
+    tipRASs = self.getTipPredictionsRAS(tipPredictions) if tipPredictions else None
+    # Pulled arrays are views/shared buffers: the frame gets its own copy
+    frame = TrackingFrame(firstArray.copy(), secondArray.copy(), geometry, tipRASs[0] if tipRASs else None, time.time(), tipRASs)
+    frame.stageTimes['pull'] = time.perf_counter() - pullStart
+    return frame
+
+  # Enable/disable collection of per-stage latency statistics
+  def setProfilingEnabled(self, enabled):
+    self.profiler.setEnabled(enabled)
+
+  # Return rolling latency statistics {stage: {'count', 'mean', 'p50', 'p95', 'p99'}} (ms)
+  def getStageStatistics(self):
+    return self.profiler.getStatistics()
+
+  # Clear latency statistics
+  def resetStageStatistics(self):
+    self.profiler.reset()
+
+  # Save the tip history as .npy or .csv file (by extension), return number of records
+  def exportTipHistory(self, path):
+    directory = os.path.dirname(path)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    self.tipHistory.export(path)
+    return len(self.tipHistory)
+
+  # Remove all records of the tip history
+  def clearTipHistory(self):
+    self.tipHistory.clear()
+
+  # Clear the health counters (start of a tracking session)
+  def resetTrackingStatistics(self):
+    self.trackingStatistics.reset()
+
+  # Return health counters of the tracking session (see TrackingStatistics.getStatistics)
+  def getTrackingStatistics(self):
+    self.updateReceiverDroppedFrames()
+    return self.trackingStatistics.getStatistics()
+
+  # Save the health counters as .json or .csv file (by extension)
+  def exportTrackingStatistics(self, path):
+    directory = os.path.dirname(path)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    self.updateReceiverDroppedFrames()
+    self.trackingStatistics.export(path)
+
+  # Start background tracking worker ('Thread' or 'Process') with the current volumes as base images
+  def startWorker(self, firstVolume, secondVolume, parameters, mode):
+    self.startWorkerFromFrame(self.snapshotFrame(firstVolume, secondVolume), parameters, mode)
+
+  # Start background tracking worker ('Thread' or 'Process') with a frame as base images
+  def startWorkerFromFrame(self, baseFrame, parameters, mode):
+    self.stopWorker()
+    self.worker = TrackingWorker(mode)
+    self.worker.start(self.copyFrame(baseFrame), parameters)
+
+  # Stop background tracking worker
+  def stopWorker(self):
+    if self.worker is not None:
+      self.worker.stop()
+
+  # Hand the current frame to the background worker (a pending older frame is dropped)
+  # tipPredictions: tip prediction nodes of all tracked needles
+  def submitFrame(self, firstVolume, secondVolume, tipPredictions):
+    if (self.worker is None) or (not self.worker.isRunning()):
+      print('ERROR: Tracking worker is not running')
+      return
+    self.trackingStatistics.addReceivedFrames()
+    frame = self.snapshotFrame(firstVolume, secondVolume, tipPredictions)
+    if self.isFrameSkipped(frame.getTipPredictions(), frame.geometry, frame.firstArray.shape):
+      return
+    if self.worker.submit(frame):
+      self.trackingStatistics.addDroppedFrames()
+      print('Tracking worker busy: dropped pending frame')
+
+  # Hand a frame taken from the OpenIGTLink receiver to the background worker (a pending older frame is dropped)
+  def submitReceivedFrame(self, frame, tipPredictions):
+    if (self.worker is None) or (not self.worker.isRunning()):
+      print('ERROR: Tracking worker is not running')
+      return
+    self.trackingStatistics.addReceivedFrames()
+    frame = self.copyFrame(frame, tipPredictions)
+    if self.isFrameSkipped(frame.getTipPredictions(), frame.geometry, frame.firstArray.shape):
+      return
+    if self.worker.submit(frame):
+      self.trackingStatistics.addDroppedFrames()
+      print('Tracking worker busy: dropped pending frame')
+
+  # Return a copy of a frame that owns its arrays (frames of the receiver are overwritten once released)
+  # tipPredictions: tip prediction nodes of all tracked needles
+  def copyFrame(self, frame, tipPredictions=None):
+    tipRASs = self.getTipPredictionsRAS(tipPredictions) if tipPredictions else None
+    copy = TrackingFrame(frame.firstArray.copy(), frame.secondArray.copy(), frame.geometry, tipRASs[0] if tipRASs else None, frame.timestamp, tipRASs)
+    copy.stageTimes.update(frame.stageTimes)
+    return copy
+
+  # Start receiving first/second images as OpenIGTLink IMAGE messages from host:port
+  def startReceiver(self, host, port, firstDeviceName, secondDeviceName):
+    self.stopReceiver()
+    self.receiver = IGTLImageReceiver(host, port, firstDeviceName, secondDeviceName)
+    self.receiverDroppedFrames = 0
+    self.receiver.start()
+
+  # Stop the OpenIGTLink receiver
+  def stopReceiver(self):
+    if self.receiver is not None:
+      self.receiver.stop()
+      self.updateReceiverDroppedFrames()
+      print(self.receiver.formatStatistics())
+      self.receiver = None
+
+  # Return frame of the latest received image pair (None if there is none), valid until the next call
+  def takeReceivedFrame(self):
+    if self.receiver is None:
+      return None
+    frame = self.receiver.takeFrame()
+    if frame is not None:
+      self.updateReceiverDroppedFrames()
+    return frame
+
+  # Count the frames the OpenIGTLink receiver dropped (replaced before they were taken) since the last call as received and dropped
+  def updateReceiverDroppedFrames(self):
+    if self.receiver is None:
+      return
+    dropped = self.receiver.getStatistics()['dropped'] - self.receiverDroppedFrames
+    if dropped > 0:
+      self.receiverDroppedFrames += dropped
+      self.trackingStatistics.addReceivedFrames(dropped)
+      self.trackingStatistics.addDroppedFrames(dropped)
+
+  # Push results of the background worker to the tracked tip nodes (must be called on the main thread)
+  # Return result lists (one result per needle) of the processed frames
+  def applyWorkerResults(self, tipPredictions=None):
+    if self.worker is None:
+      return []
+    frameResults = self.worker.getResults()
+    for results in frameResults:
+      self.profiler.addFrame(results[0].stageTimes)
+      self.tipHistory.appendResults(results)
+      self.trackingStatistics.addResults(results)
+      self.updateRobotDetection(results)
+      for (needle, result) in enumerate(results):
+        if result.roiChange:
+          print('Needle %d ROI: %s' %(needle+1, result.roiChange))
+        if result.success:
+          self.setTrackedTip(result.tip, tipPredictions[needle] if tipPredictions else None, needle)
+    return frameResults
+
+  # Update the stored base images (parameters: TrackingParameters, unwrap parameters are applied)
+  def updateBaseImages(self, firstVolume, secondVolume, parameters):
+    # Get arrays from MRML volume nodes 
+    (firstArray, geometry) = self.pullVolumeArray(firstVolume)
+    (secondArray, _) = self.pullVolumeArray(secondVolume)
+    self.setBaseFrame(TrackingFrame(firstArray, secondArray, geometry), parameters)
+
+  # Update the stored base images from a frame
+  def setBaseFrame(self, frame, parameters):
+    self.engine.setBaseFrame(frame, parameters)
+    if parameters.debugFlag:
+      self.endDebugFrame()
+  
+  def getNeedle(self, firstVolume, secondVolume, sliceIndex, tipPrediction, parameters):
+    return self.getNeedles(firstVolume, secondVolume, sliceIndex, [tipPrediction], parameters)[0]
+
+  # Track all needles of tipPredictions (tip prediction nodes) in the current frame, return result of each needle (TrackingResult,
+  # true if successful, reason/getFailureCode() otherwise). The phase difference is computed once for all needles, tracked tips are pushed to the tracked tip node of each needle
+  # parameters: TrackingParameters of the tracking session
+  def getNeedles(self, firstVolume, secondVolume, sliceIndex, tipPredictions, parameters):
+    print('Logic: getNeedles()')    
+    # Get arrays from MRML volume nodes 
+    timestamp = time.time()
+    pullStart = time.perf_counter()
+    (firstArray, geometry) = self.pullVolumeArray(firstVolume)
+    (secondArray, _) = self.pullVolumeArray(secondVolume)
+    pullTime = time.perf_counter() - pullStart
+    return self.getNeedlesFromArrays(firstArray, secondArray, geometry, timestamp, pullTime, tipPredictions, parameters)
+
+  # Track all needles of tipPredictions (tip prediction nodes) in a frame given as arrays (pulled from the scene or received from
+  # OpenIGTLink), return result of each needle (TrackingResult)
+  # timestamp: acquisition time (s) of the frame, pullTime: time (s) spent getting the arrays
+  def getNeedlesFromArrays(self, firstArray, secondArray, geometry, timestamp, pullTime, tipPredictions, parameters):
+    self.trackingStatistics.addReceivedFrames()
+    if not self.engine.isInitialized():
+      print('ERROR: Mag/Phase base images were not initialized')    
+      results = [TrackingResult.failure(self.engine.count, FAILURE_NOT_INITIALIZED) for _ in tipPredictions]
+      self.trackingStatistics.addResults(results)
+      return results
+    # Get tip predicted coordinates: 3D Slicer (RAS)
+    tipRASs = self.getTipPredictionsRAS(tipPredictions)
+    if self.isFrameSkipped(tipRASs, geometry, firstArray.shape):
+      return [TrackingResult.failure(self.engine.count, FAILURE_FRAME_SKIPPED) for _ in tipPredictions]
+    # Debug images of the sampled frames only
+    if parameters.debugFlag and not self.debugWriter.isSampled(self.engine.count + 1):
+      parameters = copy.copy(parameters)
+      parameters.debugFlag = False
+    # Execute tracking pipeline
+    results = self.engine.getNeedles(firstArray, secondArray, geometry, tipRASs, parameters, timestamp)
+    for result in results:
+      result.timestamp = timestamp
+      result.stageTimes['pull'] = pullTime  # Shared frame stage, as the other stage times
+    self.profiler.addFrame(results[0].stageTimes)
+    self.tipHistory.appendResults(results)
+    self.trackingStatistics.addResults(results)
+    self.updateRobotDetection(results)
+    if parameters.debugFlag:
+      self.endDebugFrame()
+    for (needle, result) in enumerate(results):
+      if result.roiChange:
+        print('Needle %d ROI: %s' %(needle+1, result.roiChange))
+      if result.success:
+        # Push coordinates to tip Node
+        self.setTrackedTip(result.tip, tipPredictions[needle], needle)
+
+    return results
@@ -0,0 +1,59 @@
+import math
+
+
+################################################################################################################################################
+# Adaptive ROI policy
+################################################################################################################################################
+
+# ROI size (pixels) adapted to the detection confidence
+# The ROI shrinks by shrinkStep after consistentFrames consecutive consistent detections (tip close to the ROI center) down to
+# the minimum size, and grows by growFactor on each miss (failure reason in growReasons) up to the maximum size.
+# Other failures (e.g. ROI outside the image) keep the size.
+class AdaptiveROIPolicy(object):
+
+  def __init__(self, growReasons=(), shrinkStep=2, growFactor=1.5, consistentFrames=3, consistentRatio=0.5):
+    self.growReasons = tuple(growReasons)     # Failure reasons that grow the ROI (the needle may be outside the window)
+    self.shrinkStep = shrinkStep              # Pixels removed from the ROI size when shrinking
+    self.growFactor = growFactor              # ROI size multiplier when growing
+    self.consistentFrames = consistentFrames  # Consecutive consistent detections before shrinking
+    self.consistentRatio = consistentRatio    # Consistent detection: prediction error below this fraction of the ROI half width
+    self.reset()
+
+  # Forget the adapted size (the next frame starts with the configured ROI size)
+  def reset(self):
+    self.size = None
+    self.reason = None
+    self.consistent = 0
+
+  # Return ROI size (pixels) for the next frame, starting from roiSize and clamped to [minimumSize, maximumSize]
+  def getSize(self, roiSize, minimumSize, maximumSize):
+    if self.size is None:
+      self.size = roiSize
+    self.size = int(min(max(self.size, minimumSize), maximumSize))
+    return self.size
+
+  # Return True if the detection is consistent with the prediction
+  # spacing: (column, row, slice) pixel spacing (mm)
+  def isConsistent(self, result, spacing):
+    if (not result.success) or (result.predictionError is None):
+      return False
+    return result.predictionError <= self.consistentRatio*0.5*self.size*min(spacing[0], spacing[1])
+
+  # Adapt the size to the result of the frame tracked with getSize
+  # Return reason of the size change (None if the size was kept)
+  def update(self, result, spacing, minimumSize, maximumSize):
+    previousSize = self.size
+    reason = None
+    if result.success:
+      self.consistent = self.consistent + 1 if self.isConsistent(result, spacing) else 0
+      if self.consistent >= self.consistentFrames:
+        self.size = max(self.size - self.shrinkStep, minimumSize)
+        self.consistent = 0
+        reason = 'Shrink to %d px: %d consistent detections' %(self.size, self.consistentFrames)
+    else:
+      self.consistent = 0
+      if result.reason in self.growReasons:
+        self.size = min(int(math.ceil(self.size*self.growFactor)), maximumSize)
+        reason = 'Grow to %d px: %s' %(self.size, result.reason)
+    self.reason = reason if (self.size != previousSize) else None
+    return self.reason
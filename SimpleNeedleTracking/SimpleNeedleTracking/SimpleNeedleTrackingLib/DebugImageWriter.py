@@ -0,0 +1,122 @@
+import os
+import queue
+import threading
+
+import SimpleITK as sitk
+
+
+################################################################################################################################################
+# Asynchronous debug image writer
+################################################################################################################################################
+
+# Write debug images (intermediate images of the tracking pipeline) to files from a background thread
+# Images are collected by put() and written as <name>_<frame>.nrrd (frame 0: base images), so the tracking loop never waits for
+# the disk. Images of a frame are handed to the writer thread by endFrame() (or the first image of the next frame), so files are
+# written between frames instead of competing with the tracking of the frame for the CPU.
+# Only every frameInterval-th frame is written; images that do not fit in the bounded queue are dropped and counted.
+# Queued images must not be modified afterwards (the engine creates a new itk image for every debug image).
+class DebugImageWriter(object):
+
+  def __init__(self, path, frameInterval=1, compression=False, maximumQueueSize=64):
+    self.path = path
+    self.frameInterval = max(int(frameInterval), 1)  # Write every frameInterval-th frame
+    self.compression = compression                   # Compress NRRD files (smaller files, more CPU time in the writer thread)
+    self.maximumQueueSize = maximumQueueSize         # Images waiting to be written before new ones are dropped
+    self.imageQueue = None
+    self.thread = None
+    self.pendingImages = []  # (sitkImage, fileName) of the current frame
+    self.pendingFrame = None
+    self.writtenImages = 0
+    self.droppedImages = 0
+    self.failedImages = 0
+    self.lastError = None
+
+  # Return True if the writer thread is running
+  def isRunning(self):
+    return (self.thread is not None) and self.thread.is_alive()
+
+  # Start the writer thread (the output directory is created if needed)
+  def start(self):
+    self.stop()
+    os.makedirs(self.path, exist_ok=True)
+    self.writtenImages = 0
+    self.droppedImages = 0
+    self.failedImages = 0
+    self.lastError = None
+    self.pendingImages = []
+    self.pendingFrame = None
+    self.imageQueue = queue.Queue(maxsize=self.maximumQueueSize)
+    self.thread = threading.Thread(target=self.run, name='DebugImageWriter')
+    self.thread.daemon = True
+    self.thread.start()
+
+  # Return True if images of the frame are written
+  def isSampled(self, frame):
+    return (frame % self.frameInterval) == 0
+
+  # Return file path of a debug image
+  def getFileName(self, name, frame):
+    return os.path.join(self.path, '%s_%06d.nrrd' %(name, frame))
+
+  # Add an image of the frame, return False if the frame is not sampled or the writer is stopped
+  def put(self, sitkImage, name, frame):
+    if (not self.isRunning()) or (not self.isSampled(frame)):
+      return False
+    if frame != self.pendingFrame:
+      self.endFrame()
+      self.pendingFrame = frame
+    self.pendingImages.append((sitkImage, self.getFileName(name, frame)))
+    return True
+
+  # Queue the images of the current frame for writing, return number of images dropped because the queue is full
+  def endFrame(self):
+    dropped = 0
+    for item in self.pendingImages:
+      try:
+        self.imageQueue.put_nowait(item)
+      except queue.Full:
+        dropped += 1
+    self.droppedImages += dropped
+    self.pendingImages = []
+    self.pendingFrame = None
+    return dropped
+
+  # Writer thread loop (a None item stops the loop)
+  def run(self):
+    fileWriter = sitk.ImageFileWriter()
+    while True:
+      item = self.imageQueue.get()
+      if item is None:
+        break
+      (sitkImage, fileName) = item
+      try:
+        fileWriter.Execute(sitkImage, fileName, self.compression, -1)
+        self.writtenImages += 1
+      except RuntimeError as error:
+        self.failedImages += 1
+        self.lastError = str(error)
+
+  # Write the queued images and stop the writer thread (images still queued after timeout seconds are lost)
+  def stop(self, timeout=10.0):
+    if self.thread is None:
+      return
+    self.endFrame()
+    try:
+      self.imageQueue.put(None, timeout=timeout)
+    except queue.Full:
+      pass
+    self.thread.join(timeout)
+    self.thread = None
+
+  # Return number of queued, written, dropped and failed images
+  def getStatistics(self):
+    queued = self.imageQueue.qsize() if self.imageQueue is not None else 0
+    return {'queued': queued, 'written': self.writtenImages, 'dropped': self.droppedImages, 'failed': self.failedImages}
+
+  # Return statistics as text
+  def formatStatistics(self):
+    statistics = self.getStatistics()
+    text = 'Debug images: %d written, %d dropped (queue full), %d failed' %(statistics['written'], statistics['dropped'], statistics['failed'])
+    if self.lastError is not None:
+      text += ' (last error: %s)' %(self.lastError)
+    return text
@@ -0,0 +1,389 @@
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+from .TrackingEngine import ImageGeometry, TrackingFrame
+
+
+# OpenIGTLink message header (58 bytes, big endian): version, message type, device name, timestamp, body size, CRC64 of the body
+IGTL_HEADER_FORMAT = '>H12s20sQQQ'
+IGTL_HEADER_SIZE = 58
+# Extended header at the start of version 2 message bodies: extended header size, metadata header size, metadata size, message ID
+IGTL_EXTENDED_HEADER_FORMAT = '>HHII'
+# IMAGE message header (72 bytes): version, components, scalar type, endian, coordinate system, size (i, j, k),
+# matrix (t, s, n: axis directions scaled by the spacing, p: center of the volume), subvolume offset and size
+IGTL_IMAGE_HEADER_FORMAT = '>HBBBB3H12f3H3H'
+IGTL_IMAGE_HEADER_SIZE = 72
+
+IGTL_SCALAR_TYPES = {2: np.int8, 3: np.uint8, 4: np.int16, 5: np.uint16, 6: np.int32, 7: np.uint32, 10: np.float32, 11: np.float64}
+IGTL_ENDIAN_BIG = 1
+IGTL_ENDIAN_LITTLE = 2
+IGTL_COORDINATE_RAS = 1
+IGTL_COORDINATE_LPS = 2
+
+# CRC64 of OpenIGTLink (ECMA-182 polynomial, not reflected, initial value 0)
+CRC64_POLYNOMIAL = 0x42F0E1EBA9EA3693
+CRC64_MASK = 0xFFFFFFFFFFFFFFFF
+
+
+################################################################################################################################################
+# OpenIGTLink protocol
+################################################################################################################################################
+
+def _createCRC64Table():
+  table = []
+  for byte in range(256):
+    crc = byte << 56
+    for _ in range(8):
+      crc = ((crc << 1) ^ CRC64_POLYNOMIAL) if (crc & (1 << 63)) else (crc << 1)
+      crc &= CRC64_MASK
+    table.append(crc)
+  return table
+
+_CRC64_TABLE = _createCRC64Table()
+
+# Return CRC64 of data (pure Python, about 0.2 s per MB: receivers only check it on request)
+def crc64(data, crc=0):
+  table = _CRC64_TABLE
+  for byte in bytes(data):
+    crc = table[((crc >> 56) ^ byte) & 0xFF] ^ ((crc << 8) & CRC64_MASK)
+  return crc
+
+# Return OpenIGTLink timestamp (seconds in the upper 32 bits, fraction of a second in the lower 32 bits) of a time (s)
+def packTimestamp(timestamp):
+  seconds = int(timestamp)
+  return (seconds << 32) | int((timestamp - seconds)*(1 << 32))
+
+# Return time (s) of an OpenIGTLink timestamp
+def unpackTimestamp(value):
+  return (value >> 32) + (value & 0xFFFFFFFF)/float(1 << 32)
+
+# Return message header bytes
+def packHeader(messageType, deviceName, timestamp, body, checksum=True):
+  crc = crc64(body) if checksum else 0
+  return struct.pack(IGTL_HEADER_FORMAT, 1, messageType.encode('ascii'), deviceName.encode('ascii'), packTimestamp(timestamp), len(body), crc)
+
+# Return (version, message type, device name, timestamp (s), body size, CRC64) of a message header
+def unpackHeader(data):
+  (version, messageType, deviceName, timestamp, bodySize, crc) = struct.unpack(IGTL_HEADER_FORMAT, data)
+  return (version, messageType.rstrip(b'\0').decode('ascii', 'replace'), deviceName.rstrip(b'\0').decode('ascii', 'replace'),
+          unpackTimestamp(timestamp), bodySize, crc)
+
+# Return IMAGE matrix (t, s, n, p in RAS) of a [slice, row, column] volume with ImageGeometry (LPS)
+def getImageMatrix(shape, geometry):
+  direction = np.reshape(geometry.direction, (3, 3))
+  size = np.array(shape[::-1], dtype=float)  # (i, j, k)
+  center = np.asarray(geometry.origin) + direction.dot(np.asarray(geometry.spacing)*(size - 1)/2.0)
+  axes = direction*np.asarray(geometry.spacing)  # Columns: t, s, n
+  lpsToRAS = np.array([-1.0, -1.0, 1.0])
+  return [float(v) for v in np.concatenate([axes[:, 0], axes[:, 1], axes[:, 2], center])*np.tile(lpsToRAS, 4)]
+
+# Return ImageGeometry (LPS) of an IMAGE matrix (t, s, n, p) with size (i, j, k)
+def getImageGeometry(size, matrix, coordinate=IGTL_COORDINATE_RAS):
+  matrix = np.reshape(np.asarray(matrix, dtype=float), (4, 3))
+  if coordinate == IGTL_COORDINATE_RAS:
+    matrix = matrix*np.array([-1.0, -1.0, 1.0])
+  axes = matrix[:3].T  # Columns: t, s, n
+  spacing = np.linalg.norm(axes, axis=0)
+  direction = axes/np.where(spacing > 0, spacing, 1.0)
+  origin = matrix[3] - direction.dot(spacing*(np.asarray(size, dtype=float) - 1)/2.0)
+  return ImageGeometry(spacing, origin, direction.flatten())
+
+# Return IMAGE message (header and body bytes) of a [slice, row, column] array (single component)
+def packImageMessage(deviceName, array, geometry, timestamp, checksum=True):
+  scalarTypes = dict((np.dtype(dtype), scalarType) for (scalarType, dtype) in IGTL_SCALAR_TYPES.items())
+  scalarType = scalarTypes.get(array.dtype.newbyteorder('='))
+  if scalarType is None:
+    raise ValueError('Unsupported OpenIGTLink scalar type: %s' %(array.dtype))
+  size = array.shape[::-1]
+  imageHeader = struct.pack(IGTL_IMAGE_HEADER_FORMAT, 1, 1, scalarType, IGTL_ENDIAN_BIG, IGTL_COORDINATE_RAS, *(tuple(size) + tuple(getImageMatrix(array.shape, geometry)) +
+                            (0, 0, 0) + tuple(size)))
+  body = imageHeader + np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('>')).tobytes()
+  return packHeader('IMAGE', deviceName, timestamp, body, checksum) + body
+
+
+################################################################################################################################################
+# Image pair buffer
+################################################################################################################################################
+
+# Preallocated float32 image of the pair buffer
+class _ImageSlot(object):
+
+  FREE = 0     # Can be written
+  WRITING = 1  # Pixel data is being copied by the receiver
+  WAITING = 2  # Waiting for the image of the other channel
+  PAIRED = 3   # Part of the latest pair, not taken yet
+  TAKEN = 4    # Part of the frame handed to the consumer
+
+  def __init__(self):
+    self.array = None
+    self.geometry = None
+    self.timestamp = None
+    self.convertTime = 0.0
+    self.state = _ImageSlot.FREE
+
+# Ring buffer of first (magnitude/real) and second (phase/imaginary) images, paired by timestamp
+# Each channel has a fixed number of preallocated float32 slots that are reused as long as the image size does not change.
+# An image is paired with the image of the other channel with the closest timestamp within pairTolerance (s); images
+# older than a completed pair are discarded as unmatched. Only the latest pair is kept (latest frame wins): a pair that is
+# replaced before it was taken is counted as dropped.
+class ImagePairBuffer(object):
+
+  def __init__(self, slots=4, pairTolerance=0.05):
+    self.pairTolerance = pairTolerance
+    self.slots = [[_ImageSlot() for _ in range(max(slots, 3))] for _ in range(2)]  # Latest pair, taken frame and one to write
+    self.condition = threading.Condition()
+    self.latestPair = None
+    self.takenPair = None
+    self.pairedFrames = 0
+    self.takenFrames = 0
+    self.droppedFrames = 0
+    self.unmatchedImages = 0
+
+  # Return a slot of the channel for a new image (state WRITING): free slot of the same size first, oldest waiting image otherwise
+  def acquireSlot(self, channel, shape):
+    with self.condition:
+      candidates = [slot for slot in self.slots[channel] if slot.state == _ImageSlot.FREE]
+      candidates.sort(key=lambda slot: (slot.array is None) or (slot.array.shape != shape))
+      if not candidates:
+        candidates = sorted([slot for slot in self.slots[channel] if slot.state == _ImageSlot.WAITING], key=lambda slot: slot.timestamp)
+        self.unmatchedImages += 1
+      slot = candidates[0]
+      slot.state = _ImageSlot.WRITING
+    if (slot.array is None) or (slot.array.shape != shape):
+      slot.array = np.empty(shape, dtype=np.float32)
+    return slot
+
+  # Copy an image into a slot of the channel and pair it, return True if a pair was completed
+  def put(self, channel, array, geometry, timestamp):
+    convertStart = time.perf_counter()
+    slot = self.acquireSlot(channel, array.shape)
+    np.copyto(slot.array, array, casting='unsafe')
+    slot.geometry = geometry
+    slot.timestamp = timestamp
+    slot.convertTime = time.perf_counter() - convertStart
+    with self.condition:
+      slot.state = _ImageSlot.WAITING
+      others = [other for other in self.slots[1 - channel] if (other.state == _ImageSlot.WAITING) and (other.array.shape == slot.array.shape) and
+                (abs(other.timestamp - timestamp) <= self.pairTolerance)]
+      if not others:
+        return False
+      other = min(others, key=lambda other: abs(other.timestamp - timestamp))
+      pair = (slot, other) if channel == 0 else (other, slot)
+      # Replace the latest pair, discard images older than the new pair
+      if self.latestPair is not None:
+        self.droppedFrames += 1
+        for pairSlot in self.latestPair:
+          pairSlot.state = _ImageSlot.FREE
+      for (pairSlot, channelSlots) in zip(pair, self.slots):
+        for older in channelSlots:
+          if (older.state == _ImageSlot.WAITING) and (older is not pairSlot) and (older.timestamp < pairSlot.timestamp):
+            older.state = _ImageSlot.FREE
+            self.unmatchedImages += 1
+        pairSlot.state = _ImageSlot.PAIRED
+      self.latestPair = pair
+      self.pairedFrames += 1
+      self.condition.notify_all()
+      return True
+
+  # Return TrackingFrame of the latest pair (None if there is no new pair within timeout seconds, 0: do not wait)
+  # The frame arrays are slots of the buffer: they stay valid until the next take() or release() and must not be modified.
+  # The frame geometry is the geometry of the first image, stageTimes['pull'] is the conversion time of both images.
+  def take(self, timeout=0):
+    with self.condition:
+      self.release()
+      if (self.latestPair is None) and timeout:
+        self.condition.wait(timeout)
+      if self.latestPair is None:
+        return None
+      (first, second) = self.takenPair = self.latestPair
+      self.latestPair = None
+      first.state = second.state = _ImageSlot.TAKEN
+      self.takenFrames += 1
+    frame = TrackingFrame(first.array, second.array, first.geometry, None, first.timestamp)
+    frame.stageTimes['pull'] = first.convertTime + second.convertTime
+    return frame
+
+  # Give the slots of the taken frame back to the buffer
+  def release(self):
+    with self.condition:
+      if self.takenPair is not None:
+        for slot in self.takenPair:
+          slot.state = _ImageSlot.FREE
+        self.takenPair = None
+
+
+################################################################################################################################################
+# OpenIGTLink IMAGE receiver
+################################################################################################################################################
+
+# Receive first (magnitude/real) and second (phase/imaginary) images as OpenIGTLink IMAGE messages in a background thread
+# The receiver connects to host:port (or listens on port if server is True) and reconnects when the connection is lost.
+# IMAGE messages of firstDeviceName/secondDeviceName are converted to float32 straight from the socket buffer into the
+# ImagePairBuffer and paired by message timestamp (receive time if the sender does not set timestamps); other messages are
+# skipped. Frames are taken by the consumer with takeFrame() without going through the MRML scene.
+class IGTLImageReceiver(object):
+
+  def __init__(self, host='localhost', port=18944, firstDeviceName='first', secondDeviceName='second', server=False, slots=4, pairTolerance=0.05,
+               checkCRC=False):
+    self.host = host
+    self.port = port
+    self.deviceNames = (firstDeviceName, secondDeviceName)
+    self.server = server
+    self.checkCRC = checkCRC  # Verify CRC64 of IMAGE bodies (slow for large images)
+    self.pairBuffer = ImagePairBuffer(slots, pairTolerance)
+    self.bodyBuffer = bytearray()
+    self.thread = None
+    self.stopEvent = threading.Event()
+    self.connected = False
+    self.connections = 0
+    self.receivedImages = [0, 0]
+    self.skippedMessages = 0
+    self.rejectedImages = 0
+    self.lastError = None
+
+  # Return True if the receiver thread is running
+  def isRunning(self):
+    return (self.thread is not None) and self.thread.is_alive()
+
+  # Start the receiver thread
+  def start(self):
+    self.stop()
+    self.stopEvent.clear()
+    self.thread = threading.Thread(target=self.run, name='IGTLImageReceiver')
+    self.thread.daemon = True
+    self.thread.start()
+
+  # Stop the receiver thread and close the connection
+  def stop(self, timeout=5.0):
+    if self.thread is None:
+      return
+    self.stopEvent.set()
+    self.thread.join(timeout)
+    self.thread = None
+
+  # Return frame of the latest image pair (see ImagePairBuffer.take)
+  def takeFrame(self, timeout=0):
+    return self.pairBuffer.take(timeout)
+
+  # Give the arrays of the taken frame back to the receiver
+  def releaseFrame(self):
+    self.pairBuffer.release()
+
+  # Return connected socket (None if stopped)
+  def connect(self):
+    if not self.server:
+      while not self.stopEvent.is_set():
+        try:
+          return socket.create_connection((self.host, self.port), timeout=0.5)
+        except OSError as error:
+          self.lastError = str(error)
+          self.stopEvent.wait(0.5)
+      return None
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((self.host, self.port))
+    listener.listen(1)
+    listener.settimeout(0.5)
+    try:
+      while not self.stopEvent.is_set():
+        try:
+          return listener.accept()[0]
+        except socket.timeout:
+          continue
+    finally:
+      listener.close()
+    return None
+
+  # Fill view from the socket, return False if stopped or disconnected
+  def receiveInto(self, connection, view):
+    received = 0
+    while received < len(view):
+      try:
+        count = connection.recv_into(view[received:])
+      except socket.timeout:
+        if self.stopEvent.is_set():
+          return False
+        continue
+      if count == 0:
+        return False
+      received += count
+    return True
+
+  # Receiver thread loop
+  def run(self):
+    while not self.stopEvent.is_set():
+      connection = self.connect()
+      if connection is None:
+        break
+      connection.settimeout(0.5)
+      connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      self.connections += 1
+      self.connected = True
+      try:
+        self.receiveMessages(connection)
+      except (OSError, ValueError, struct.error) as error:
+        self.lastError = str(error)
+      finally:
+        self.connected = False
+        connection.close()
+
+  # Receive messages until stopped or disconnected
+  def receiveMessages(self, connection):
+    header = bytearray(IGTL_HEADER_SIZE)
+    while self.receiveInto(connection, memoryview(header)):
+      (version, messageType, deviceName, timestamp, bodySize, crc) = unpackHeader(header)
+      if len(self.bodyBuffer) < bodySize:
+        self.bodyBuffer = bytearray(bodySize)
+      body = memoryview(self.bodyBuffer)[:bodySize]
+      if not self.receiveInto(connection, body):
+        return
+      if (messageType != 'IMAGE') or (deviceName not in self.deviceNames):
+        self.skippedMessages += 1
+        continue
+      if self.checkCRC and (crc64(body) != crc):
+        self.rejectedImages += 1
+        self.lastError = 'CRC64 mismatch of %s' %(deviceName)
+        continue
+      if version >= 2:
+        # Skip the extended header, remove the metadata from the content
+        (extendedHeaderSize, metadataHeaderSize, metadataSize, _) = struct.unpack_from(IGTL_EXTENDED_HEADER_FORMAT, body)
+        body = body[extendedHeaderSize:bodySize - metadataHeaderSize - metadataSize]
+      self.putImage(self.deviceNames.index(deviceName), body, timestamp if timestamp > 0 else time.time())
+
+  # Convert IMAGE message content into the pair buffer
+  def putImage(self, channel, content, timestamp):
+    values = struct.unpack_from(IGTL_IMAGE_HEADER_FORMAT, content)
+    (components, scalarType, endian, coordinate) = values[1:5]
+    size = values[5:8]
+    matrix = values[8:20]
+    subvolumeSize = values[23:26]
+    dtype = IGTL_SCALAR_TYPES.get(scalarType)
+    if (components != 1) or (dtype is None) or (tuple(subvolumeSize) != tuple(size)):
+      self.rejectedImages += 1
+      self.lastError = 'Unsupported image: %d components, scalar type %d, subvolume %s of %s' %(components, scalarType, subvolumeSize, size)
+      return
+    dtype = np.dtype(dtype).newbyteorder('>' if endian == IGTL_ENDIAN_BIG else '<')
+    shape = tuple(size[::-1])
+    array = np.frombuffer(content, dtype=dtype, count=int(np.prod(shape)), offset=IGTL_IMAGE_HEADER_SIZE).reshape(shape)
+    self.pairBuffer.put(channel, array, getImageGeometry(size, matrix, coordinate), timestamp)
+    self.receivedImages[channel] += 1
+
+  # Return receiver counters
+  def getStatistics(self):
+    pairBuffer = self.pairBuffer
+    return {'connections': self.connections, 'first': self.receivedImages[0], 'second': self.receivedImages[1], 'paired': pairBuffer.pairedFrames,
+            'taken': pairBuffer.takenFrames, 'dropped': pairBuffer.droppedFrames, 'unmatched': pairBuffer.unmatchedImages,
+            'skipped': self.skippedMessages, 'rejected': self.rejectedImages}
+
+  # Return statistics as text
+  def formatStatistics(self):
+    statistics = self.getStatistics()
+    text = ('OpenIGTLink: %(first)d/%(second)d images received, %(paired)d frames paired, %(taken)d tracked, %(dropped)d dropped (busy), '
+            '%(unmatched)d unmatched images, %(skipped)d other messages, %(rejected)d rejected images' %statistics)
+    if self.lastError is not None:
+      text += ' (last error: %s)' %(self.lastError)
+    return text
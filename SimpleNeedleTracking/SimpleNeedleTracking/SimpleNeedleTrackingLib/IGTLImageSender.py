@@ -0,0 +1,138 @@
+# Stand-in OpenIGTLink image sender for the needle tracker
+#
+# Sends a recorded sequence (base frame, then frames) as pairs of OpenIGTLink IMAGE messages, like the scanner does, to test
+# IGTLImageReceiver without a scanner. Both images of a frame get the same timestamp; the second image can be sent first, with
+# a timestamp offset or be left out to exercise the pairing.
+#
+# Usage (from the SimpleNeedleTracking module directory):
+#   python -m SimpleNeedleTrackingLib.IGTLImageSender --base mag_base.nrrd phase_base.nrrd \
+#     --first "mag_*.nrrd" --second "phase_*.nrrd" --port 18944 --rate 2 --first-device Magnitude --second-device Phase
+
+import argparse
+import random
+import socket
+import time
+
+from .IGTLImageReceiver import packImageMessage
+from .ReplayBenchmark import loadBaseFrame, loadTrackingFrames
+
+
+################################################################################################################################################
+# Image sender
+################################################################################################################################################
+
+# Send IMAGE messages to one receiver (listening on port if server is True, connecting to host:port otherwise)
+class IGTLImageSender(object):
+
+  def __init__(self, host='localhost', port=18944, server=True, checksum=True):
+    self.host = host
+    self.port = port
+    self.server = server
+    self.checksum = checksum  # Compute CRC64 of the message bodies (pure Python, about 0.2 s per MB)
+    self.connection = None
+    self.sentMessages = 0
+
+  # Wait for the receiver to connect (server) or connect to it, return False on timeout
+  def open(self, timeout=60.0):
+    if not self.server:
+      deadline = time.time() + timeout
+      while time.time() < deadline:
+        try:
+          self.connection = socket.create_connection((self.host, self.port), timeout=timeout)
+          break
+        except OSError:
+          time.sleep(0.5)
+    else:
+      listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      listener.bind((self.host, self.port))
+      listener.listen(1)
+      listener.settimeout(timeout)
+      try:
+        self.connection = listener.accept()[0]
+      except socket.timeout:
+        pass
+      finally:
+        listener.close()
+    if self.connection is None:
+      return False
+    self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return True
+
+  # Send one image
+  def sendImage(self, deviceName, array, geometry, timestamp):
+    self.connection.sendall(packImageMessage(deviceName, array, geometry, timestamp, self.checksum))
+    self.sentMessages += 1
+
+  # Send the images of a frame
+  # secondFirst: send the second image before the first one, secondOffset: timestamp offset (s) of the second image,
+  # skipSecond: do not send the second image
+  def sendFrame(self, frame, firstDeviceName, secondDeviceName, timestamp=None, secondFirst=False, secondOffset=0.0, skipSecond=False):
+    timestamp = time.time() if timestamp is None else timestamp
+    messages = [(firstDeviceName, frame.firstArray, timestamp)]
+    if not skipSecond:
+      messages.append((secondDeviceName, frame.secondArray, timestamp + secondOffset))
+    if secondFirst:
+      messages.reverse()
+    for (deviceName, array, messageTimestamp) in messages:
+      self.sendImage(deviceName, array, frame.geometry, messageTimestamp)
+
+  # Close the connection
+  def close(self):
+    if self.connection is not None:
+      self.connection.close()
+      self.connection = None
+
+
+################################################################################################################################################
+# Command line
+################################################################################################################################################
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Send a recorded sequence as OpenIGTLink IMAGE messages')
+  parser.add_argument('--base', nargs=2, required=True, metavar=('FIRST', 'SECOND'), help='Base magnitude/real and phase/imaginary NRRD files')
+  parser.add_argument('--first', nargs='+', required=True, help='Magnitude/real frame files (glob patterns, 3D or 4D NRRD)')
+  parser.add_argument('--second', nargs='+', required=True, help='Phase/imaginary frame files (glob patterns, 3D or 4D NRRD)')
+  parser.add_argument('--host', default='localhost', help='Receiver host (--client) or listening address')
+  parser.add_argument('--port', type=int, default=18944)
+  parser.add_argument('--client', action='store_true', help='Connect to the receiver instead of waiting for it')
+  parser.add_argument('--first-device', default='first', help='Device name of the magnitude/real images')
+  parser.add_argument('--second-device', default='second', help='Device name of the phase/imaginary images')
+  parser.add_argument('--rate', type=float, default=1.0, help='Frames per second (0: as fast as possible)')
+  parser.add_argument('--repeat', type=int, default=1, help='Number of times the frames are sent')
+  parser.add_argument('--base-delay', type=float, default=1.0, help='Delay (s) between the base frame and the first frame')
+  parser.add_argument('--second-first', action='store_true', help='Send the second image of each frame before the first one')
+  parser.add_argument('--jitter', type=float, default=0.0, help='Random timestamp offset (ms) of the second images, up to +/- this value')
+  parser.add_argument('--drop-every', type=int, default=0, metavar='N', help='Leave out the second image of every N-th frame')
+  parser.add_argument('--no-checksum', action='store_true', help='Send CRC64 0 instead of computing it')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args(argv)
+
+  baseFrame = loadBaseFrame(args.base[0], args.base[1])
+  frames = loadTrackingFrames(args.first, args.second)
+  generator = random.Random(args.seed)
+  sender = IGTLImageSender(args.host, args.port, not args.client, not args.no_checksum)
+  print('Waiting for the receiver on port %d' %(args.port) if sender.server else 'Connecting to %s:%d' %(args.host, args.port))
+  if not sender.open():
+    print('ERROR: No receiver connected')
+    return
+  try:
+    sender.sendFrame(baseFrame, args.first_device, args.second_device)
+    time.sleep(args.base_delay)
+    index = 0
+    for _ in range(args.repeat):
+      for frame in frames:
+        index += 1
+        sendStart = time.time()
+        sender.sendFrame(frame, args.first_device, args.second_device, sendStart, args.second_first, generator.uniform(-args.jitter, args.jitter)*1e-3,
+                         (args.drop_every > 0) and (index % args.drop_every == 0))
+        if args.rate > 0:
+          time.sleep(max(1.0/args.rate - (time.time() - sendStart), 0.0))
+  except OSError as error:
+    print('ERROR: %s' %(error))
+  finally:
+    sender.close()
+  print('Sent %d frames (%d messages)' %(index, sender.sentMessages))
+
+if __name__ == '__main__':
+  main()
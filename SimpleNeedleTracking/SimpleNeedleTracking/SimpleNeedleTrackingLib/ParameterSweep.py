@@ -0,0 +1,269 @@
+# Parallel parameter sweep for the needle tracker
+#
+# Replays a recorded sequence (ReplayBenchmark) with every parameter set of a grid or of a random sample on a process pool
+# and ranks the sets by success rate, tip error against the reference path and mean latency. Sets that no other set beats in
+# all three are marked as Pareto optimal. Latencies measured while the workers compete for the CPUs are inflated, so the best
+# sets (top and Pareto optimal) are replayed again one after the other before the final ranking (see retimeBestSets).
+#
+# Values of a swept parameter (names of TrackingParameters):
+#   key=v1,v2,v3      listed values (grid and random sample)
+#   key=lo:hi:n       n values evenly spaced from lo to hi (grid), uniform in [lo, hi] (random sample)
+#   key=lo:hi         uniform in [lo, hi] (random sample only)
+#
+# Usage (from the SimpleNeedleTracking module directory):
+#   python -m SimpleNeedleTrackingLib.ParameterSweep --base mag_base.nrrd phase_base.nrrd \
+#     --first "mag_*.nrrd" --second "phase_*.nrrd" --prediction-csv tips.csv --reference-csv tips.csv \
+#     --param maskThreshold=40,60,80 --param roiSize=15,25,35 --param blobThreshold=2.5:3.5:3 --workers 4 --csv sweep.csv
+#   Random sample of 50 sets: --random 50 --param blobThreshold=2.0:4.0 --param errorThreshold=5:20
+#   Frame timestamps (Kalman prediction, tip smoothing): --frame-interval 0.5 or --timestamp-csv timestamps.csv
+
+import argparse
+import collections
+import concurrent.futures
+import csv
+import itertools
+import multiprocessing
+import os
+import random
+
+import numpy as np
+
+from .TrackingEngine import TrackingParameters
+from .ReplayBenchmark import ReplayBenchmark, loadBaseFrame, loadTrackingFrames, loadPointsCSV, loadTimestampsCSV, parseParameters
+
+
+################################################################################################################################################
+# Parameter sets
+################################################################################################################################################
+
+# Swept parameter: listed values or range [minimum, maximum] (with number of grid steps)
+class ParameterSpec(object):
+
+  def __init__(self, key, values=None, minimum=None, maximum=None, steps=None):
+    self.key = key
+    self.values = values
+    self.minimum = minimum
+    self.maximum = maximum
+    self.steps = steps
+    self.isInteger = isinstance(getattr(TrackingParameters(), key), int) and not isinstance(getattr(TrackingParameters(), key), bool)
+
+  # Return spec from 'key=v1,v2,...', 'key=lo:hi:n' or 'key=lo:hi'
+  @staticmethod
+  def fromText(text):
+    (key, _, valueText) = [part.strip() for part in text.partition('=')]
+    if not hasattr(TrackingParameters(), key):
+      raise ValueError('Unknown tracking parameter: %s' %(key))
+    if ':' in valueText:
+      parts = valueText.split(':')
+      if len(parts) not in (2, 3):
+        raise ValueError('Invalid range of %s: %s (expected lo:hi or lo:hi:n)' %(key, valueText))
+      steps = int(parts[2]) if len(parts) == 3 else None
+      return ParameterSpec(key, minimum=float(parts[0]), maximum=float(parts[1]), steps=steps)
+    return ParameterSpec(key, values=[value.strip() for value in valueText.split(',') if value.strip()])
+
+  # Return value as text ('key=value' item of parseParameters)
+  def formatValue(self, value):
+    if isinstance(value, str):
+      return value
+    return '%d' %(int(round(value))) if self.isInteger else '%.6g' %(value)
+
+  # Return grid values (text)
+  def getGridValues(self):
+    if self.values is not None:
+      return self.values
+    if self.steps is None:
+      raise ValueError('Grid sweep needs a list or lo:hi:n for %s' %(self.key))
+    values = [self.formatValue(value) for value in np.linspace(self.minimum, self.maximum, max(self.steps, 1))]
+    return list(dict.fromkeys(values))  # Integer parameters: remove repeated rounded values
+
+  # Return a random value (text)
+  def getRandomValue(self, generator):
+    if self.values is not None:
+      return generator.choice(self.values)
+    if self.isInteger:
+      return self.formatValue(generator.randint(int(round(self.minimum)), int(round(self.maximum))))
+    return self.formatValue(generator.uniform(self.minimum, self.maximum))
+
+# Return parameter sets (lists of (key, value text)) of the full grid
+def getGridSets(specs):
+  return [list(zip([spec.key for spec in specs], values)) for values in itertools.product(*[spec.getGridValues() for spec in specs])]
+
+# Return count random parameter sets (repeated sets are removed)
+def getRandomSets(specs, count, seed=0):
+  generator = random.Random(seed)
+  sets = []
+  for _ in range(count):
+    parameterSet = [(spec.key, spec.getRandomValue(generator)) for spec in specs]
+    if parameterSet not in sets:
+      sets.append(parameterSet)
+  return sets
+
+# Return parseParameters text of a parameter set on top of the fixed parameters
+def formatParameterSet(fixedText, parameterSet):
+  items = [item for item in fixedText.split(',') if item.strip()] + ['%s=%s' %(key, value) for (key, value) in parameterSet]
+  return ','.join(items)
+
+
+################################################################################################################################################
+# Sweep workers
+################################################################################################################################################
+
+# Replay benchmark of the worker process (loaded once per process by the pool initializer)
+_benchmark = None
+
+# Load the sequence in the worker process
+def _initializeWorker(sequence):
+  global _benchmark
+  (basePaths, firstPatterns, secondPatterns, predictions, references, followTip, frameInterval, timestamps) = sequence
+  baseFrame = loadBaseFrame(basePaths[0], basePaths[1])
+  frames = loadTrackingFrames(firstPatterns, secondPatterns, frameInterval, timestamps)
+  _benchmark = ReplayBenchmark(baseFrame, frames, predictions, references, followTip)
+
+# Replay the sequence with one parameter set, return (name, parameter text, summary, failure counts)
+def _runParameterSet(name, text, inputMode):
+  report = _benchmark.run(parseParameters(text, inputMode), name)
+  return (name, text, report.getSummary(), dict(report.getFailureCounts()))
+
+
+################################################################################################################################################
+# Ranking
+################################################################################################################################################
+
+# Return sort key: highest success rate, then lowest mean tip error (missing error last), then lowest mean latency
+def getRankKey(summary):
+  error = summary['tip_error_mean_mm']
+  return (-summary['success_rate'], error if not np.isnan(error) else float('inf'), summary['latency_mean_ms'])
+
+# Return True if summary a is at least as good as b in success rate, tip error and latency and better in one of them
+def dominates(a, b):
+  (successA, errorA, latencyA) = getRankKey(a)
+  (successB, errorB, latencyB) = getRankKey(b)
+  return (successA <= successB) and (errorA <= errorB) and (latencyA <= latencyB) and ((successA, errorA, latencyA) != (successB, errorB, latencyB))
+
+# Return sweep rows sorted by rank, with 'rank' and 'pareto' (not dominated by another set) added to each summary
+# Summaries with 'retimed' False (latency measured on concurrent workers) are ranked but never Pareto optimal, and only
+# re-timed sets are compared for the Pareto marks.
+def rankResults(results):
+  summaries = [summary for (_, _, summary, _) in results if summary.get('retimed', True)]
+  rows = []
+  for (name, text, summary, failures) in results:
+    pareto = summary.get('retimed', True) and not any(dominates(other, summary) for other in summaries if other is not summary)
+    rows.append((name, text, summary, failures, pareto))
+  rows.sort(key=lambda row: getRankKey(row[2]))
+  for (rank, row) in enumerate(rows):
+    row[2]['rank'] = rank + 1
+    row[2]['pareto'] = row[4]
+  return rows
+
+# Print the best sets
+def printRanking(rows, count):
+  print('%5s %7s %10s %10s %10s %7s  %s' %('rank', 'success', 'error(mm)', 'mean(ms)', 'p95(ms)', 'pareto', 'parameters'))
+  for (name, text, summary, failures, pareto) in rows[:count]:
+    print('%5d %7.3f %10.3f %10.2f %10.2f %7s  %s' %(summary['rank'], summary['success_rate'], summary['tip_error_mean_mm'], summary['latency_mean_ms'],
+                                                   summary['latency_p95_ms'], '*' if pareto else '', text or '(defaults)'))
+  if not all(summary.get('retimed', True) for (_, _, summary, _, _) in rows[:count]):
+    print('Latencies of sets that were not re-timed were measured on concurrent workers (relative only)')
+
+# Write all sets (one row per set: rank, swept parameter values, summary values, failure counts)
+def writeResultsCSV(path, rows, keys):
+  reasons = sorted(set(reason for row in rows for reason in row[3]))
+  summaryKeys = [key for key in rows[0][2].keys() if key not in ('rank', 'pareto', 'name')]
+  with open(path, 'w', newline='') as csvFile:
+    writer = csv.writer(csvFile)
+    writer.writerow(['rank', 'name', 'pareto'] + keys + summaryKeys + ['parameters'] + reasons)
+    for (name, text, summary, failures, pareto) in rows:
+      parameters = parseParameters(text)
+      writer.writerow([summary['rank'], name, int(pareto)] + [getattr(parameters, key) for key in keys] + [summary[key] for key in summaryKeys] +
+                      [text] + [failures.get(reason, 0) for reason in reasons])
+
+
+################################################################################################################################################
+# Command line
+################################################################################################################################################
+
+# Run all parameter sets on workers processes (in this process if workers is 1), return (name, text, summary, failures) list
+def runSweep(sequence, texts, inputMode, workers):
+  names = ['set%03d' %(index) for index in range(len(texts))]
+  if workers <= 1:
+    _initializeWorker(sequence)
+    return [_runParameterSet(name, text, inputMode) for (name, text) in zip(names, texts)]
+  context = multiprocessing.get_context('spawn')
+  with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context, initializer=_initializeWorker, initargs=(sequence,)) as executor:
+    futures = [executor.submit(_runParameterSet, name, text, inputMode) for (name, text) in zip(names, texts)]
+    results = []
+    for (index, future) in enumerate(concurrent.futures.as_completed(futures)):
+      results.append(future.result())
+      print('%d/%d parameter sets done' %(index + 1, len(futures)), end='\r', flush=True)
+    print()
+  return results
+
+# Replay the best sets (first count ranked rows and Pareto optimal rows) again one after the other in this process, return
+# results with their summaries replaced (same success rate and tip error, latencies without CPU sharing) and 'retimed' set
+# in all summaries
+def retimeBestSets(sequence, rows, inputMode, count):
+  selected = [row for (rank, row) in enumerate(rows) if (rank < count) or row[4]]
+  print('Re-timing %d parameter sets on one worker' %(len(selected)))
+  _initializeWorker(sequence)
+  retimed = dict((name, _runParameterSet(name, text, inputMode)) for (name, text, _, _, _) in selected)
+  results = []
+  for (name, text, summary, failures, _) in rows:
+    if name in retimed:
+      (name, text, summary, failures) = retimed[name]
+      summary['retimed'] = True
+    else:
+      summary = collections.OrderedDict((key, value) for (key, value) in summary.items() if key not in ('rank', 'pareto'))
+      summary['retimed'] = False
+    results.append((name, text, summary, failures))
+  return results
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Rank tracking parameter sets on a recorded sequence')
+  parser.add_argument('--base', nargs=2, required=True, metavar=('FIRST', 'SECOND'), help='Base magnitude/real and phase/imaginary NRRD files')
+  parser.add_argument('--first', nargs='+', required=True, help='Magnitude/real frame files (glob patterns, 3D or 4D NRRD)')
+  parser.add_argument('--second', nargs='+', required=True, help='Phase/imaginary frame files (glob patterns, 3D or 4D NRRD)')
+  parser.add_argument('--input-mode', default='MagPhase', choices=['MagPhase', 'RealImag'])
+  predictionGroup = parser.add_mutually_exclusive_group(required=True)
+  predictionGroup.add_argument('--prediction', nargs=3, type=float, metavar=('R', 'A', 'S'), help='Fixed tip prediction (RAS)')
+  predictionGroup.add_argument('--prediction-csv', help='CSV file with one tip prediction (columns R,A,S) per frame')
+  parser.add_argument('--follow', action='store_true', help='Use the last tracked tip as prediction of the next frame')
+  parser.add_argument('--reference-csv', help='CSV file with reference tip positions (columns R,A,S) per frame')
+  timeGroup = parser.add_mutually_exclusive_group()
+  timeGroup.add_argument('--frame-interval', type=float, metavar='SECONDS', help='Acquisition interval of the frames (timestamps of the tip predictor and tip filter)')
+  timeGroup.add_argument('--timestamp-csv', help='CSV file with one acquisition time (column timestamp, s) per frame')
+  parser.add_argument('--param', action='append', default=[], metavar='KEY=VALUES', help='Swept parameter: v1,v2,... or lo:hi:n (grid), lo:hi (random)')
+  parser.add_argument('--fixed', default='', metavar='KEY=VALUE,...', help='Parameters kept for all sets')
+  parser.add_argument('--random', type=int, metavar='N', help='Run N random parameter sets instead of the grid')
+  parser.add_argument('--seed', type=int, default=0, help='Seed of the random sample')
+  parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes')
+  parser.add_argument('--top', type=int, default=10, help='Number of ranked sets printed (and re-timed with Pareto optimal sets)')
+  parser.add_argument('--no-retime', action='store_true', help='Keep the latencies measured on concurrent workers (relative only)')
+  parser.add_argument('--csv', help='Output CSV with all parameter sets')
+  args = parser.parse_args(argv)
+
+  specs = [ParameterSpec.fromText(text) for text in args.param]
+  parameterSets = getRandomSets(specs, args.random, args.seed) if args.random else getGridSets(specs)
+  texts = [formatParameterSet(args.fixed, parameterSet) for parameterSet in parameterSets]
+  if args.fixed not in texts:
+    texts.insert(0, args.fixed)  # Reference: fixed parameters with defaults
+  for text in texts:
+    parseParameters(text, args.input_mode)  # Report invalid parameters before starting the workers
+
+  predictions = args.prediction if args.prediction is not None else loadPointsCSV(args.prediction_csv)
+  references = loadPointsCSV(args.reference_csv) if args.reference_csv else None
+  timestamps = loadTimestampsCSV(args.timestamp_csv) if args.timestamp_csv else None
+  sequence = (args.base, args.first, args.second, predictions, references, args.follow, args.frame_interval, timestamps)
+  workers = max(min(args.workers, len(texts)), 1)
+  if workers > (os.cpu_count() or 1):
+    print('WARNING: %d workers on %d CPUs: latencies are inflated by CPU sharing' %(workers, os.cpu_count() or 1))
+  print('Running %d parameter sets on %d workers' %(len(texts), workers))
+
+  rows = rankResults(runSweep(sequence, texts, args.input_mode, workers))
+  if (workers > 1) and not args.no_retime:
+    rows = rankResults(retimeBestSets(sequence, rows, args.input_mode, args.top))
+  printRanking(rows, args.top)
+  if args.csv:
+    writeResultsCSV(args.csv, rows, [spec.key for spec in specs])
+  return rows
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,168 @@
+# Synthetic needle-artifact phantom for tracker load tests
+#
+# Generates MR frame sequences with a tissue-like magnitude background, background phase wraps, complex noise and a
+# needle susceptibility artifact (chain of magnetic dipoles along the shaft, signal void around it) whose tip moves along
+# a known path. Frames are returned as TrackingFrame (MagPhase or RealImag) or written as NRRD files together with a
+# ground truth CSV that ReplayBenchmark accepts (--reference-csv / --prediction-csv).
+#
+# Usage (from the SimpleNeedleTracking module directory):
+#   python -m SimpleNeedleTrackingLib.PhantomGenerator --output phantom --frames 50 --matrix 256 --slices 3 --noise 0.02
+
+import argparse
+import csv
+import os
+
+import numpy as np
+import SimpleITK as sitk
+
+from .TrackingEngine import ImageGeometry, TrackingFrame
+
+
+# Synthetic needle phantom
+# Needle positions are given in pixel coordinates (column, row, slice) of the image; ground truth is reported in RAS.
+class NeedlePhantom(object):
+
+  def __init__(self, matrixSize=256, numberOfSlices=1, spacing=(1.0, 1.0, 5.0), noiseLevel=0.02, phaseWraps=3.0,
+               signalLevel=200.0, susceptibility=2.0, needleRadius=1.0, b0Direction=(0.0, 1.0, 0.0),
+               entryPoint=None, startTip=None, endTip=None, phaseDriftPerFrame=0.0, phaseDriftGradientPerFrame=0.0, seed=0):
+    self.matrixSize = matrixSize
+    self.numberOfSlices = numberOfSlices
+    self.spacing = tuple(float(v) for v in spacing)
+    self.noiseLevel = noiseLevel                  # Standard deviation of complex noise (fraction of signalLevel)
+    self.phaseWraps = phaseWraps                  # Number of 2*pi cycles of the background phase across the field of view
+    self.signalLevel = signalLevel                # Tissue magnitude
+    self.susceptibility = susceptibility          # Scale of the needle phase perturbation (rad at 1 mm from each dipole)
+    self.needleRadius = needleRadius              # Radius (mm) of the signal void around the needle
+    self.b0Direction = np.asarray(b0Direction, dtype=float)/np.linalg.norm(b0Direction)  # In (column, row, slice) axes
+    self.phaseDriftPerFrame = phaseDriftPerFrame  # Global phase drift (rad/frame), e.g. to emulate B0 drift
+    self.phaseDriftGradientPerFrame = phaseDriftGradientPerFrame  # Linear phase drift (rad/frame at the left/right edges, zero at the center)
+    center = 0.5*(matrixSize-1)
+    middleSlice = 0.5*(numberOfSlices-1)
+    self.entryPoint = np.asarray(entryPoint if entryPoint is not None else (0.1*matrixSize, center, middleSlice), dtype=float)
+    self.startTip = np.asarray(startTip if startTip is not None else (0.3*matrixSize, center, middleSlice), dtype=float)
+    self.endTip = np.asarray(endTip if endTip is not None else (0.7*matrixSize, center, middleSlice), dtype=float)
+    self.random = np.random.default_rng(seed)
+    # Geometry: identity direction, image centered at the origin
+    origin = tuple(-center*self.spacing[0] if axis < 2 else -middleSlice*self.spacing[2] for axis in range(3))
+    self.geometry = ImageGeometry(self.spacing, origin)
+    # Background (needle-free) complex image
+    self.grid = np.meshgrid(np.arange(numberOfSlices), np.arange(matrixSize), np.arange(matrixSize), indexing='ij')
+    self.background = self.createBackground()
+
+  # Return tissue magnitude and wrapped background phase as complex image (slices, rows, columns)
+  def createBackground(self):
+    (z, y, x) = [axis.astype(np.float32) for axis in self.grid]
+    n = float(self.matrixSize)
+    # Elliptical body with smooth tissue texture
+    body = ((x-0.5*n)/(0.45*n))**2 + ((y-0.5*n)/(0.38*n))**2
+    magnitude = self.signalLevel*(body < 1.0)*(0.8 + 0.2*np.cos(6*np.pi*x/n)*np.cos(4*np.pi*y/n))
+    # Smooth background field: linear ramp (phase wraps) plus a quadratic term
+    phase = 2*np.pi*self.phaseWraps*(0.7*x + 0.3*y)/n + 2.0*((x-0.5*n)**2 + (y-0.5*n)**2)/n**2 + 0.1*z
+    return (magnitude*np.exp(1j*phase)).astype(np.complex64)
+
+  # Return tip position (pixel coordinates) at normalized time t (0-1)
+  def getTipIndex(self, t):
+    return self.startTip + t*(self.endTip - self.startTip)
+
+  # Return tip position in 3D Slicer coordinates (RAS)
+  def indexToRAS(self, index):
+    return tuple(float(v) for v in self.geometry.indexToRAS(index))
+
+  # Return needle phase perturbation and magnitude attenuation for the given tip (pixel coordinates)
+  def getNeedleArtifact(self, tipIndex):
+    (z, y, x) = self.grid
+    spacing = np.asarray(self.spacing)
+    length = np.linalg.norm((tipIndex - self.entryPoint)*spacing)
+    numberOfDipoles = max(2, int(length/max(self.needleRadius, 0.5)))
+    phase = np.zeros(x.shape, dtype=np.float32)
+    distance = np.full(x.shape, np.inf, dtype=np.float32)
+    for t in np.linspace(0.0, 1.0, numberOfDipoles):
+      dipole = self.entryPoint + t*(tipIndex - self.entryPoint)
+      # Vector from dipole to voxel (mm)
+      dx = (x - dipole[0])*spacing[0]
+      dy = (y - dipole[1])*spacing[1]
+      dz = (z - dipole[2])*spacing[2]
+      r2 = dx*dx + dy*dy + dz*dz + 0.25*self.needleRadius**2
+      cosTheta2 = (dx*self.b0Direction[0] + dy*self.b0Direction[1] + dz*self.b0Direction[2])**2/r2
+      phase += (self.susceptibility/numberOfDipoles*length)*(3*cosTheta2 - 1)/r2**1.5
+      distance = np.minimum(distance, np.sqrt(r2))
+    attenuation = 1.0 - np.exp(-(distance/(2*self.needleRadius))**2)
+    return (phase, attenuation.astype(np.float32))
+
+  # Return complex image with the needle tip at the given position (pixel coordinates)
+  def getComplexImage(self, tipIndex=None, frameIndex=0):
+    image = self.background.copy()
+    if tipIndex is not None:
+      (phase, attenuation) = self.getNeedleArtifact(tipIndex)
+      image *= attenuation*np.exp(1j*phase)
+    if self.phaseDriftPerFrame:
+      image *= np.exp(1j*self.phaseDriftPerFrame*frameIndex)
+    if self.phaseDriftGradientPerFrame:
+      ramp = (2.0*self.grid[2]/(self.matrixSize-1) - 1.0)
+      image *= np.exp(1j*self.phaseDriftGradientPerFrame*frameIndex*ramp)
+    sigma = self.noiseLevel*self.signalLevel
+    if sigma > 0:
+      image += sigma*(self.random.standard_normal(image.shape) + 1j*self.random.standard_normal(image.shape))
+    return image.astype(np.complex64)
+
+  # Return TrackingFrame from complex image
+  def toFrame(self, image, inputMode, tipPrediction=None):
+    if inputMode == 'RealImag':
+      return TrackingFrame(np.ascontiguousarray(image.real), np.ascontiguousarray(image.imag), self.geometry, tipPrediction)
+    return TrackingFrame(np.abs(image).astype(np.float32), np.angle(image).astype(np.float32), self.geometry, tipPrediction)
+
+  # Return needle-free base frame
+  def getBaseFrame(self, inputMode='MagPhase'):
+    return self.toFrame(self.getComplexImage(), inputMode)
+
+  # Return list of (frame, ground truth tip RAS) with the tip moving from startTip to endTip
+  def getFrames(self, numberOfFrames, inputMode='MagPhase'):
+    frames = []
+    for index in range(numberOfFrames):
+      tipIndex = self.getTipIndex(index/max(numberOfFrames-1, 1))
+      tipRAS = self.indexToRAS(tipIndex)
+      frame = self.toFrame(self.getComplexImage(tipIndex, index+1), inputMode, tipRAS)
+      frames.append((frame, tipRAS))
+    return frames
+
+  # Write base frame, frames and ground truth as NRRD/CSV files in the output directory
+  def writeSequence(self, directory, numberOfFrames, inputMode='MagPhase', compress=True):
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.writeFrame(self.getBaseFrame(inputMode), os.path.join(directory, 'base_first.nrrd'), os.path.join(directory, 'base_second.nrrd'), compress)
+    with open(os.path.join(directory, 'ground_truth.csv'), 'w', newline='') as csvFile:
+      writer = csv.writer(csvFile)
+      writer.writerow(['frame', 'R', 'A', 'S'])
+      for (index, (frame, tipRAS)) in enumerate(self.getFrames(numberOfFrames, inputMode)):
+        self.writeFrame(frame, os.path.join(directory, 'first_%04d.nrrd' %(index)), os.path.join(directory, 'second_%04d.nrrd' %(index)), compress)
+        writer.writerow([index, tipRAS[0], tipRAS[1], tipRAS[2]])
+
+  # Write frame arrays as NRRD files
+  def writeFrame(self, frame, firstPath, secondPath, compress=True):
+    for (array, path) in ((frame.firstArray, firstPath), (frame.secondArray, secondPath)):
+      image = frame.geometry.applyTo(sitk.GetImageFromArray(array))
+      sitk.WriteImage(image, path, compress)
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Generate a synthetic needle tracking sequence')
+  parser.add_argument('--output', required=True, help='Output directory')
+  parser.add_argument('--frames', type=int, default=50)
+  parser.add_argument('--matrix', type=int, default=256, help='Matrix size (pixels)')
+  parser.add_argument('--slices', type=int, default=1)
+  parser.add_argument('--spacing', nargs=3, type=float, default=(1.0, 1.0, 5.0))
+  parser.add_argument('--noise', type=float, default=0.02, help='Noise standard deviation (fraction of the tissue signal)')
+  parser.add_argument('--wraps', type=float, default=3.0, help='Background phase cycles across the field of view')
+  parser.add_argument('--susceptibility', type=float, default=2.0)
+  parser.add_argument('--drift', type=float, default=0.0, help='Global phase drift (rad/frame)')
+  parser.add_argument('--drift-gradient', type=float, default=0.0, help='Left-right linear phase drift (rad/frame at the edges)')
+  parser.add_argument('--input-mode', default='MagPhase', choices=['MagPhase', 'RealImag'])
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args(argv)
+  phantom = NeedlePhantom(args.matrix, args.slices, args.spacing, args.noise, args.wraps, susceptibility=args.susceptibility,
+                          phaseDriftPerFrame=args.drift, phaseDriftGradientPerFrame=args.drift_gradient, seed=args.seed)
+  phantom.writeSequence(args.output, args.frames, args.input_mode)
+  print('Wrote %d frames to %s' %(args.frames, args.output))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,339 @@
+# Offline replay benchmark for the needle tracker
+#
+# Feeds a recorded image sequence through NeedleTrackingEngine (same pipeline as updateBaseImages/getNeedle
+# in SimpleNeedleTrackingLogic) as fast as possible and reports throughput, latency, failures and tip trajectory.
+#
+# Usage (from the SimpleNeedleTracking module directory):
+#   python -m SimpleNeedleTrackingLib.ReplayBenchmark --base mag_base.nrrd phase_base.nrrd \
+#     --first "mag_*.nrrd" --second "phase_*.nrrd" --prediction -20 10 35 --csv tips.csv \
+#     --params default: --params small:roiSize=30,roiUnwrap=True
+
+import argparse
+import collections
+import copy
+import csv
+import glob
+import os
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+from .TrackingEngine import NeedleTrackingEngine, ImageGeometry, TrackingFrame, TrackingParameters
+from .StageProfiler import StageProfiler
+from .DebugImageWriter import DebugImageWriter
+from .TipHistory import TipHistory
+
+
+################################################################################################################################################
+# Sequence loading
+################################################################################################################################################
+
+# Return (array, geometry) list of the frames stored in a file (3D image: one frame, 4D/vector image: one frame per volume)
+def loadFrameArrays(path):
+  image = sitk.ReadImage(path)
+  if image.GetNumberOfComponentsPerPixel() > 1:   # Sequence stored as vector image (e.g. .seq.nrrd)
+    geometry = ImageGeometry.fromImage(sitk.VectorIndexSelectionCast(image, 0))
+    array = sitk.GetArrayFromImage(image)
+    return [(np.ascontiguousarray(array[..., index]), geometry) for index in range(array.shape[-1])]
+  if image.GetDimension() == 4:                   # Sequence stored as 4D image
+    frames = []
+    for index in range(image.GetSize()[3]):
+      volume = image[:,:,:,index]
+      frames.append((sitk.GetArrayFromImage(volume), ImageGeometry.fromImage(volume)))
+    return frames
+  return [(sitk.GetArrayFromImage(image), ImageGeometry.fromImage(image))]
+
+# Return frame arrays of all files matching the patterns (sorted by file name)
+def loadSeries(patterns):
+  if isinstance(patterns, str):
+    patterns = [patterns]
+  paths = []
+  for pattern in patterns:
+    paths.extend(sorted(glob.glob(pattern)) or [pattern])
+  frames = []
+  for path in paths:
+    frames.extend(loadFrameArrays(path))
+  return frames
+
+# Return TrackingFrame list from first (magnitude/real) and second (phase/imaginary) series
+# Frame timestamps (s): timestamps (one per frame), else index*frameInterval, else None (tip predictor and tip filter
+# then assume their default frame interval)
+def loadTrackingFrames(firstPatterns, secondPatterns, frameInterval=None, timestamps=None):
+  firstFrames = loadSeries(firstPatterns)
+  secondFrames = loadSeries(secondPatterns)
+  if len(firstFrames) != len(secondFrames):
+    raise ValueError('Number of first (%d) and second (%d) frames do not match' %(len(firstFrames), len(secondFrames)))
+  if timestamps is None:
+    timestamps = [index*frameInterval if frameInterval is not None else None for index in range(len(firstFrames))]
+  elif len(timestamps) < len(firstFrames):
+    raise ValueError('Missing timestamps: %d timestamps for %d frames' %(len(timestamps), len(firstFrames)))
+  return [TrackingFrame(first[0], second[0], first[1], timestamp=timestamp) for (first, second, timestamp) in zip(firstFrames, secondFrames, timestamps)]
+
+# Return base TrackingFrame from first/second NRRD files
+def loadBaseFrame(firstPath, secondPath):
+  (firstArray, geometry) = loadFrameArrays(firstPath)[0]
+  (secondArray, _) = loadFrameArrays(secondPath)[0]
+  return TrackingFrame(firstArray, secondArray, geometry)
+
+# Return (N,3) array of RAS points from a CSV file with columns R, A, S (one row per frame)
+def loadPointsCSV(path):
+  points = []
+  with open(path, newline='') as csvFile:
+    for row in csv.DictReader(csvFile):
+      points.append((float(row['R']), float(row['A']), float(row['S'])))
+  return np.array(points, dtype=float)
+
+# Return frame timestamps (s) from a CSV file with column timestamp (one row per frame)
+def loadTimestampsCSV(path):
+  with open(path, newline='') as csvFile:
+    return [float(row['timestamp']) for row in csv.DictReader(csvFile)]
+
+
+################################################################################################################################################
+# Benchmark report
+################################################################################################################################################
+
+# Results of one replay run
+class BenchmarkReport(object):
+
+  def __init__(self, name, parameters):
+    self.name = name
+    self.parameters = parameters
+    self.results = []
+    self.latencies = []
+    self.predictions = []
+    self.references = []
+    self.elapsedTime = 0.0
+    self.profiler = StageProfiler(windowSize=None)
+    self.profiler.setEnabled(True)
+
+  # Add result of one frame
+  def addResult(self, result, latency, prediction, reference=None):
+    self.results.append(result)
+    self.latencies.append(latency)
+    self.predictions.append(prediction)
+    self.references.append(reference)
+    self.profiler.addFrame(result.stageTimes)
+
+  def getNumberOfFrames(self):
+    return len(self.results)
+
+  def getNumberOfSuccesses(self):
+    return sum(1 for result in self.results if result.success)
+
+  # Return success ratio (0-1)
+  def getSuccessRate(self):
+    return self.getNumberOfSuccesses()/len(self.results) if self.results else 0.0
+
+  # Return processed frames per second
+  def getThroughput(self):
+    return len(self.results)/self.elapsedTime if self.elapsedTime > 0 else 0.0
+
+  # Return {reason: count} of failed frames
+  def getFailureCounts(self):
+    return collections.Counter(result.reason for result in self.results if not result.success)
+
+  # Return latency statistics (ms)
+  def getLatencyStatistics(self):
+    if not self.latencies:
+      return {'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    latencies = 1000.0 * np.asarray(self.latencies)
+    (p50, p95, p99) = np.percentile(latencies, (50, 95, 99))
+    return {'mean': float(latencies.mean()), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'max': float(latencies.max())}
+
+  # Return distances (mm) between tracked tips and reference points (successful frames with reference only)
+  def getTipErrors(self):
+    errors = [np.linalg.norm(np.subtract(result.tip, reference)) for (result, reference) in zip(self.results, self.references)
+              if result.success and (reference is not None)]
+    return np.array(errors, dtype=float)
+
+  # Write tip trajectory (one row per frame)
+  def writeTrajectoryCSV(self, path):
+    with open(path, 'w', newline='') as csvFile:
+      writer = csv.writer(csvFile)
+      writer.writerow(['frame', 'success', 'reason', 'R', 'A', 'S', 'prediction_R', 'prediction_A', 'prediction_S', 'prediction_error', 'latency_ms', 'reference_error', 'roi_size', 'roi_change'])
+      for (index, result) in enumerate(self.results):
+        tip = result.tip if result.success else ('', '', '')
+        # ROI center used by the engine (Kalman prediction), given prediction if the engine did not report it
+        prediction = result.tipPrediction if result.tipPrediction is not None else self.predictions[index]
+        prediction = prediction if prediction is not None else ('', '', '')
+        reference = self.references[index]
+        referenceError = np.linalg.norm(np.subtract(result.tip, reference)) if (result.success and reference is not None) else ''
+        predictionError = result.predictionError if result.predictionError is not None else ''
+        writer.writerow([index, int(result.success), result.reason or '', tip[0], tip[1], tip[2], prediction[0], prediction[1], prediction[2],
+                         predictionError, 1000.0*self.latencies[index], referenceError, result.roiSize or '', result.roiChange or ''])
+
+  # Return TipHistory with the results of all frames (processing times are not recorded during replay: NaN)
+  def getTipHistory(self):
+    history = TipHistory(max(len(self.results), 1))
+    for result in self.results:
+      history.append(result, processingTime=float('nan'))
+    return history
+
+  # Return one-line summary values
+  def getSummary(self):
+    latency = self.getLatencyStatistics()
+    errors = self.getTipErrors()
+    roiSizes = [result.roiSize for result in self.results if result.roiSize is not None]
+    return collections.OrderedDict([
+      ('name', self.name),
+      ('frames', self.getNumberOfFrames()),
+      ('success', self.getNumberOfSuccesses()),
+      ('success_rate', self.getSuccessRate()),
+      ('fps', self.getThroughput()),
+      ('latency_mean_ms', latency['mean']),
+      ('latency_p50_ms', latency['p50']),
+      ('latency_p95_ms', latency['p95']),
+      ('latency_p99_ms', latency['p99']),
+      ('tip_error_mean_mm', float(errors.mean()) if errors.size else float('nan')),
+      ('tip_error_max_mm', float(errors.max()) if errors.size else float('nan')),
+      ('roi_size_mean', float(np.mean(roiSizes)) if roiSizes else float('nan')),
+    ])
+
+
+################################################################################################################################################
+# Replay benchmark
+################################################################################################################################################
+
+# Replay a recorded sequence through the tracking engine
+# predictions: single RAS point used for all frames, or (N,3) array with one prediction per frame
+# followTip: use the last tracked tip as prediction of the next frame
+# references: optional (N,3) array of ground truth tip positions (RAS) to compute accuracy
+class ReplayBenchmark(object):
+
+  def __init__(self, baseFrame, frames, predictions, references=None, followTip=False):
+    self.baseFrame = baseFrame
+    self.frames = frames
+    predictions = np.asarray(predictions, dtype=float)
+    if predictions.ndim == 1:
+      predictions = np.tile(predictions, (len(frames), 1))
+    if len(predictions) < len(frames):
+      raise ValueError('Missing tip predictions: %d predictions for %d frames' %(len(predictions), len(frames)))
+    self.predictions = predictions
+    self.references = np.asarray(references, dtype=float) if references is not None else None
+    self.followTip = followTip
+
+  # Run all frames with the given parameters and return BenchmarkReport
+  # debugWriter: optional DebugImageWriter receiving the debug images of its sampled frames (base images: frame 0)
+  def run(self, parameters, name='default', debugWriter=None):
+    report = BenchmarkReport(name, parameters)
+    engine = NeedleTrackingEngine()
+    debugParameters = parameters
+    if debugWriter is not None:
+      engine.debugCallback = lambda sitkImage, imageName: debugWriter.put(sitkImage, imageName, engine.count)
+      debugParameters = copy.copy(parameters)
+      debugParameters.debugFlag = True
+    engine.setBaseFrame(self.baseFrame, debugParameters)
+    prediction = tuple(self.predictions[0])
+    runStart = time.perf_counter()
+    for (index, frame) in enumerate(self.frames):
+      if not self.followTip:
+        prediction = tuple(self.predictions[index])
+      frame = TrackingFrame(frame.firstArray, frame.secondArray, frame.geometry, prediction, frame.timestamp)
+      frameStart = time.perf_counter()
+      result = engine.trackFrame(frame, debugParameters if (debugWriter is not None and debugWriter.isSampled(index + 1)) else parameters)
+      latency = time.perf_counter() - frameStart
+      if debugWriter is not None:
+        debugWriter.endFrame()
+      reference = tuple(self.references[index]) if (self.references is not None and index < len(self.references)) else None
+      report.addResult(result, latency, prediction, reference)
+      if self.followTip and result.success:
+        prediction = result.tip
+    report.elapsedTime = time.perf_counter() - runStart
+    engine.shutdownUnwrapPool()
+    return report
+
+
+################################################################################################################################################
+# Command line
+################################################################################################################################################
+
+# Return TrackingParameters from 'key=value,key=value' (values parsed as the type of the default)
+def parseParameters(text, inputMode='MagPhase'):
+  parameters = TrackingParameters(inputMode=inputMode)
+  for item in [item for item in text.split(',') if item.strip()]:
+    (key, value) = [part.strip() for part in item.split('=', 1)]
+    if not hasattr(parameters, key):
+      raise ValueError('Unknown tracking parameter: %s' %(key))
+    default = getattr(parameters, key)
+    if isinstance(default, bool):
+      value = value.lower() in ('1', 'true', 'yes', 'on')
+    elif isinstance(default, (int, float)):
+      value = type(default)(float(value)) if isinstance(default, int) else float(value)
+    setattr(parameters, key, value)
+  return parameters
+
+# Print reports side by side
+def printReports(reports):
+  summaries = [report.getSummary() for report in reports]
+  for key in summaries[0].keys():
+    values = []
+    for summary in summaries:
+      value = summary[key]
+      values.append('%16.3f' %(value) if isinstance(value, float) else '%16s' %(value))
+    print('%-32s%s' %(key, ''.join(values)))
+  reasons = sorted(set(reason for report in reports for reason in report.getFailureCounts()))
+  for reason in reasons:
+    print('%-32s%s' %(reason[:31], ''.join('%16d' %(report.getFailureCounts().get(reason, 0)) for report in reports)))
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Replay a recorded sequence through the needle tracker')
+  parser.add_argument('--base', nargs=2, required=True, metavar=('FIRST', 'SECOND'), help='Base magnitude/real and phase/imaginary NRRD files')
+  parser.add_argument('--first', nargs='+', required=True, help='Magnitude/real frame files (glob patterns, 3D or 4D NRRD)')
+  parser.add_argument('--second', nargs='+', required=True, help='Phase/imaginary frame files (glob patterns, 3D or 4D NRRD)')
+  parser.add_argument('--input-mode', default='MagPhase', choices=['MagPhase', 'RealImag'])
+  predictionGroup = parser.add_mutually_exclusive_group(required=True)
+  predictionGroup.add_argument('--prediction', nargs=3, type=float, metavar=('R', 'A', 'S'), help='Fixed tip prediction (RAS)')
+  predictionGroup.add_argument('--prediction-csv', help='CSV file with one tip prediction (columns R,A,S) per frame')
+  parser.add_argument('--follow', action='store_true', help='Use the last tracked tip as prediction of the next frame')
+  parser.add_argument('--reference-csv', help='CSV file with reference tip positions (columns R,A,S) per frame')
+  timeGroup = parser.add_mutually_exclusive_group()
+  timeGroup.add_argument('--frame-interval', type=float, metavar='SECONDS', help='Acquisition interval of the frames (timestamps of the tip predictor and tip filter)')
+  timeGroup.add_argument('--timestamp-csv', help='CSV file with one acquisition time (column timestamp, s) per frame')
+  parser.add_argument('--params', action='append', default=[], metavar='NAME:KEY=VALUE,...', help='Parameter set to run (repeat to compare sets)')
+  parser.add_argument('--csv', help='Output CSV of the tip trajectory (name of the parameter set is appended when comparing sets)')
+  parser.add_argument('--history', help='Output tip history (.npy or .csv) of all results (name of the parameter set is appended when comparing sets)')
+  parser.add_argument('--stages', action='store_true', help='Print per-stage latency statistics')
+  parser.add_argument('--debug-dir', help='Write debug images of the sampled frames to this directory (subdirectory per parameter set when comparing sets)')
+  parser.add_argument('--debug-interval', type=int, default=1, help='Write debug images of every N-th frame')
+  parser.add_argument('--debug-compress', action='store_true', help='Compress debug images')
+  args = parser.parse_args(argv)
+
+  baseFrame = loadBaseFrame(args.base[0], args.base[1])
+  timestamps = loadTimestampsCSV(args.timestamp_csv) if args.timestamp_csv else None
+  frames = loadTrackingFrames(args.first, args.second, args.frame_interval, timestamps)
+  predictions = args.prediction if args.prediction is not None else loadPointsCSV(args.prediction_csv)
+  references = loadPointsCSV(args.reference_csv) if args.reference_csv else None
+  benchmark = ReplayBenchmark(baseFrame, frames, predictions, references, args.follow)
+  print('Loaded %d frames' %(len(frames)))
+
+  parameterSets = args.params or ['default:']
+  reports = []
+  for parameterSet in parameterSets:
+    (name, _, text) = parameterSet.partition(':')
+    parameters = parseParameters(text, args.input_mode)
+    debugWriter = None
+    if args.debug_dir:
+      path = args.debug_dir if len(parameterSets) == 1 else os.path.join(args.debug_dir, name)
+      debugWriter = DebugImageWriter(path, args.debug_interval, args.debug_compress)
+      debugWriter.start()
+    report = benchmark.run(parameters, name, debugWriter)
+    reports.append(report)
+    if debugWriter is not None:
+      debugWriter.stop()
+      print('[%s] %s' %(name, debugWriter.formatStatistics()))
+    if args.csv:
+      path = args.csv if len(parameterSets) == 1 else args.csv.replace('.csv', '') + '_%s.csv' %(name)
+      report.writeTrajectoryCSV(path)
+    if args.history:
+      (root, extension) = os.path.splitext(args.history)
+      report.getTipHistory().export(args.history if len(parameterSets) == 1 else '%s_%s%s' %(root, name, extension))
+    if args.stages:
+      print('[%s]' %(name))
+      print(report.profiler.formatStatistics())
+  printReports(reports)
+  return reports
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,80 @@
+import time
+
+import numpy as np
+
+
+################################################################################################################################################
+# Robot tip prior
+################################################################################################################################################
+
+# Tip prediction (RAS) from the robot pose with fallback to the last detection
+# The pose is the CURRENT_POSITION transform streamed by the robot (ProstateBRPInterface: CurrentPositionTransform): the
+# needle tip/guide at the origin, the needle axis (insertion direction) along the third column. The predicted tip is the
+# pose origin plus insertionDepth (mm) along the axis. A pose older than maximumAge (s) is stale: the last detected tip
+# is returned instead (None without detection, the caller keeps its own tip prediction).
+class RobotTipPrior(object):
+
+  SOURCE_ROBOT = 'Robot'
+  SOURCE_DETECTION = 'Detection'
+
+  def __init__(self, insertionDepth=0.0, maximumAge=2.0):
+    self.insertionDepth = insertionDepth  # Commanded insertion depth (mm) beyond the pose origin
+    self.maximumAge = maximumAge          # Age (s) after which the pose is stale
+    self.reset()
+
+  # Forget pose and detection
+  def reset(self):
+    self.position = None        # Pose origin (RAS)
+    self.axis = None            # Unit needle axis (RAS)
+    self.poseTime = None        # Time (s) the pose was received (None: age unknown, stale)
+    self.detection = None       # Last detected tip (RAS)
+    self.source = None          # Source of the last prediction
+    self.skippedFrames = 0      # Frames skipped because the predicted tip was outside the image
+
+  # Set robot pose (4x4 matrix to RAS) received at receiveTime (s, time.time() if None)
+  # stale: pose of unknown age (e.g. already in the scene when tracking starts), used only after the next update
+  def setPose(self, matrix, receiveTime=None, stale=False):
+    matrix = np.asarray(matrix, dtype=float)
+    axis = matrix[:3,2]
+    norm = np.linalg.norm(axis)
+    if norm == 0:
+      return
+    self.position = matrix[:3,3].copy()
+    self.axis = axis/norm
+    self.poseTime = None if stale else (receiveTime if receiveTime is not None else time.time())
+
+  # Set last detected tip (RAS)
+  def setDetection(self, tip):
+    self.detection = tuple(float(v) for v in tip)
+
+  # Return age (s) of the pose (None if there is no pose or its age is unknown)
+  def getPoseAge(self, now=None):
+    if (self.position is None) or (self.poseTime is None):
+      return None
+    return (now if now is not None else time.time()) - self.poseTime
+
+  # Return True if the pose is younger than maximumAge
+  def isPoseFresh(self, now=None):
+    age = self.getPoseAge(now)
+    return (age is not None) and (age <= self.maximumAge)
+
+  # Return predicted tip (RAS) of the pose
+  def getPoseTip(self):
+    return tuple(float(v) for v in self.position + self.insertionDepth*self.axis)
+
+  # Return (predicted tip (RAS), source) from the fresh pose or the last detection, (None, None) if there is neither
+  def getTipPrediction(self, now=None):
+    if self.isPoseFresh(now):
+      self.source = RobotTipPrior.SOURCE_ROBOT
+      return (self.getPoseTip(), self.source)
+    self.source = RobotTipPrior.SOURCE_DETECTION if self.detection is not None else None
+    return (self.detection, self.source)
+
+  # Return True if the tip (RAS) lies in the image or less than margin (mm) outside of it
+  # geometry: ImageGeometry, shape: array shape [slice, row, column]
+  @staticmethod
+  def isInsideImage(tip, geometry, shape, margin=0.0):
+    index = geometry.rasToIndex(tip)  # (column, row, slice)
+    marginIndex = margin/np.asarray(geometry.spacing)
+    size = np.asarray(shape[::-1], dtype=float)
+    return bool(np.all(index >= -0.5 - marginIndex) and np.all(index <= size - 0.5 + marginIndex))
@@ -0,0 +1,82 @@
+import collections
+import time
+
+import numpy as np
+
+
+# Pipeline stages in processing order ('pull' is measured by the Slicer adapter, 'predict' only runs with the Kalman tip
+# predictor, 'baseline' only with the rolling baseline, 'total' covers the engine stages)
+STAGES = ('pull', 'predict', 'convert', 'unwrap', 'difference', 'roi', 'gradient', 'blobs', 'tip', 'baseline', 'total')
+
+
+################################################################################################################################################
+# Stage timer
+################################################################################################################################################
+
+# Time consecutive stages of one tracking cycle (seconds)
+class StageTimer(object):
+
+  def __init__(self):
+    self.times = {}
+    self.startTime = time.perf_counter()
+    self.lastTime = self.startTime
+
+  # Record the time elapsed since the previous mark as the given stage
+  def mark(self, stage):
+    now = time.perf_counter()
+    self.times[stage] = self.times.get(stage, 0.0) + (now - self.lastTime)
+    self.lastTime = now
+
+  # Record total time and return all stage times
+  def finish(self):
+    self.times['total'] = time.perf_counter() - self.startTime
+    return self.times
+
+
+################################################################################################################################################
+# Stage profiler
+################################################################################################################################################
+
+# Rolling latency statistics per stage over the last windowSize frames
+class StageProfiler(object):
+
+  def __init__(self, windowSize=200):
+    self.enabled = False
+    self.windowSize = windowSize
+    self.samples = {}
+
+  # Enable/disable collection (statistics are kept)
+  def setEnabled(self, enabled):
+    self.enabled = enabled
+
+  # Clear all samples
+  def reset(self):
+    self.samples = {}
+
+  # Add stage times (seconds) of one tracking cycle
+  def addFrame(self, stageTimes):
+    if (not self.enabled) or (not stageTimes):
+      return
+    for (stage, duration) in stageTimes.items():
+      if stage not in self.samples:
+        self.samples[stage] = collections.deque(maxlen=self.windowSize)
+      self.samples[stage].append(duration)
+
+  # Return {stage: {'count', 'mean', 'p50', 'p95', 'p99'}} in milliseconds, stages in processing order
+  def getStatistics(self):
+    statistics = collections.OrderedDict()
+    stages = [stage for stage in STAGES if stage in self.samples] + sorted(stage for stage in self.samples if stage not in STAGES)
+    for stage in stages:
+      values = 1000.0 * np.asarray(self.samples[stage])
+      if values.size == 0:
+        continue
+      (p50, p95, p99) = np.percentile(values, (50, 95, 99))
+      statistics[stage] = {'count': int(values.size), 'mean': float(values.mean()), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99)}
+    return statistics
+
+  # Return statistics as printable table
+  def formatStatistics(self):
+    lines = ['%-12s %6s %9s %9s %9s %9s' %('Stage', 'N', 'Mean(ms)', 'p50(ms)', 'p95(ms)', 'p99(ms)')]
+    for (stage, values) in self.getStatistics().items():
+      lines.append('%-12s %6d %9.2f %9.2f %9.2f %9.2f' %(stage, values['count'], values['mean'], values['p50'], values['p95'], values['p99']))
+    return '\n'.join(lines)
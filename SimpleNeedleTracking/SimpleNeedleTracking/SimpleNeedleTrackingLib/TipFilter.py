@@ -0,0 +1,95 @@
+import math
+
+import numpy as np
+
+
+################################################################################################################################################
+# Temporal tip filter
+################################################################################################################################################
+
+# Temporal smoothing of the tracked tip (RAS, mm) of one needle with outlier rejection
+# Modes: 'Median' (component-wise median of the window), 'AlphaBeta' (alpha-beta position/velocity filter) or 'OneEuro'
+# (low-pass filter whose cutoff frequency increases with the tip speed: smooth at rest, responsive while inserting).
+# A detection farther than outlierDistance (mm) from the median of the window is rejected once the window holds
+# minimumSamples tips; after maximumRejections consecutive rejections the needle is assumed to have moved and the filter
+# restarts from the detection. Time steps are taken from frame timestamps (s); frames without timestamp advance the filter
+# by one time unit.
+class TipFilter(object):
+
+  MODES = ('Median', 'AlphaBeta', 'OneEuro')
+
+  def __init__(self, mode='Median', window=5, outlierDistance=10.0, minimumSamples=3, maximumRejections=3, alpha=0.5, beta=0.1,
+               minimumCutoff=0.5, speedCoefficient=0.05, derivativeCutoff=1.0):
+    if mode not in TipFilter.MODES:
+      raise ValueError('Unknown tip filter mode: %s' %(mode))
+    self.mode = mode
+    self.window = max(int(window), 1)                 # Number of recent detections kept
+    self.outlierDistance = outlierDistance            # Rejection distance (mm) from the window median (0: no rejection)
+    self.minimumSamples = minimumSamples              # Detections in the window before outliers are rejected
+    self.maximumRejections = maximumRejections        # Consecutive rejections before the filter restarts
+    self.alpha = alpha                                # Alpha-beta: position and velocity gains
+    self.beta = beta
+    self.minimumCutoff = minimumCutoff                # One-euro: cutoff frequency (Hz) at rest
+    self.speedCoefficient = speedCoefficient          # One-euro: cutoff increase per speed unit (Hz per mm/s)
+    self.derivativeCutoff = derivativeCutoff          # One-euro: cutoff frequency (Hz) of the speed estimate
+    self.tips = np.empty((self.window, 3))
+    self.reset()
+
+  # Forget all detections
+  def reset(self):
+    self.count = 0          # Detections added to the window
+    self.rejections = 0
+    self.position = None    # Filtered tip
+    self.velocity = None    # Alpha-beta velocity / one-euro speed estimate (mm per time unit)
+    self.timestamp = None
+
+  # Return distance (mm) of a detection from the median of the window (None if the window is too short to judge)
+  def getOutlierDistance(self, tip):
+    if self.count < min(self.minimumSamples, self.window):
+      return None
+    return float(np.linalg.norm(np.asarray(tip, dtype=float) - np.median(self.tips[:min(self.count, self.window)], axis=0)))
+
+  # Return time step (s) from the last detection to the timestamp
+  def getTimeStep(self, timestamp):
+    if (timestamp is None) or (self.timestamp is None):
+      return 1.0
+    return max(timestamp - self.timestamp, 1e-3)
+
+  # Return smoothing factor of an exponential low-pass filter with the cutoff frequency (Hz, scalar or per component) for the time step (s)
+  @staticmethod
+  def getSmoothingFactor(timeStep, cutoff):
+    tau = 1.0/(2.0*math.pi*cutoff)
+    return 1.0/(1.0 + tau/timeStep)
+
+  # Add a detected tip (RAS), return the filtered tip or None if the detection was rejected as outlier
+  def update(self, tip, timestamp=None):
+    tip = np.asarray(tip, dtype=float)
+    distance = self.getOutlierDistance(tip)
+    if (self.outlierDistance > 0) and (distance is not None) and (distance > self.outlierDistance):
+      self.rejections += 1
+      if self.rejections < self.maximumRejections:
+        return None
+      self.reset()  # Persistent jump: the needle moved, restart from this detection
+    self.rejections = 0
+    timeStep = self.getTimeStep(timestamp)
+    self.tips[self.count % self.window] = tip
+    self.count += 1
+    if self.position is None:
+      self.position = tip.copy()
+      self.velocity = np.zeros(3)
+    elif self.mode == 'Median':
+      self.position = np.median(self.tips[:min(self.count, self.window)], axis=0)
+    elif self.mode == 'AlphaBeta':
+      predicted = self.position + timeStep*self.velocity
+      residual = tip - predicted
+      self.position = predicted + self.alpha*residual
+      self.velocity = self.velocity + (self.beta/timeStep)*residual
+    else:
+      speedFactor = self.getSmoothingFactor(timeStep, self.derivativeCutoff)
+      self.velocity = speedFactor*(tip - self.position)/timeStep + (1.0 - speedFactor)*self.velocity
+      cutoff = self.minimumCutoff + self.speedCoefficient*np.abs(self.velocity)
+      factor = self.getSmoothingFactor(timeStep, cutoff)
+      self.position = factor*tip + (1.0 - factor)*self.position
+    if timestamp is not None:
+      self.timestamp = timestamp
+    return tuple(float(v) for v in self.position)
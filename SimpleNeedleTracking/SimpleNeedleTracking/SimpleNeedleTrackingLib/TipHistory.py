@@ -0,0 +1,132 @@
+import time
+
+import numpy as np
+
+
+# Record of one tracking result (one row per frame and needle); NaN: value not available (e.g. no tip for failed frames)
+TIP_HISTORY_DTYPE = np.dtype([
+  ('frame', np.int64),                # Sequence counter of the engine
+  ('needle', np.int16),               # Needle index (order of the tip predictions)
+  ('acquisitionTime', np.float64),    # Timestamp (s) of the tracked frame
+  ('processingTime', np.float64),     # Time (s) the result was recorded
+  ('latency', np.float32),            # Processing time (s) of the tracking pipeline
+  ('success', np.bool_),
+  ('failureCode', np.int16),          # Index in FAILURE_REASONS (0: success, -1: unknown reason)
+  ('tip', np.float64, (3,)),          # Tracked tip (RAS, smoothed if a tip filter is used)
+  ('rawTip', np.float64, (3,)),       # Detected tip (RAS) before smoothing or outlier rejection
+  ('prediction', np.float64, (3,)),   # Tip prediction (RAS) the ROI was centered on
+  ('predictionError', np.float32),    # Distance (mm) between detection and prediction
+  ('roiSize', np.int16),
+  ('gradientMean', np.float32),
+  ('blobCount', np.int32),            # -1: blobs not detected (pipeline stopped before Step 5)
+  ('blobSize', np.float32),
+  ('blobElongation', np.float32),
+  ('blobFlatness', np.float32),
+  ('mahalanobisDistance', np.float32),
+])
+
+# CSV columns of the record fields (vector fields are split into R, A, S columns)
+def _getCSVColumns():
+  columns = []
+  for name in TIP_HISTORY_DTYPE.names:
+    if TIP_HISTORY_DTYPE[name].shape:
+      columns.extend([(name, axis, '%s_%s' %(name, suffix)) for (axis, suffix) in enumerate('RAS')])
+    else:
+      columns.append((name, None, name))
+  return columns
+
+
+################################################################################################################################################
+# Tip history
+################################################################################################################################################
+
+# Fixed-capacity ring buffer of tracking results backed by a structured numpy array
+# append() writes one record in place (the oldest record is overwritten once the buffer is full); getRecords() returns the
+# records in chronological order for analysis, temporal filtering or export (.npy/CSV).
+class TipHistory(object):
+
+  def __init__(self, capacity=20000):
+    self.capacity = max(int(capacity), 1)
+    self.records = np.zeros(self.capacity, dtype=TIP_HISTORY_DTYPE)
+    self.count = 0  # Number of records appended since the last clear()
+
+  def __len__(self):
+    return min(self.count, self.capacity)
+
+  # Remove all records
+  def clear(self):
+    self.count = 0
+
+  # Record a tracking result (processingTime: time.time() if None)
+  def append(self, result, needle=0, processingTime=None):
+    record = self.records[self.count % self.capacity]
+    record['frame'] = result.frame
+    record['needle'] = needle
+    record['acquisitionTime'] = result.timestamp if result.timestamp is not None else np.nan
+    record['processingTime'] = processingTime if processingTime is not None else time.time()
+    record['latency'] = result.stageTimes.get('total', np.nan)
+    record['success'] = result.success
+    record['failureCode'] = result.getFailureCode()
+    record['tip'] = result.tip if result.tip is not None else np.nan
+    rawTip = result.rawTip if result.rawTip is not None else result.tip
+    record['rawTip'] = rawTip if rawTip is not None else np.nan
+    record['prediction'] = result.tipPrediction if result.tipPrediction is not None else np.nan
+    record['predictionError'] = result.predictionError if result.predictionError is not None else np.nan
+    record['roiSize'] = result.roiSize if result.roiSize is not None else -1
+    record['gradientMean'] = result.gradientMean if result.gradientMean is not None else np.nan
+    record['blobCount'] = result.blobCount if result.blobCount is not None else -1
+    record['blobSize'] = result.blobSize if result.blobSize is not None else np.nan
+    record['blobElongation'] = result.blobElongation if result.blobElongation is not None else np.nan
+    record['blobFlatness'] = result.blobFlatness if result.blobFlatness is not None else np.nan
+    record['mahalanobisDistance'] = result.mahalanobisDistance if result.mahalanobisDistance is not None else np.nan
+    self.count += 1
+
+  # Record the results of one frame (one result per needle)
+  def appendResults(self, results, processingTime=None):
+    processingTime = processingTime if processingTime is not None else time.time()
+    for (needle, result) in enumerate(results):
+      self.append(result, needle, processingTime)
+
+  # Return records in chronological order (copy)
+  def getRecords(self):
+    if self.count <= self.capacity:
+      return self.records[:self.count].copy()
+    start = self.count % self.capacity
+    return np.concatenate((self.records[start:], self.records[:start]))
+
+  # Return the last count records of the needle (all needles if None) in chronological order
+  def getLatest(self, count=1, needle=None):
+    records = self.getRecords()
+    if needle is not None:
+      records = records[records['needle'] == needle]
+    return records[-count:] if count > 0 else records[:0]
+
+  # Save records as .npy file (load with TipHistory.load or np.load)
+  def save(self, path):
+    np.save(path, self.getRecords())
+
+  # Write records as CSV file (one column per field, R/A/S columns for points)
+  def writeCSV(self, path):
+    records = self.getRecords()
+    columns = _getCSVColumns()
+    values = np.column_stack([records[name][:, axis] if axis is not None else records[name] for (name, axis, _) in columns]) if len(records) else \
+             np.zeros((0, len(columns)))
+    formats = ['%d' if TIP_HISTORY_DTYPE[name].base.kind in 'iub' else '%.6f' for (name, _, _) in columns]
+    np.savetxt(path, values, fmt=formats, delimiter=',', header=','.join(header for (_, _, header) in columns), comments='')
+
+  # Write records as .npy (default) or CSV file depending on the extension of path
+  def export(self, path):
+    if path.lower().endswith('.csv'):
+      self.writeCSV(path)
+    else:
+      self.save(path)
+
+  # Return TipHistory with the records of a .npy file
+  @staticmethod
+  def load(path, capacity=None):
+    records = np.load(path)
+    history = TipHistory(capacity if capacity is not None else max(len(records), 1))
+    records = records[-history.capacity:]
+    history.records[:len(records)] = records
+    history.count = len(records)
+    return history
@@ -0,0 +1,107 @@
+import math
+
+import numpy as np
+
+
+################################################################################################################################################
+# Kalman tip predictor
+################################################################################################################################################
+
+# Constant-velocity Kalman filter of the needle tip position (RAS, mm) and velocity
+# Time steps are taken from frame timestamps (s); frames without timestamp advance the filter by frameInterval. The noise
+# defaults are calibrated on replayed insertions of 1-3 mm per frame at about one frame per second (detections 2-3 mm off
+# the tip), so set frameInterval to the acquisition interval when timestamps are missing.
+# The filter is initialized from the first accepted detection and reset after maximumMisses consecutive frames without
+# an accepted detection, so the caller falls back to its own (fixed) tip prediction.
+class TipPredictor(object):
+
+  def __init__(self, processNoise=1.0, measurementNoise=2.0, initialVelocityVariance=4.0, maximumMisses=10, frameInterval=1.0):
+    self.processNoise = processNoise                        # Spectral density of the acceleration noise (mm^2/s^3)
+    self.measurementNoise = measurementNoise                # Standard deviation of a tip detection (mm)
+    self.initialVelocityVariance = initialVelocityVariance  # Velocity variance after initialization ((mm/s)^2)
+    self.maximumMisses = maximumMisses                      # Consecutive misses before the filter is reset
+    self.frameInterval = frameInterval                      # Time step (s) of frames without timestamp
+    self.reset()
+
+  # Forget the tip state
+  def reset(self):
+    self.state = None       # (R, A, S, vR, vA, vS)
+    self.covariance = None
+    self.timestamp = None
+    self.misses = 0
+
+  # Return True if the filter has a tip state
+  def isInitialized(self):
+    return self.state is not None
+
+  # Initialize the state at a detected tip position with zero velocity
+  def initialize(self, position, timestamp=None):
+    self.state = np.concatenate([np.asarray(position, dtype=float), np.zeros(3)])
+    self.covariance = np.diag([self.measurementNoise**2]*3 + [self.initialVelocityVariance]*3)
+    self.timestamp = timestamp
+    self.misses = 0
+
+  # Return time step (s) from the last state to the timestamp (frameInterval without timestamps)
+  def getTimeStep(self, timestamp):
+    if (timestamp is None) or (self.timestamp is None):
+      return self.frameInterval
+    return max(timestamp - self.timestamp, 0.0)
+
+  # Advance the state to the timestamp and return the predicted tip position (RAS)
+  def predict(self, timestamp=None):
+    dt = self.getTimeStep(timestamp)
+    transition = np.eye(6)
+    transition[:3,3:] = dt*np.eye(3)
+    # Continuous white noise acceleration model
+    q = self.processNoise
+    processCovariance = np.kron(np.array([[dt**3/3, dt**2/2], [dt**2/2, dt]])*q, np.eye(3))
+    self.state = transition.dot(self.state)
+    self.covariance = transition.dot(self.covariance).dot(transition.T) + processCovariance
+    if timestamp is not None:
+      self.timestamp = timestamp
+    return self.getPosition()
+
+  # Return the tip position (RAS)
+  def getPosition(self):
+    return tuple(float(v) for v in self.state[:3])
+
+  # Return the tip velocity (RAS, mm/s)
+  def getVelocity(self):
+    return tuple(float(v) for v in self.state[3:])
+
+  # Return covariance of the position (3x3, mm^2)
+  def getPositionCovariance(self):
+    return self.covariance[:3,:3]
+
+  # Return innovation covariance of a tip detection (3x3, mm^2)
+  def getInnovationCovariance(self):
+    return self.getPositionCovariance() + (self.measurementNoise**2)*np.eye(3)
+
+  # Return Mahalanobis distance of a detected tip position (RAS) from the predicted position
+  def getMahalanobisDistance(self, position):
+    innovation = np.asarray(position, dtype=float) - self.state[:3]
+    return math.sqrt(float(innovation.dot(np.linalg.solve(self.getInnovationCovariance(), innovation))))
+
+  # Correct the state with a detected tip position (RAS)
+  def update(self, position):
+    innovation = np.asarray(position, dtype=float) - self.state[:3]
+    gain = self.covariance[:,:3].dot(np.linalg.inv(self.getInnovationCovariance()))
+    self.state = self.state + gain.dot(innovation)
+    # Joseph form keeps the covariance symmetric positive definite
+    correction = np.eye(6)
+    correction[:,:3] -= gain
+    self.covariance = correction.dot(self.covariance).dot(correction.T) + (self.measurementNoise**2)*gain.dot(gain.T)
+    self.misses = 0
+
+  # Record a frame without accepted detection (the filter is reset after maximumMisses consecutive misses)
+  def miss(self):
+    self.misses += 1
+    if self.misses >= self.maximumMisses:
+      self.reset()
+
+  # Return ROI size (pixels) widened by the position uncertainty beyond the measurement noise
+  # spacing: (column, row, slice) pixel spacing (mm), gate: Mahalanobis gate (standard deviations)
+  def getROISize(self, roiSize, spacing, gate, maximumScale=3.0):
+    sigma = math.sqrt(max(float(np.linalg.eigvalsh(self.getPositionCovariance())[-1]), 0.0))
+    margin = gate*max(sigma - self.measurementNoise, 0.0)/min(spacing[0], spacing[1])
+    return int(min(roiSize + 2*math.ceil(margin), math.ceil(maximumScale*roiSize)))
@@ -0,0 +1,1078 @@
+import concurrent.futures
+import copy
+import multiprocessing
+import os
+import shutil
+import sys
+
+import SimpleITK as sitk
+import numpy as np
+from scipy import ndimage
+from skimage.restoration import unwrap_phase
+
+from math import sqrt, pow
+
+from .StageProfiler import StageTimer
+from .TipPredictor import TipPredictor
+from .TipFilter import TipFilter
+from .AdaptiveROIPolicy import AdaptiveROIPolicy
+
+
+# Failure reasons reported in TrackingResult.reason
+FAILURE_NOT_INITIALIZED = 'Mag/Phase base images were not initialized'
+FAILURE_INVALID_ROI = 'Invalid ROI'
+FAILURE_EMPTY_PHASE_DIFF = 'Probably empty phase diff, gradient mostly noise'
+FAILURE_NO_CENTROIDS = 'No centroids found'
+FAILURE_TIP_TOO_FAR = 'Tip too far from prediction'
+FAILURE_OUTSIDE_GATE = 'Tip outside Kalman prediction gate'
+FAILURE_OUTLIER = 'Tip rejected as outlier of the recent tips'
+FAILURE_FRAME_SKIPPED = 'Frame skipped: robot tip prediction outside the image'  # Frame not tracked by the Slicer adapter (robot coupling)
+# Failure codes (index in this tuple, 0: success) used where reasons are stored as numbers (e.g. TipHistory)
+FAILURE_REASONS = (None, FAILURE_NOT_INITIALIZED, FAILURE_INVALID_ROI, FAILURE_EMPTY_PHASE_DIFF, FAILURE_NO_CENTROIDS, FAILURE_TIP_TOO_FAR, FAILURE_OUTSIDE_GATE,
+                   FAILURE_OUTLIER, FAILURE_FRAME_SKIPPED)
+
+
+# Axis signs between ITK (LPS) and 3D Slicer (RAS) coordinates
+LPS_TO_RAS = np.array([-1.0, -1.0, 1.0])
+
+
+# Return Python interpreter that runs spawned worker processes, None if there is none
+# Inside 3D Slicer sys.executable is the Slicer application, which cannot run them: its PythonSlicer launcher (next to the
+# application or on the PATH) is used instead.
+def getPythonExecutable():
+  if os.path.basename(sys.executable).lower().startswith('python'):
+    return sys.executable
+  name = 'PythonSlicer.exe' if os.name == 'nt' else 'PythonSlicer'
+  directory = os.path.dirname(sys.executable)
+  for path in (os.path.join(directory, name), os.path.join(directory, 'bin', name)):
+    if os.path.isfile(path):
+      return path
+  return shutil.which(name)
+
+# Return 'spawn' multiprocessing context running getPythonExecutable(), None if worker processes are not available
+def getSpawnContext():
+  executable = getPythonExecutable()
+  if executable is None:
+    return None
+  context = multiprocessing.get_context('spawn')
+  context.set_executable(executable)
+  return context
+
+# Unwrap one 2D phase slice (bool background: pixels to ignore), at module level so that process pools can run it
+def _unwrapSlice(array_p, array_background):
+  return unwrap_phase(np.ma.MaskedArray(array_p, mask=array_background, copy=False), wrap_around=(False,False)).data
+
+
+################################################################################################################################################
+# Image geometry
+################################################################################################################################################
+
+# Physical metadata of a volume in ITK convention (LPS, numpy arrays indexed as [slice, row, column])
+# Points are converted between 3D Slicer coordinates (RAS) and pixel indexes (column, row, slice) with 4x4 affine matrices
+# built from spacing, origin and direction on first use (oblique planes included); conversions take one point or an (N, 3)
+# array of points (one matrix multiply for all needles/blobs).
+class ImageGeometry(object):
+
+  def __init__(self, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0), direction=(1, 0, 0, 0, 1, 0, 0, 0, 1)):
+    self.spacing = tuple(float(v) for v in spacing)
+    self.origin = tuple(float(v) for v in origin)
+    self.direction = tuple(float(v) for v in direction)
+    self.indexToRASMatrix = None
+    self.rasToIndexMatrix = None
+
+  # Return geometry of a SimpleITK image
+  @staticmethod
+  def fromImage(sitkImage):
+    return ImageGeometry(sitkImage.GetSpacing(), sitkImage.GetOrigin(), sitkImage.GetDirection())
+
+  # Copy geometry to a SimpleITK image
+  def applyTo(self, sitkImage):
+    sitkImage.SetSpacing(self.spacing)
+    sitkImage.SetOrigin(self.origin)
+    sitkImage.SetDirection(self.direction)
+    return sitkImage
+
+  # Return physical point (LPS) of a pixel index (column, row, slice)
+  def indexToPhysicalPoint(self, index):
+    direction = np.reshape(self.direction, (3, 3))
+    return tuple(float(v) for v in np.asarray(self.origin) + direction.dot(np.asarray(index, dtype=float)*np.asarray(self.spacing)))
+
+  # Return geometry of the sub-region starting at the given pixel index (column, row, slice)
+  def getRegionGeometry(self, index):
+    return ImageGeometry(self.spacing, self.indexToPhysicalPoint(index), self.direction)
+
+  # Return 4x4 affine from pixel index (column, row, slice, 1) to 3D Slicer coordinates (RAS, 1)
+  def getIndexToRASMatrix(self):
+    if self.indexToRASMatrix is None:
+      matrix = np.eye(4)
+      matrix[:3,:3] = LPS_TO_RAS[:,None]*np.reshape(self.direction, (3, 3))*np.asarray(self.spacing)
+      matrix[:3,3] = LPS_TO_RAS*np.asarray(self.origin)
+      self.indexToRASMatrix = matrix
+    return self.indexToRASMatrix
+
+  # Return 4x4 affine from 3D Slicer coordinates (RAS, 1) to pixel index (column, row, slice, 1)
+  def getRASToIndexMatrix(self):
+    if self.rasToIndexMatrix is None:
+      self.rasToIndexMatrix = np.linalg.inv(self.getIndexToRASMatrix())
+    return self.rasToIndexMatrix
+
+  # Return points (RAS) of pixel indexes (column, row, slice, continuous), one index or an (N, 3) array
+  def indexToRAS(self, indexes):
+    matrix = self.getIndexToRASMatrix()
+    return np.asarray(indexes, dtype=float).dot(matrix[:3,:3].T) + matrix[:3,3]
+
+  # Return continuous pixel indexes (column, row, slice) of points (RAS), one point or an (N, 3) array
+  def rasToIndex(self, points):
+    matrix = self.getRASToIndexMatrix()
+    return np.asarray(points, dtype=float).dot(matrix[:3,:3].T) + matrix[:3,3]
+
+  # Return nearest pixel indexes (int, same as sitk TransformPhysicalPointToIndex) of points (RAS), one point or an (N, 3) array
+  def rasToNearestIndex(self, points):
+    return np.floor(self.rasToIndex(points) + 0.5).astype(int)
+
+  def __repr__(self):
+    return 'ImageGeometry(spacing=%s, origin=%s, direction=%s)' %(self.spacing, self.origin, self.direction)
+
+
+################################################################################################################################################
+# Tracking frame and parameters
+################################################################################################################################################
+
+# Snapshot of one acquired image pair (magnitude/phase or real/imaginary arrays)
+# tipPrediction: predicted tip point in 3D Slicer coordinates (RAS), timestamp: acquisition/snapshot time (s)
+# tipPredictions: predicted tip points (RAS) of all tracked needles (None: tipPrediction only)
+class TrackingFrame(object):
+
+  def __init__(self, firstArray, secondArray, geometry=None, tipPrediction=None, timestamp=None, tipPredictions=None):
+    self.firstArray = firstArray
+    self.secondArray = secondArray
+    self.geometry = geometry
+    self.tipPrediction = tipPrediction
+    self.timestamp = timestamp
+    self.tipPredictions = tipPredictions
+    self.stageTimes = {}  # Stage times (s) measured before tracking (e.g. 'pull' from the scene)
+
+  # Return predicted tip points (RAS) of all tracked needles
+  def getTipPredictions(self):
+    return list(self.tipPredictions) if self.tipPredictions is not None else [self.tipPrediction]
+
+
+# Tracking parameters (defaults are the same as SimpleNeedleTrackingLogic.setDefaultParameters)
+class TrackingParameters(object):
+
+  def __init__(self, inputMode='MagPhase', maskThreshold=60, maskClosing=15, roiSize=15, blobThreshold=3.14, errorThreshold=15.0, debugFlag=False, roiUnwrap=False, roiMargin=10,
+               phaseDifferenceMode='Unwrap', unwrapDifference=False, predictionMode='Fixed', mahalanobisGate=3.4, roiMode='Fixed', roiMinimum=11, roiMaximum=45,
+               baselineMode='Fixed', baselineWeight=0.05, baselineExclusion=20.0, baselineInterval=1, unwrapMode='3D', unwrapWorkers=1, unwrapPool='Thread',
+               smoothingMode='None', smoothingWindow=5, outlierDistance=10.0):
+    self.inputMode = inputMode
+    self.maskThreshold = maskThreshold
+    self.maskClosing = maskClosing
+    self.roiSize = roiSize
+    self.blobThreshold = blobThreshold
+    self.errorThreshold = errorThreshold
+    self.debugFlag = debugFlag
+    self.roiUnwrap = roiUnwrap
+    self.roiMargin = roiMargin
+    self.phaseDifferenceMode = phaseDifferenceMode  # 'Unwrap' or 'Complex'
+    self.unwrapDifference = unwrapDifference        # Unwrap the phase difference map ('Complex' mode only)
+    self.predictionMode = predictionMode            # 'Fixed' (given tip prediction) or 'Kalman' (TipPredictor drives the ROI)
+    self.mahalanobisGate = mahalanobisGate          # Gate of Kalman predicted detections (standard deviations), errorThreshold still applies
+    self.roiMode = roiMode                          # 'Fixed' (roiSize) or 'Adaptive' (AdaptiveROIPolicy starting from roiSize)
+    self.roiMinimum = roiMinimum                    # Minimum/maximum ROI size (pixels) of the adaptive policy
+    self.roiMaximum = roiMaximum
+    self.baselineMode = baselineMode                # 'Fixed' (base images) or 'Rolling' (frames blended into the base, see updateRollingBaseline)
+    self.baselineWeight = baselineWeight            # Weight of a frame in the rolling baseline (exponential moving average)
+    self.baselineExclusion = baselineExclusion      # Half width (mm) of the needle exclusion zone around each tracked tip
+    self.baselineInterval = baselineInterval        # Frames between rolling baseline updates
+    self.unwrapMode = unwrapMode                    # '3D' (whole stack) or 'Slice' (each slice in 2D, see setUnwrapParameters)
+    self.unwrapWorkers = unwrapWorkers              # Concurrent slices in 'Slice' mode
+    self.unwrapPool = unwrapPool                    # 'Thread' or 'Process' pool of the slice unwrapping
+    self.smoothingMode = smoothingMode              # 'None', 'Median', 'AlphaBeta' or 'OneEuro' temporal filter of the tracked tips (TipFilter)
+    self.smoothingWindow = smoothingWindow          # Recent tips kept by the filter
+    self.outlierDistance = outlierDistance          # Tips farther (mm) from the median of the recent tips are rejected (0: no rejection)
+
+  def __repr__(self):
+    return 'TrackingParameters(%s)' %(', '.join('%s=%r' %(key, value) for (key, value) in sorted(vars(self).items())))
+
+
+################################################################################################################################################
+# Tracking result
+################################################################################################################################################
+
+# Result of one tracking cycle: tip in 3D Slicer coordinates (RAS) if successful, failure reason otherwise
+class TrackingResult(object):
+
+  def __init__(self, frame, success=False, tip=None, reason=None, predictionError=None):
+    self.frame = frame
+    self.success = success
+    self.tip = tip
+    self.reason = reason
+    self.predictionError = predictionError
+    self.timestamp = None  # Timestamp of the tracked frame
+    self.stageTimes = {}   # Processing time (s) of each pipeline stage
+    self.tipPrediction = None        # Tip prediction (RAS) the ROI was centered on
+    self.roiSize = None              # ROI size (pixels) used
+    self.roiChange = None            # Reason of the adaptive ROI size change after this frame (None if kept)
+    self.mahalanobisDistance = None  # Distance of the detection from the Kalman prediction
+    self.rawTip = None               # Detected tip before temporal smoothing (None if not smoothed)
+    self.gradientMean = None         # Mean of the rescaled phase gradient in the ROI (Step 4)
+    self.blobCount = None            # Number of blobs in the ROI (Step 5)
+    self.blobSize = None             # Size (pixels), elongation and flatness of the selected blob
+    self.blobElongation = None
+    self.blobFlatness = None
+
+  # Return failed result with given reason
+  @staticmethod
+  def failure(frame, reason):
+    return TrackingResult(frame, success=False, reason=reason)
+
+  # Return failure code of the result (index in FAILURE_REASONS, 0: success, -1: unknown reason)
+  def getFailureCode(self):
+    if self.success:
+      return 0
+    return FAILURE_REASONS.index(self.reason) if self.reason in FAILURE_REASONS else -1
+
+  def __bool__(self):
+    return self.success
+
+  def __repr__(self):
+    if self.success:
+      return 'TrackingResult(frame=%s, tip=%s, predictionError=%s)' %(self.frame, self.tip, self.predictionError)
+    return 'TrackingResult(frame=%s, reason=%r)' %(self.frame, self.reason)
+
+
+################################################################################################################################################
+# Baseline cache
+################################################################################################################################################
+
+# Baseline state derived once from the base images and reused for every frame
+# Built by NeedleTrackingEngine.setBaseImages; the mask dependent part is rebuilt only when maskThreshold/maskClosing change
+class BaselineCache(object):
+
+  def __init__(self, geometry, inputMode, maskThreshold, maskClosing):
+    self.geometry = geometry
+    self.inputMode = inputMode
+    self.maskThreshold = maskThreshold
+    self.maskClosing = maskClosing
+    self.imageSize = None                     # (columns, rows, slices)
+    # Base magnitude/phase (radians) arrays and itk images
+    self.numpy_base_m = None
+    self.numpy_base_p = None
+    self.sitk_base_m = None
+    self.sitk_base_p = None
+    # Mask: itk image, array as extracted from itk, bool mask and inverted bool mask (background)
+    self.sitk_mask = None
+    self.numpy_mask = None
+    self.numpy_mask_bool = None
+    self.numpy_background = None
+    # Unwrapped base phase (full frame and last crop region)
+    self.numpy_base_unwraped_p = None
+    self.cropRegion = None
+    self.numpy_base_unwraped_crop_p = None
+    # Conjugate complex base and phase value range (phase difference in the complex domain)
+    self.numpy_base_conj_c = None
+    self.basePhaseRange = None
+    # Rolling baseline: complex base, work buffers (allocated on the first update) and number of updates
+    self.numpy_base_c = None
+    self.numpy_update_c = None
+    self.numpy_update_p = None
+    self.updates = 0
+    # RAS to pixel index affine, built once per baseline (see ImageGeometry.rasToIndex)
+    geometry.getRASToIndexMatrix()
+    # Gaussian sigma (pixels) of the Step 4 gradient: 1 mm in-plane, no smoothing across slices
+    self.gradientSigma = (0.0, 1.0/geometry.spacing[1], 1.0/geometry.spacing[0])
+
+  # Return True if the mask was built with the given parameters
+  def matchesMask(self, maskThreshold, maskClosing):
+    return (self.maskThreshold == maskThreshold) and (self.maskClosing == maskClosing)
+
+  # Allocate the rolling baseline buffers (complex base from the conjugate base, update buffers)
+  def allocateRollingBuffers(self):
+    if self.numpy_base_c is None:
+      self.numpy_base_c = np.conj(self.numpy_base_conj_c)
+      self.numpy_update_c = np.empty_like(self.numpy_base_c)
+      self.numpy_update_p = np.empty(self.numpy_base_c.shape, dtype=np.float32)
+
+
+################################################################################################################################################
+# Tracking engine
+################################################################################################################################################
+
+# Slicer-free needle tracking pipeline working on NumPy arrays
+# Arrays are indexed as [slice, row, column] (same as sitk.GetArrayFromImage and slicer.util.arrayFromVolume)
+# Input arrays are only read and never kept, so they can be views of the scene volumes. Full frames stay in NumPy,
+# only the ROI window is converted to an ITK image.
+class NeedleTrackingEngine(object):
+
+  def __init__(self):
+    # Phase rescaling filter
+    self.phaseRescaleFilter = sitk.RescaleIntensityImageFilter()
+    self.phaseRescaleFilter.SetOutputMaximum(2*np.pi)
+    self.phaseRescaleFilter.SetOutputMinimum(0)
+
+    # Called as debugCallback(sitkImage, name) with intermediate images when debugFlag is set
+    self.debugCallback = None
+
+    # Base images and derived state (BaselineCache)
+    self.baseline = None
+    self.count = None
+
+    # Kalman tip predictor ('Kalman' prediction mode), adaptive ROI size ('Adaptive' ROI mode) and temporal tip filter of each needle
+    self.tipPredictors = []
+    self.roiPolicies = []
+    self.tipFilters = []
+
+    # Per-frame work arrays reused across frames (getBuffer)
+    self.buffers = {}
+
+    # Phase unwrapping mode and pool of the slice-parallel mode (created on first use)
+    self.unwrapMode = '3D'
+    self.unwrapWorkers = 1
+    self.unwrapPool = 'Thread'
+    self.unwrapExecutor = None
+
+  # Return Kalman tip predictor of the needle (created on first use)
+  def getTipPredictor(self, needle):
+    while len(self.tipPredictors) <= needle:
+      self.tipPredictors.append(TipPredictor())
+    return self.tipPredictors[needle]
+
+  # Return adaptive ROI policy of the needle (created on first use)
+  def getROIPolicy(self, needle):
+    while len(self.roiPolicies) <= needle:
+      self.roiPolicies.append(AdaptiveROIPolicy(growReasons=(FAILURE_EMPTY_PHASE_DIFF, FAILURE_NO_CENTROIDS, FAILURE_TIP_TOO_FAR, FAILURE_OUTSIDE_GATE)))
+    return self.roiPolicies[needle]
+
+  # Return temporal tip filter of the needle (created on first use, created again when the mode or window changes)
+  def getTipFilter(self, needle, smoothingMode, smoothingWindow, outlierDistance):
+    while len(self.tipFilters) <= needle:
+      self.tipFilters.append(None)
+    tipFilter = self.tipFilters[needle]
+    if (tipFilter is None) or (tipFilter.mode != smoothingMode) or (tipFilter.window != max(int(smoothingWindow), 1)):
+      tipFilter = TipFilter(smoothingMode, smoothingWindow)
+      self.tipFilters[needle] = tipFilter
+    tipFilter.outlierDistance = outlierDistance
+    return tipFilter
+
+  # Return work array of the named buffer, reallocated only when the shape or type changes
+  # The content is overwritten by the next frame: results kept across frames must not be buffers
+  def getBuffer(self, name, shape, dtype=np.float32):
+    buffer = self.buffers.get(name)
+    if (buffer is None) or (buffer.shape != shape) or (buffer.dtype != dtype):
+      buffer = np.empty(shape, dtype=dtype)
+      self.buffers[name] = buffer
+    return buffer
+
+  # Return True if base images were set
+  def isInitialized(self):
+    return self.baseline is not None
+
+  # Send intermediate image to the debug callback
+  def pushDebugImage(self, sitkImage, name):
+    if self.debugCallback is not None:
+      self.debugCallback(sitkImage, name)
+
+  # Return sitk Image from numpy array
+  def numpyToitk(self, array, sitkReference, type=None):
+    image = sitk.GetImageFromArray(array, isVector=False)
+    if (type is None):
+      image = sitk.Cast(image, sitkReference.GetPixelID())
+    else:
+      image = sitk.Cast(image, type)
+    image.CopyInformation(sitkReference)
+    return image
+
+  # Return sitk Image from numpy array and image geometry
+  def arrayToitk(self, array, geometry, type=sitk.sitkFloat32):
+    image = sitk.Cast(sitk.GetImageFromArray(array, isVector=False), type)
+    return geometry.applyTo(image)
+
+  # Set phase unwrapping mode: '3D' (whole stack) or 'Slice' (each slice unwrapped in 2D, for stacks of independent 2D slices)
+  # 'Slice' mode unwraps up to workers slices concurrently on a 'Thread' pool or a 'Process' pool. Any gain depends on the host:
+  # on a single-core host neither pool is faster than one worker (see README, SLICE UNWRAPPING), so the default is 1 worker.
+  # The unwrapped base phase is recomputed when the mode changes, so frame and base are always unwrapped the same way.
+  def setUnwrapParameters(self, unwrapMode='3D', workers=1, pool='Thread'):
+    if unwrapMode not in ('3D', 'Slice'):
+      raise ValueError('Unknown unwrap mode: %s' %(unwrapMode))
+    if pool not in ('Thread', 'Process'):
+      raise ValueError('Unknown unwrap pool: %s' %(pool))
+    workers = max(int(workers), 1)
+    if (workers, pool) != (self.unwrapWorkers, self.unwrapPool):
+      self.shutdownUnwrapPool()
+      (self.unwrapWorkers, self.unwrapPool) = (workers, pool)
+    if unwrapMode != self.unwrapMode:
+      self.unwrapMode = unwrapMode
+      if self.isInitialized():
+        self.baseline.numpy_base_unwraped_p = None
+        self.baseline.numpy_base_unwraped_crop_p = None
+
+  # Return pool of the slice-parallel unwrapping (created on first use)
+  def getUnwrapExecutor(self):
+    if self.unwrapExecutor is None:
+      # Daemon processes (e.g. the 'Process' tracking worker) cannot have children, and processes need a Python interpreter
+      # (getSpawnContext): slices are unwrapped on threads otherwise
+      context = getSpawnContext() if (self.unwrapPool == 'Process') and (not multiprocessing.current_process().daemon) else None
+      if context is not None:
+        # Spawned workers: forking the (Slicer) process is not safe
+        self.unwrapExecutor = concurrent.futures.ProcessPoolExecutor(self.unwrapWorkers, mp_context=context)
+      else:
+        self.unwrapExecutor = concurrent.futures.ThreadPoolExecutor(self.unwrapWorkers, thread_name_prefix='NeedleTrackingUnwrap')
+    return self.unwrapExecutor
+
+  # Stop the workers of the slice-parallel unwrapping
+  def shutdownUnwrapPool(self):
+    if self.unwrapExecutor is not None:
+      self.unwrapExecutor.shutdown(wait=True)
+      self.unwrapExecutor = None
+
+  # Unwrap phase images with implementation from scikit-image (module: restoration)
+  # array_background: bool array of the pixels to ignore (inverted mask). Return plain array, background pixels are undefined.
+  def unwrap_phase_array(self, array_p, array_background):
+    if (array_p.shape[0] == 1) or (self.unwrapMode == 'Slice'): # 2D images in a 3D array: unwrap each as 2D array
+        array_p_unwraped = np.empty(array_p.shape, dtype=array_p.dtype)
+        if (self.unwrapWorkers > 1) and (array_p.shape[0] > 1):
+            executor = self.getUnwrapExecutor()
+            slices = executor.map(_unwrapSlice, array_p, array_background)
+        else:
+            slices = map(_unwrapSlice, array_p, array_background)
+        for (index, array_slice) in enumerate(slices):
+            array_p_unwraped[index] = array_slice
+    else:
+        array_p_masked = np.ma.MaskedArray(array_p, mask=array_background, copy=False)  # No-copy view: only mask input of unwrap_phase
+        array_p_unwraped = unwrap_phase(array_p_masked, wrap_around=(False,False,False)).data
+    return array_p_unwraped
+
+  # Set background pixels of a phase difference array to the mean of the mask pixels (in place) and return the array
+  # array_mask/array_background: bool mask and inverted mask of the array
+  def fillBackground(self, array_p, array_mask, array_background):
+    count = np.count_nonzero(array_mask)
+    mean = float(np.sum(array_p, where=array_mask, dtype=np.float64))/count if count else 0.0
+    np.copyto(array_p, array_p.dtype.type(mean), where=array_background)
+    return array_p
+
+  # Return phase array scaled to radians [0 to 2*pi] with the given value range (default: value range of the base phase image)
+  # out: float32 array to write the result to (default: new array)
+  def scalePhaseArray(self, array_p, phaseRange=None, out=None):
+    (minimum, maximum) = self.baseline.basePhaseRange if phaseRange is None else phaseRange
+    if out is None:
+      array_p = np.array(array_p, dtype=np.float32)
+    else:
+      np.copyto(out, array_p, casting='unsafe')
+      array_p = out
+    array_p -= np.float32(minimum)
+    array_p *= np.float32(2*np.pi/max(maximum - minimum, 1e-6))
+    return array_p
+
+  # Return float32 magnitude/phase (radians [-pi to pi]) arrays from real/imaginary arrays
+  # Both are computed from the real/imaginary parts without complex intermediate: the phase array holds the squared
+  # imaginary part until the magnitude is done (np.hypot is several times slower for float32)
+  # out: (magnitude, phase) float32 arrays to write the results to (default: new arrays)
+  def realImagToMagPhase(self, numpy_real, numpy_imag, out=None):
+    if out is None:
+      out = (np.empty(numpy_real.shape, dtype=np.float32), np.empty(numpy_real.shape, dtype=np.float32))
+    (numpy_magn, numpy_phase) = out
+    np.multiply(numpy_real, numpy_real, out=numpy_magn, dtype=np.float32)
+    np.multiply(numpy_imag, numpy_imag, out=numpy_phase, dtype=np.float32)
+    numpy_magn += numpy_phase
+    np.sqrt(numpy_magn, out=numpy_magn)
+    np.arctan2(numpy_imag, numpy_real, out=numpy_phase, dtype=np.float32)
+    return (numpy_magn, numpy_phase)
+
+  # Return float magnitude array of the window (tuple of slices) from the input arrays
+  def getMagnitudeArray(self, firstArray, secondArray, inputMode, window=Ellipsis):
+    if (inputMode == 'RealImag'):
+      return self.realImagToMagPhase(firstArray[window], secondArray[window])[0]
+    return np.asarray(firstArray[window], dtype=np.float32)
+
+  # Return float phase array of the window (tuple of slices) in radians [0 to 2*pi] from the input arrays
+  # Magnitude/phase input is scaled with the value range of the full phase frame, real/imaginary input is converted with arctan2
+  # out: float32 array to write the result to (default: new array)
+  def getPhaseArray(self, firstArray, secondArray, inputMode, window=Ellipsis, out=None):
+    if (inputMode == 'RealImag'):
+      numpy_p = np.arctan2(secondArray[window], firstArray[window], out=out, dtype=np.float32)
+      numpy_p += np.float32(np.pi)
+      return numpy_p
+    return self.scalePhaseArray(secondArray[window], (float(np.min(secondArray)), float(np.max(secondArray))), out)
+
+  # Return array scaled to [0 to 2*pi] with its own value range (same as phaseRescaleFilter)
+  def rescaleArray(self, array):
+    array = np.array(array, dtype=np.float32)
+    minimum = array.min()
+    maximum = array.max()
+    array -= minimum
+    array *= np.float32(2*np.pi/(maximum - minimum)) if (maximum > minimum) else np.float32(0.0)
+    return array
+
+  # Return Gaussian gradient magnitude (per mm) of every slice of a [slice, row, column] stack in one call
+  # spacing: (column, row, slice) spacing in mm, sigma: Gaussian sigma (pixels) per array axis
+  def getGradientMagnitudeArray(self, array, spacing, sigma):
+    gradientColumn = ndimage.gaussian_filter(array, sigma, order=(0, 0, 1), mode='nearest')
+    gradientRow = ndimage.gaussian_filter(array, sigma, order=(0, 1, 0), mode='nearest')
+    gradientColumn *= np.float32(1.0/spacing[0])
+    gradientRow *= np.float32(1.0/spacing[1])
+    return np.hypot(gradientColumn, gradientRow)
+
+  # Return size (pixels), centroid (continuous pixel index: column, row, slice), flatness and elongation arrays of labels 1 to numberOfLabels
+  # Moments are accumulated for all labels at once; definitions are the same as sitk.LabelShapeStatisticsImageFilter
+  def getLabelStatistics(self, numpy_labels, numberOfLabels, spacing):
+    labels = numpy_labels.ravel()
+    length = numberOfLabels + 1
+    sizes = np.bincount(labels, minlength=length)[1:]
+    if numberOfLabels == 0:
+      return (sizes, np.zeros((0, 3)), np.zeros(0), np.zeros(0))
+    # Pixel positions (mm) along the image axes (column, row, slice)
+    (z, y, x) = np.indices(numpy_labels.shape)
+    positions = [x.ravel()*spacing[0], y.ravel()*spacing[1], z.ravel()*spacing[2]]
+    means = np.stack([np.bincount(labels, weights=position, minlength=length)[1:] for position in positions], axis=1)/sizes[:,None]
+    # Central second order moments and principal moments (ascending)
+    moments = np.empty((numberOfLabels, 3, 3))
+    for i in range(3):
+      for j in range(i, 3):
+        moments[:,i,j] = np.bincount(labels, weights=positions[i]*positions[j], minlength=length)[1:]/sizes - means[:,i]*means[:,j]
+        moments[:,j,i] = moments[:,i,j]
+    principalMoments = np.linalg.eigvalsh(moments)
+    tolerance = 1e-9*np.maximum(principalMoments[:,2], 1e-300)
+    elongation = np.sqrt(np.divide(principalMoments[:,2], principalMoments[:,1], out=np.zeros(numberOfLabels), where=(principalMoments[:,1] > tolerance)))
+    flatness = np.sqrt(np.divide(principalMoments[:,1], principalMoments[:,0], out=np.zeros(numberOfLabels), where=(principalMoments[:,0] > tolerance)))
+    return (sizes, means/np.asarray(spacing), flatness, elongation)
+
+  # Return crop window (tuple of slices for [slice, row, column] arrays) of a crop region
+  def getCropWindow(self, cropIndex, cropSize):
+    return (slice(None), slice(cropIndex[1], cropIndex[1]+cropSize[1]), slice(cropIndex[0], cropIndex[0]+cropSize[0]))
+
+  # Return crop region (index, size) enclosing the ROI window plus margin, or None if ROI is outside the image
+  # imageSize: (columns, rows, slices) as returned by sitk.Image.GetSize
+  def getCropRegion(self, imageSize, roiIndex, roiSize, roiMargin):
+    for axis in range(2):
+      if (roiIndex[axis] < 0) or (roiIndex[axis]+roiSize > imageSize[axis]):
+        return None
+    cropStart = [max(0, roiIndex[axis]-roiMargin) for axis in range(2)]
+    cropEnd = [min(imageSize[axis], roiIndex[axis]+roiSize+roiMargin) for axis in range(2)]
+    cropIndex = (cropStart[0], cropStart[1], 0)
+    cropSize = (cropEnd[0]-cropStart[0], cropEnd[1]-cropStart[1], imageSize[2])
+    return (cropIndex, cropSize)
+
+  # Return crop region (index, size) enclosing all given crop regions
+  def getUnionRegion(self, cropRegions):
+    cropStart = [min(cropIndex[axis] for (cropIndex, _) in cropRegions) for axis in range(3)]
+    cropEnd = [max(cropIndex[axis]+cropSize[axis] for (cropIndex, cropSize) in cropRegions) for axis in range(3)]
+    return (tuple(cropStart), tuple(cropEnd[axis]-cropStart[axis] for axis in range(3)))
+
+  # Return unwrapped base phase of the full frame (unwrapped again after a rolling baseline update)
+  def getBaseUnwraped(self):
+    baseline = self.baseline
+    if baseline.numpy_base_unwraped_p is None:
+      baseline.numpy_base_unwraped_p = self.unwrap_phase_array(baseline.numpy_base_p, baseline.numpy_background)
+    return baseline.numpy_base_unwraped_p
+
+  # Return unwrapped base phase for the crop region (unwrapped once and reused while the region and the base are unchanged)
+  def getBaseUnwrapedCrop(self, cropIndex, cropSize):
+    baseline = self.baseline
+    if (baseline.cropRegion != (cropIndex, cropSize)) or (baseline.numpy_base_unwraped_crop_p is None):
+      window = self.getCropWindow(cropIndex, cropSize)
+      baseline.numpy_base_unwraped_crop_p = self.unwrap_phase_array(baseline.numpy_base_p[window], baseline.numpy_background[window])
+      baseline.cropRegion = (cropIndex, cropSize)
+    return baseline.numpy_base_unwraped_crop_p
+
+  # Build the base mask and the unwrapped base phase of the baseline with the given mask parameters
+  def updateBaselineMask(self, baseline, maskThreshold, maskClosing):
+    baseline.maskThreshold = maskThreshold
+    baseline.maskClosing = maskClosing
+    # Get base mask: Generate bool mask from magnitude image to remove background
+    baseline.sitk_mask = (baseline.sitk_base_m > maskThreshold)
+    closingFilter = sitk.BinaryMorphologicalClosingImageFilter()    # Closing to fill bigger holes
+    closingFilter.SetKernelRadius(maskClosing)
+    baseline.sitk_mask = closingFilter.Execute(baseline.sitk_mask)
+    baseline.numpy_mask = sitk.GetArrayFromImage(baseline.sitk_mask)
+    baseline.numpy_mask_bool = baseline.numpy_mask.astype(bool)
+    baseline.numpy_background = np.logical_not(baseline.numpy_mask_bool)
+    # Unwrapped base phase (cropped base phase is invalidated)
+    baseline.numpy_base_unwraped_p = self.unwrap_phase_array(baseline.numpy_base_p, baseline.numpy_background)
+    baseline.cropRegion = None
+    baseline.numpy_base_unwraped_crop_p = None
+
+  # Rebuild the mask dependent baseline state if the mask parameters changed
+  def setMaskParameters(self, maskThreshold, maskClosing):
+    if self.isInitialized() and not self.baseline.matchesMask(maskThreshold, maskClosing):
+      self.updateBaselineMask(self.baseline, maskThreshold, maskClosing)
+
+  # Update the stored base images
+  # firstArray/secondArray: magnitude/phase or real/imaginary arrays, depending on inputMode
+  def setBaseImages(self, firstArray, secondArray, geometry, inputMode, maskThreshold, maskClosing, debugFlag=False):
+    # Initialize sequence counter, tip states and ROI sizes
+    self.count = 0
+    self.tipPredictors = []
+    self.roiPolicies = []
+    self.tipFilters = []
+    baseline = BaselineCache(geometry, inputMode, maskThreshold, maskClosing)
+    baseline.imageSize = (firstArray.shape[2], firstArray.shape[1], firstArray.shape[0])
+    # Get float magnitude/phase arrays and itk images
+    if (inputMode == 'RealImag'):
+      (baseline.numpy_base_m, baseline.numpy_base_p) = self.realImagToMagPhase(firstArray, secondArray)
+      baseline.numpy_base_p += np.float32(np.pi)
+    else:
+      baseline.numpy_base_m = self.getMagnitudeArray(firstArray, secondArray, inputMode).copy()
+      baseline.numpy_base_p = self.getPhaseArray(firstArray, secondArray, inputMode)
+    baseline.sitk_base_m = self.arrayToitk(baseline.numpy_base_m, geometry)
+    baseline.sitk_base_p = self.arrayToitk(baseline.numpy_base_p, geometry)
+    # Mask and unwrapped base phase
+    self.updateBaselineMask(baseline, maskThreshold, maskClosing)
+    # Conjugate base for phase difference in the complex domain
+    if (inputMode == 'RealImag'):
+      baseline.numpy_base_conj_c = np.empty(firstArray.shape, dtype=np.complex64)
+      baseline.numpy_base_conj_c.real[...] = firstArray
+      np.negative(secondArray, out=baseline.numpy_base_conj_c.imag, dtype=np.float32)
+    else:
+      baseline.basePhaseRange = (float(np.min(secondArray)), float(np.max(secondArray)))
+      baseline.numpy_base_conj_c = np.exp(-1.0j*baseline.numpy_base_p).astype(np.complex64)
+    self.baseline = baseline
+    # Push debug images
+    if debugFlag:
+      self.pushDebugImage(baseline.sitk_base_m, 'debug_base_m')
+      self.pushDebugImage(baseline.sitk_base_p, 'debug_base_p')
+      self.pushDebugImage(baseline.sitk_mask, 'debug_mask')
+      sitk_base_unwraped_p = self.numpyToitk(baseline.numpy_base_unwraped_p, baseline.sitk_base_p)
+      self.pushDebugImage(sitk_base_unwraped_p, 'debug_base_unwraped_p')
+
+  # Update the stored base images from a frame
+  def setBaseFrame(self, frame, parameters):
+    self.setUnwrapParameters(parameters.unwrapMode, parameters.unwrapWorkers, parameters.unwrapPool)
+    self.setBaseImages(frame.firstArray, frame.secondArray, frame.geometry, parameters.inputMode, parameters.maskThreshold, parameters.maskClosing, parameters.debugFlag)
+
+  # Run one tracking cycle on a frame
+  def trackFrame(self, frame, parameters):
+    result = self.getNeedle(frame.firstArray, frame.secondArray, frame.geometry, frame.tipPrediction, parameters, frame.timestamp)
+    result.timestamp = frame.timestamp
+    result.stageTimes.update(frame.stageTimes)
+    return result
+
+  # Run one tracking cycle on a frame for all needles of frame.getTipPredictions(), return one result per needle
+  def trackNeedles(self, frame, parameters):
+    results = self.getNeedles(frame.firstArray, frame.secondArray, frame.geometry, frame.getTipPredictions(), parameters, frame.timestamp)
+    for result in results:
+      result.timestamp = frame.timestamp
+      result.stageTimes.update(frame.stageTimes)
+    return results
+
+  # Run one tracking cycle, the result includes the processing time of each stage
+  # geometry: image geometry of the frame (None to use the base image geometry)
+  # tipPrediction: predicted tip point in 3D Slicer coordinates (RAS)
+  # parameters: TrackingParameters (the baseline mask is rebuilt first if the mask parameters changed, unwrap parameters are applied)
+  # timestamp: acquisition time (s) of the frame for the tip predictor and the tip filter
+  # parameters.phaseDifferenceMode: 'Unwrap' (unwrap frame, subtract unwrapped base) or 'Complex' (conjugate product, ROI window only)
+  # parameters.predictionMode: 'Fixed' (ROI centered on tipPrediction) or 'Kalman' (ROI centered and sized by the tip predictor once it
+  # was initialized from a detection, detections gated by Mahalanobis distance, errorThreshold from the prediction is kept as hard limit)
+  # parameters.roiMode: 'Fixed' (roiSize) or 'Adaptive' (size adapted to the detection confidence within [roiMinimum, roiMaximum], starting from roiSize)
+  # parameters.baselineMode: 'Fixed' (base images) or 'Rolling' (every baselineInterval frames, blend the frame into the baseline with baselineWeight
+  # outside baselineExclusion (mm) around the tracked tips, see updateRollingBaseline)
+  # parameters.smoothingMode: 'None' (detected tip) or temporal filter of the recent tips ('Median', 'AlphaBeta' or 'OneEuro' over smoothingWindow tips,
+  # detections farther than outlierDistance (mm) from the recent tips are rejected, see TipFilter)
+  def getNeedle(self, firstArray, secondArray, geometry, tipPrediction, parameters, timestamp=None):
+    return self.getNeedles(firstArray, secondArray, geometry, [tipPrediction], parameters, timestamp)[0]
+
+  # Run one tracking cycle for several needles, return one result per needle (same order as tipPredictions)
+  # Steps 1-2 (phase difference) are computed once for the region enclosing all ROIs, steps 3-6 run in the ROI of each needle.
+  # Each needle has its own Kalman tip predictor, adaptive ROI size and tip filter; all results share the stage times of the cycle.
+  # tipPredictions: predicted tip points in 3D Slicer coordinates (RAS), one per needle (other arguments as in getNeedle)
+  def getNeedles(self, firstArray, secondArray, geometry, tipPredictions, parameters, timestamp=None):
+    if not self.isInitialized():
+      return [TrackingResult.failure(self.count, FAILURE_NOT_INITIALIZED) for _ in tipPredictions]
+    self.setMaskParameters(parameters.maskThreshold, parameters.maskClosing)
+    self.setUnwrapParameters(parameters.unwrapMode, parameters.unwrapWorkers, parameters.unwrapPool)
+    timer = StageTimer()
+    tipPredictions = [tuple(tipPrediction) for tipPrediction in tipPredictions]
+    roiSizes = []
+    errorThresholds = []
+    gated = []
+    for needle in range(len(tipPredictions)):
+      needleROISize = parameters.roiSize
+      if parameters.roiMode == 'Adaptive':
+        needleROISize = self.getROIPolicy(needle).getSize(parameters.roiSize, parameters.roiMinimum, parameters.roiMaximum)
+      needleErrorThreshold = parameters.errorThreshold
+      predictor = self.getTipPredictor(needle) if (parameters.predictionMode == 'Kalman') else None
+      gated.append((predictor is not None) and predictor.isInitialized())
+      if gated[needle]:
+        tipPredictions[needle] = predictor.predict(timestamp)
+        needleROISize = predictor.getROISize(needleROISize, self.baseline.geometry.spacing, parameters.mahalanobisGate)
+      roiSizes.append(self.getROISizeInImage(needleROISize))
+      errorThresholds.append(needleErrorThreshold)
+    if any(gated):
+      timer.mark('predict')
+    results = self.runPipeline(timer, firstArray, secondArray, geometry, tipPredictions, parameters.inputMode, roiSizes, parameters.blobThreshold, errorThresholds,
+                               parameters.debugFlag, parameters.roiUnwrap, parameters.roiMargin, parameters.phaseDifferenceMode, parameters.unwrapDifference)
+    for (needle, result) in enumerate(results):
+      if parameters.predictionMode == 'Kalman':
+        result = self.updateTipPredictor(self.getTipPredictor(needle), result, gated[needle], parameters.mahalanobisGate, timestamp)
+      if parameters.roiMode == 'Adaptive':
+        result.roiChange = self.getROIPolicy(needle).update(result, self.baseline.geometry.spacing, parameters.roiMinimum, parameters.roiMaximum)
+      if parameters.smoothingMode != 'None':
+        tipFilter = self.getTipFilter(needle, parameters.smoothingMode, parameters.smoothingWindow, parameters.outlierDistance)
+        result = self.updateTipFilter(tipFilter, result, timestamp)
+      result.tipPrediction = tipPredictions[needle]
+      result.roiSize = roiSizes[needle]
+      results[needle] = result
+    # Rolling baseline: only frames with all needles tracked (needle positions known) are blended into the baseline
+    if (parameters.baselineMode == 'Rolling') and (self.count % max(int(parameters.baselineInterval), 1) == 0) and all(result.success for result in results):
+      if self.updateRollingBaseline(firstArray, secondArray, parameters.inputMode, [result.tip for result in results], parameters.baselineWeight,
+                                    parameters.baselineExclusion):
+        timer.mark('baseline')
+    stageTimes = timer.finish()
+    for result in results:
+      result.stageTimes = dict(stageTimes)
+    return results
+
+  # Blend a frame into the baseline (exponential moving average in the complex domain), except in the needle exclusion zone:
+  # base = (1-weight)*base + weight*frame. The update runs in place in buffers allocated on the first update. The unwrapped base
+  # phase is unwrapped again when it is next needed ('Unwrap' phase difference mode only).
+  # tipPoints: tracked tips (RAS), exclusion: half width (mm) of the zone around each tip (all slices) that keeps the base
+  # Return False if the frame does not match the base images
+  def updateRollingBaseline(self, firstArray, secondArray, inputMode, tipPoints, weight, exclusion):
+    baseline = self.baseline
+    if firstArray.shape != baseline.numpy_base_p.shape:
+      return False
+    baseline.allocateRollingBuffers()
+    # Complex frame (magnitude/phase input: unit magnitude, phase scaled with the base phase range)
+    numpy_update_c = baseline.numpy_update_c
+    if inputMode == 'RealImag':
+      numpy_update_c.real[...] = firstArray
+      numpy_update_c.imag[...] = secondArray
+    else:
+      (minimum, maximum) = baseline.basePhaseRange
+      numpy_update_p = baseline.numpy_update_p
+      np.copyto(numpy_update_p, secondArray, casting='unsafe')
+      numpy_update_p -= np.float32(minimum)
+      numpy_update_p *= np.float32(2*np.pi/max(maximum - minimum, 1e-6))
+      np.cos(numpy_update_p, out=numpy_update_c.real)
+      np.sin(numpy_update_p, out=numpy_update_c.imag)
+    # Weighted difference to the base, zero in the exclusion zones
+    numpy_update_c -= baseline.numpy_base_c
+    numpy_update_c *= np.complex64(weight)  # Complex scalar: no mixed-type multiplication
+    spacing = baseline.geometry.spacing
+    radius = (int(np.ceil(exclusion/spacing[0])), int(np.ceil(exclusion/spacing[1])))
+    for tipIndex in baseline.geometry.rasToNearestIndex(np.reshape(tipPoints, (-1, 3))).tolist():
+      numpy_update_c[:, max(tipIndex[1]-radius[1], 0):max(tipIndex[1]+radius[1]+1, 0), max(tipIndex[0]-radius[0], 0):max(tipIndex[0]+radius[0]+1, 0)] = 0
+    baseline.numpy_base_c += numpy_update_c
+    # Derived base arrays: conjugate base ('Complex' mode) and base phase in [0, 2*pi] ('Unwrap' mode, as getPhaseArray for
+    # real/imaginary input; magnitude/phase base phase gets a constant offset, which cancels in the rescaled phase difference)
+    np.conjugate(baseline.numpy_base_c, out=baseline.numpy_base_conj_c)
+    np.arctan2(baseline.numpy_base_c.imag, baseline.numpy_base_c.real, out=baseline.numpy_base_p)
+    baseline.numpy_base_p += np.float32(np.pi)
+    # Unwrapped base phase is out of date
+    baseline.numpy_base_unwraped_p = None
+    baseline.numpy_base_unwraped_crop_p = None
+    baseline.updates += 1
+    return True
+
+  # Gate the detection with the Kalman prediction and correct the tip predictor with accepted detections
+  # gated: False while the predictor is not initialized (the first accepted detection initializes it)
+  def updateTipPredictor(self, predictor, result, gated, mahalanobisGate, timestamp):
+    if not gated:
+      if result.success:
+        predictor.initialize(result.tip, timestamp)
+      return result
+    if result.success:
+      distance = predictor.getMahalanobisDistance(result.tip)
+      result.mahalanobisDistance = distance
+      if distance <= mahalanobisGate:
+        predictor.update(result.tip)
+        return result
+      result = self.rejectDetection(result, FAILURE_OUTSIDE_GATE)
+    if result.reason == FAILURE_INVALID_ROI:
+      # Prediction left the image, the state is lost
+      predictor.reset()
+      return result
+    predictor.miss()
+    return result
+
+  # Smooth the tip of an accepted detection with the tip filter (the detected tip is kept as rawTip), return the result
+  # Detections rejected as outliers of the recent tips fail
+  def updateTipFilter(self, tipFilter, result, timestamp):
+    if not result.success:
+      return result
+    tip = tipFilter.update(result.tip, timestamp)
+    if tip is None:
+      return self.rejectDetection(result, FAILURE_OUTLIER)
+    result.rawTip = result.tip
+    result.tip = tip
+    return result
+
+  # Return failed copy of a detection rejected after Step 6 (statistics of the detection are kept, the detected tip as rawTip)
+  def rejectDetection(self, result, reason):
+    rejected = copy.copy(result)
+    rejected.success = False
+    rejected.reason = reason
+    rejected.rawTip = result.tip
+    rejected.tip = None
+    return rejected
+
+  # Steps 1-2 with unwrapping: unwrap frame phase (full frame or crop region around the ROI) and subtract unwrapped base phase
+  # Return (phase difference array, index of its first pixel in the frame)
+  def getUnwrapedPhaseDifference(self, timer, firstArray, secondArray, geometry, inputMode, cropRegion, roiUnwrap, debugFlag):
+    if roiUnwrap:
+      # Only the window of the ROI plus margin is converted and unwrapped
+      (cropIndex, cropSize) = cropRegion
+      window = self.getCropWindow(cropIndex, cropSize)
+    else:
+      cropIndex = (0, 0, 0)
+      window = Ellipsis
+    # Get float phase array (radians)
+    numpy_img_p = self.getPhaseArray(firstArray, secondArray, inputMode, window, self.getBuffer('img_p', firstArray[window].shape))
+    # Push debug images
+    if debugFlag:
+      cropGeometry = geometry.getRegionGeometry(cropIndex)
+      self.pushDebugImage(self.arrayToitk(self.getMagnitudeArray(firstArray, secondArray, inputMode, window), cropGeometry), 'debug_img_m')
+      self.pushDebugImage(self.arrayToitk(numpy_img_p, cropGeometry), 'debug_img_p')
+    timer.mark('convert')
+
+    ######################################
+    ##                                  ##
+    ## Step 1: Unwrap phase image       ##
+    ##                                  ##
+    ######################################
+
+    numpy_background = self.baseline.numpy_background[window]
+    if roiUnwrap:
+      numpy_base_unwraped_p = self.getBaseUnwrapedCrop(cropIndex, cropSize)
+    else:
+      numpy_base_unwraped_p = self.getBaseUnwraped()
+
+    # Unwrapped img phase
+    numpy_img_unwraped_p = self.unwrap_phase_array(numpy_img_p, numpy_background)
+
+    # Plot
+    if debugFlag:
+      sitk_img_unwraped_p = self.arrayToitk(numpy_img_unwraped_p, geometry.getRegionGeometry(cropIndex))
+      self.pushDebugImage(sitk_img_unwraped_p, 'debug_img_unwraped_p')
+    timer.mark('unwrap')
+
+    ######################################
+    ##                                  ##
+    ## Step 2: Get phase difference     ##
+    ##                                  ##
+    ######################################
+
+    # Get phase difference
+    numpy_diff_p = np.subtract(numpy_img_unwraped_p, numpy_base_unwraped_p)
+
+    # Set background to mean phase value
+    self.fillBackground(numpy_diff_p, self.baseline.numpy_mask_bool[window], numpy_background)
+
+    # Plot
+    if debugFlag:
+      sitk_diff_p = self.arrayToitk(numpy_diff_p, geometry.getRegionGeometry(cropIndex))
+      self.pushDebugImage(self.phaseRescaleFilter.Execute(sitk_diff_p), 'debug_phase_diff')
+    timer.mark('difference')
+    return (numpy_diff_p, cropIndex)
+
+  # Steps 1-2 in the complex domain: multiply frame by the conjugate base and take the angle, in the crop region around the ROI only
+  # The difference map is unwrapped only if unwrapDifference is set (not needed while the needle-induced shift stays under pi)
+  # Return (phase difference array, index of its first pixel in the frame)
+  def getComplexPhaseDifference(self, timer, firstArray, secondArray, geometry, inputMode, cropRegion, unwrapDifference, debugFlag):
+    (cropIndex, cropSize) = cropRegion
+    window = self.getCropWindow(cropIndex, cropSize)
+    # Complex frame in the window (real/imaginary input is used as is), complex64 work arrays reused across frames
+    shape = firstArray[window].shape
+    numpy_img_c = self.getBuffer('img_c', shape, np.complex64)
+    if inputMode == 'RealImag':
+      numpy_img_c.real[...] = firstArray[window]
+      numpy_img_c.imag[...] = secondArray[window]
+    else:
+      numpy_img_p = self.scalePhaseArray(secondArray[window], out=self.getBuffer('img_p', shape))
+      np.cos(numpy_img_p, out=numpy_img_c.real)
+      np.sin(numpy_img_p, out=numpy_img_c.imag)
+    timer.mark('convert')
+
+    # Phase difference wrapped to [-pi, pi]
+    numpy_img_c *= self.baseline.numpy_base_conj_c[window]
+    numpy_diff_p = np.arctan2(numpy_img_c.imag, numpy_img_c.real, out=self.getBuffer('diff_p', shape))
+    if unwrapDifference:
+      numpy_diff_p = self.unwrap_phase_array(numpy_diff_p, self.baseline.numpy_background[window])
+    timer.mark('unwrap')
+
+    # Set background to mean phase value
+    self.fillBackground(numpy_diff_p, self.baseline.numpy_mask_bool[window], self.baseline.numpy_background[window])
+
+    # Plot
+    if debugFlag:
+      sitk_diff_p = self.arrayToitk(numpy_diff_p, geometry.getRegionGeometry(cropIndex))
+      self.pushDebugImage(self.phaseRescaleFilter.Execute(sitk_diff_p), 'debug_phase_diff')
+    timer.mark('difference')
+    return (numpy_diff_p, cropIndex)
+
+  # Tracking pipeline (Steps 1-6) of all needles, stage times are recorded in timer
+  # tipPredictions, roiSizes, errorThresholds: one per needle, return one result per needle
+  def runPipeline(self, timer, firstArray, secondArray, geometry, tipPredictions, inputMode, roiSizes, blobThreshold, errorThresholds, debugFlag=False, roiUnwrap=False, roiMargin=10,
+                  phaseDifferenceMode='Unwrap', unwrapDifference=False):
+    # Increment sequence counter
+    self.count += 1
+    if geometry is None:
+      geometry = self.baseline.geometry
+
+    # ROI of each needle (needles with the ROI outside the image fail)
+    results = [None]*len(tipPredictions)
+    roiIndexes = self.getROIIndexes(tipPredictions, roiSizes)
+    cropRegions = []
+    for needle in range(len(tipPredictions)):
+      cropRegion = self.getCropRegion(self.baseline.imageSize, roiIndexes[needle], roiSizes[needle], roiMargin)
+      if cropRegion is None:
+        results[needle] = TrackingResult.failure(self.count, FAILURE_INVALID_ROI)
+      else:
+        cropRegions.append(cropRegion)
+    if not cropRegions:
+      return results
+    cropRegion = self.getUnionRegion(cropRegions)
+
+    # Steps 1-2: Get phase difference array and the index of its first pixel in the frame (shared by all needles)
+    if phaseDifferenceMode == 'Complex':
+      (numpy_diff_p, diffIndex) = self.getComplexPhaseDifference(timer, firstArray, secondArray, geometry, inputMode, cropRegion, unwrapDifference, debugFlag)
+    else:
+      (numpy_diff_p, diffIndex) = self.getUnwrapedPhaseDifference(timer, firstArray, secondArray, geometry, inputMode, cropRegion, roiUnwrap, debugFlag)
+
+    # Steps 3-6 in the ROI of each needle (debug images of the second needle on are suffixed with its number)
+    for needle in range(len(tipPredictions)):
+      if results[needle] is None:
+        debugSuffix = '_%d' %(needle+1) if needle > 0 else ''
+        results[needle] = self.detectTip(timer, numpy_diff_p, diffIndex, geometry, tipPredictions[needle], roiIndexes[needle], roiSizes[needle], blobThreshold,
+                                         errorThresholds[needle], debugFlag, debugSuffix)
+    return results
+
+  # Return indexes (column, row, slice) of the first ROI pixel around the predicted tips (RAS) of all needles
+  # ROIs of tips inside the image are shifted inside the image (roiSizes must not exceed the image, see getROISizeInImage);
+  # ROIs of tips outside the image are left outside (getCropRegion rejects them)
+  def getROIIndexes(self, tipPredictions, roiSizes):
+    imageSize = self.baseline.imageSize
+    tipIndexes = self.baseline.geometry.rasToNearestIndex(np.reshape(tipPredictions, (-1, 3))).tolist()
+    roiIndexes = []
+    for (tipIndex, roiSize) in zip(tipIndexes, roiSizes):
+      roiIndex = [round(tipIndex[axis]-0.5*roiSize) for axis in range(2)]
+      if all(0 <= tipIndex[axis] < imageSize[axis] for axis in range(2)):
+        roiIndex = [min(max(roiIndex[axis], 0), imageSize[axis]-roiSize) for axis in range(2)]
+      roiIndexes.append((roiIndex[0], roiIndex[1], 0))
+    return roiIndexes
+
+  # Return ROI size (pixels) clamped to the image (the widened ROI of the tip predictor can exceed small images)
+  def getROISizeInImage(self, roiSize):
+    return int(min(roiSize, self.baseline.imageSize[0], self.baseline.imageSize[1]))
+
+  # Tip detection (Steps 3-6) in the ROI window of the phase difference array
+  # diffIndex: index of the first phase difference pixel in the frame, roiIndex: index of the first ROI pixel in the frame
+  def detectTip(self, timer, numpy_diff_p, diffIndex, geometry, tipPrediction, roiIndex, roiSize, blobThreshold, errorThreshold, debugFlag=False, debugSuffix=''):
+    tipRAS = tuple(tipPrediction)
+
+    ######################################
+    ##                                  ##
+    ## Step 3: Select ROI               ##
+    ##                                  ##
+    ######################################
+
+    # Crop ROI from the phase difference
+    roiStart = (roiIndex[0]-diffIndex[0], roiIndex[1]-diffIndex[1])
+    numpy_roi = self.rescaleArray(numpy_diff_p[:, roiStart[1]:roiStart[1]+roiSize, roiStart[0]:roiStart[0]+roiSize])
+    roiGeometry = geometry.getRegionGeometry(roiIndex)
+    # Plot
+    if debugFlag:
+      self.pushDebugImage(self.arrayToitk(numpy_roi, roiGeometry), 'debug_roi'+debugSuffix)
+    timer.mark('roi')
+
+    ####################################
+    ##                                ##
+    ## Step 4: Image gradient         ##
+    ##                                ##
+    ####################################
+
+    # 3D Gradient Filter only works with >=4 slices
+    # Perform 2D gradient in each slice instead: all slices of the ROI stack in one call
+    numpy_phaseGradient = self.rescaleArray(self.getGradientMagnitudeArray(numpy_roi, roiGeometry.spacing, self.baseline.gradientSigma))
+    # Plot
+    if debugFlag:
+      self.pushDebugImage(self.arrayToitk(numpy_phaseGradient, roiGeometry), 'debug_phase_gradient'+debugSuffix)
+
+    # Get gradient mean intensity value
+    meanValue = float(numpy_phaseGradient.mean(dtype=np.float64))
+    if debugFlag:
+      print('Gradient mean intensity = %s' %(meanValue))
+    timer.mark('gradient')
+    # If intensity is high, we probably have only noise
+    if meanValue >= 1.2:
+      return self.setDetectionStatistics(TrackingResult.failure(self.count, FAILURE_EMPTY_PHASE_DIFF), meanValue)
+
+    ####################################
+    ##                                ##
+    ## Step 5: Blob detection         ##
+    ##                                ##
+    ####################################
+
+    # Threshold roi to create blobs
+    numpy_blobs = (numpy_phaseGradient > blobThreshold)
+    # Plot
+    if debugFlag:
+      self.pushDebugImage(self.arrayToitk(numpy_blobs.astype(np.uint8), roiGeometry, sitk.sitkUInt8), 'debug_blobs'+debugSuffix)
+
+    # Label blobs (face connectivity, same labels as sitk.ConnectedComponent) and get shape statistics of all labels at once
+    (numpy_labels, num_blobs) = ndimage.label(numpy_blobs)
+    (labels_size, labels_centroid, labels_flatness, labels_elongation) = self.getLabelStatistics(numpy_labels, num_blobs, roiGeometry.spacing)
+    # Centroids in 3D Slicer coordinates (RAS): pixel index in the frame converted for all blobs at once
+    labels_centroid = geometry.indexToRAS(labels_centroid + np.asarray(roiIndex))
+    if debugFlag:
+      for l in range(num_blobs):
+        print('Label %s: -> Size: %s, Center: %s, Flatness: %s, Elongation: %s' %(l+1, labels_size[l], tuple(labels_centroid[l].tolist()), labels_flatness[l], labels_elongation[l]))
+
+    # Check number of blobs found
+    if num_blobs == 0:
+      return self.setDetectionStatistics(TrackingResult.failure(self.count, FAILURE_NO_CENTROIDS), meanValue, num_blobs)
+    # Select center of tip blob
+    elif num_blobs == 1:
+      label_index = 0
+      center = labels_centroid[0].tolist()
+    else:               # More than one - find most likely tip
+      # Keep blobs not too elongated to be the tip
+      candidates = np.flatnonzero(labels_elongation < 4)
+      # All blobs too elongated to be the tip
+      if candidates.size == 0:
+        return self.setDetectionStatistics(TrackingResult.failure(self.count, FAILURE_NO_CENTROIDS), meanValue, num_blobs)
+      # Find two largest blobs
+      sorted_by_size = candidates[np.argsort(labels_size[candidates], kind='stable')]
+      first_largest_index = sorted_by_size[-1]
+      second_largest_index = sorted_by_size[-2] if candidates.size > 1 else first_largest_index
+      if(labels_size[second_largest_index]/labels_size[first_largest_index] >= 0.15): # Check if both blobs are comparable size
+        # Get deepest inserted from the two (the first label if both are at the same depth)
+        label_index = max(sorted([first_largest_index, second_largest_index]), key=lambda index: labels_centroid[index][2])
+      else:
+        label_index = first_largest_index                     # Get significantly largest
+      # Get selected centroid center
+      center = labels_centroid[label_index].tolist()
+      if debugFlag:
+        print('Chosen label: %i' %(label_index+1))
+    timer.mark('blobs')
+
+
+    ####################################
+    ##                                ##
+    ## Step 6: Get tip physical point ##
+    ##                                ##
+    ####################################
+
+    # Centroid is in 3D Slicer coordinates (RAS)
+    centerRAS = tuple(center)
+    if debugFlag:
+      print(centerRAS)
+
+    # Calculate prediction error
+    predError = sqrt(pow((tipRAS[0]-centerRAS[0]),2)+pow((tipRAS[1]-centerRAS[1]),2)+pow((tipRAS[2]-centerRAS[2]),2))
+    timer.mark('tip')
+    # Check error threshold
+    if(predError>errorThreshold):
+      result = TrackingResult(self.count, success=False, reason=FAILURE_TIP_TOO_FAR, predictionError=predError)
+    else:
+      result = TrackingResult(self.count, success=True, tip=centerRAS, predictionError=predError)
+    blobStatistics = (labels_size[label_index], labels_elongation[label_index], labels_flatness[label_index])
+    return self.setDetectionStatistics(result, meanValue, num_blobs, *blobStatistics)
+
+  # Store gradient and blob statistics of the tip detection in the result, return the result
+  def setDetectionStatistics(self, result, gradientMean, blobCount=None, blobSize=None, blobElongation=None, blobFlatness=None):
+    result.gradientMean = gradientMean
+    result.blobCount = blobCount
+    result.blobSize = float(blobSize) if blobSize is not None else None
+    result.blobElongation = float(blobElongation) if blobElongation is not None else None
+    result.blobFlatness = float(blobFlatness) if blobFlatness is not None else None
+    return result
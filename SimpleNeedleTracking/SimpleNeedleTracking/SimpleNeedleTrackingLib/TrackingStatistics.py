@@ -0,0 +1,165 @@
+import collections
+import csv
+import json
+import time
+
+import numpy as np
+
+from .TrackingEngine import FAILURE_REASONS
+
+
+# Health states of the tracker (see TrackingStatistics.getStatus)
+STATUS_IDLE = 'Idle'
+STATUS_OK = 'OK'
+STATUS_FALLING_BEHIND = 'Falling behind'
+STATUS_DEGRADED = 'Degraded'
+
+
+################################################################################################################################################
+# Tracking statistics
+################################################################################################################################################
+
+# Cumulative health counters of one tracking session
+# Every frame handed to the tracker is received once and ends up processed (results of all needles), dropped (replaced by a
+# newer frame while the worker or the receiver was busy) or skipped (robot tip outside the image); the rest is pending.
+# Results are counted per needle and failure code (index in FAILURE_REASONS, -1: unknown reason). Success rate, drop rate,
+# latency and lag (processing time - acquisition time) of the last windowSize frames tell whether tracking is degrading or
+# falling behind.
+class TrackingStatistics(object):
+
+  def __init__(self, windowSize=50, minimumSuccessRate=0.5, maximumDropRate=0.2):
+    self.windowSize = windowSize                  # Frames of the recent rates
+    self.minimumSuccessRate = minimumSuccessRate  # Recent success rate below which tracking is degraded
+    self.maximumDropRate = maximumDropRate        # Recent drop rate above which tracking is falling behind
+    self.reset()
+
+  # Clear all counters and start a new session
+  def reset(self):
+    self.startTime = time.time()
+    self.receivedFrames = 0
+    self.processedFrames = 0
+    self.droppedFrames = 0
+    self.skippedFrames = 0
+    self.successes = []        # Successful results per needle
+    self.failures = []         # {failure code: count} per needle
+    self.unknownReasons = collections.Counter()  # Reasons without failure code
+    self.recentFrames = collections.deque(maxlen=self.windowSize)      # True: processed, False: dropped (skipped frames are not included)
+    self.recentResults = collections.deque(maxlen=self.windowSize)     # Success of the results of all needles
+    self.recentLatencies = collections.deque(maxlen=self.windowSize)   # Processing time (s) of the tracking pipeline
+    self.recentLags = collections.deque(maxlen=self.windowSize)        # Processing time - acquisition time (s)
+
+  # Count frames handed to the tracker
+  def addReceivedFrames(self, count=1):
+    self.receivedFrames += count
+
+  # Count frames replaced by newer ones before they were tracked
+  def addDroppedFrames(self, count=1):
+    self.droppedFrames += count
+    self.recentFrames.extend([False]*min(count, self.windowSize))
+
+  # Count frames that were not tracked on purpose (e.g. robot tip outside the image)
+  def addSkippedFrames(self, count=1):
+    self.skippedFrames += count
+
+  # Count the results of one processed frame (one result per needle, processingTime: time.time() if None)
+  def addResults(self, results, processingTime=None):
+    processingTime = processingTime if processingTime is not None else time.time()
+    self.processedFrames += 1
+    self.recentFrames.append(True)
+    while len(self.successes) < len(results):
+      self.successes.append(0)
+      self.failures.append(collections.Counter())
+    for (needle, result) in enumerate(results):
+      self.recentResults.append(result.success)
+      if result.success:
+        self.successes[needle] += 1
+        continue
+      code = result.getFailureCode()
+      self.failures[needle][code] += 1
+      if code < 0:
+        self.unknownReasons[result.reason] += 1
+    if results:
+      latency = results[0].stageTimes.get('total')
+      if latency is not None:
+        self.recentLatencies.append(latency)
+      if results[0].timestamp is not None:
+        self.recentLags.append(processingTime - results[0].timestamp)
+
+  # Return {reason: count} of the failures of the needle (all needles if None), reasons in FAILURE_REASONS order
+  def getFailureCounts(self, needle=None):
+    counts = collections.Counter()
+    for failures in (self.failures if needle is None else self.failures[needle:needle+1]):
+      counts.update(failures)
+    reasons = collections.OrderedDict()
+    for (code, reason) in enumerate(FAILURE_REASONS):
+      if counts[code]:
+        reasons[reason] = counts[code]
+    if counts[-1]:
+      reasons.update(self.unknownReasons if needle is None else {'Unknown reason': counts[-1]})
+    return reasons
+
+  # Return health state: Idle (no frame processed yet), Falling behind (recent drop rate above maximumDropRate), Degraded (recent
+  # success rate below minimumSuccessRate) or OK
+  def getStatus(self):
+    if not self.recentResults:
+      return STATUS_IDLE
+    if np.mean(np.logical_not(self.recentFrames)) > self.maximumDropRate:
+      return STATUS_FALLING_BEHIND
+    if np.mean(self.recentResults) < self.minimumSuccessRate:
+      return STATUS_DEGRADED
+    return STATUS_OK
+
+  # Return counters, rates (frames/s), success/drop rates (0-1), recent latency/lag (ms) and failures per reason and needle
+  def getStatistics(self):
+    duration = time.time() - self.startTime
+    results = sum(self.successes) + sum(sum(failures.values()) for failures in self.failures)
+    statistics = collections.OrderedDict()
+    statistics['status'] = self.getStatus()
+    statistics['duration'] = duration
+    statistics['received'] = self.receivedFrames
+    statistics['processed'] = self.processedFrames
+    statistics['dropped'] = self.droppedFrames
+    statistics['skipped'] = self.skippedFrames
+    statistics['pending'] = max(self.receivedFrames - self.processedFrames - self.droppedFrames - self.skippedFrames, 0)
+    statistics['receivedRate'] = self.receivedFrames/duration if duration > 0 else 0.0
+    statistics['processedRate'] = self.processedFrames/duration if duration > 0 else 0.0
+    statistics['successRate'] = float(sum(self.successes))/results if results else float('nan')
+    statistics['recentSuccessRate'] = float(np.mean(self.recentResults)) if self.recentResults else float('nan')
+    statistics['recentDropRate'] = float(np.mean(np.logical_not(self.recentFrames))) if self.recentFrames else float('nan')
+    statistics['recentLatency'] = 1000.0*float(np.mean(self.recentLatencies)) if self.recentLatencies else float('nan')
+    statistics['recentLag'] = 1000.0*float(np.mean(self.recentLags)) if self.recentLags else float('nan')
+    statistics['failures'] = self.getFailureCounts()
+    statistics['needles'] = [collections.OrderedDict([('successes', successes), ('failures', self.getFailureCounts(needle))])
+                             for (needle, successes) in enumerate(self.successes)]
+    return statistics
+
+  # Return statistics as text
+  def formatStatistics(self):
+    statistics = self.getStatistics()
+    text = ('Tracking: %(status)s, %(received)d frames received, %(processed)d processed, %(dropped)d dropped, %(skipped)d skipped, '
+            'success rate %(successRate).2f (recent %(recentSuccessRate).2f)' %statistics)
+    for (reason, count) in statistics['failures'].items():
+      text += '\n  %6d  %s' %(count, reason)
+    return text
+
+  # Write statistics as JSON (default) or CSV file (counter, needle, value rows) depending on the extension of path
+  def export(self, path):
+    statistics = self.getStatistics()
+    if not path.lower().endswith('.csv'):
+      # Rates without samples (NaN) are written as null
+      values = collections.OrderedDict((key, None if (isinstance(value, float) and np.isnan(value)) else value) for (key, value) in statistics.items())
+      with open(path, 'w') as file:
+        json.dump(values, file, indent=2)
+      return
+    with open(path, 'w', newline='') as file:
+      writer = csv.writer(file)
+      writer.writerow(['counter', 'needle', 'value'])
+      for (key, value) in statistics.items():
+        if key not in ('failures', 'needles'):
+          writer.writerow([key, '', value])
+      for (reason, count) in statistics['failures'].items():
+        writer.writerow([reason, '', count])
+      for (needle, values) in enumerate(statistics['needles']):
+        writer.writerow(['successes', needle+1, values['successes']])
+        for (reason, count) in values['failures'].items():
+          writer.writerow([reason, needle+1, count])
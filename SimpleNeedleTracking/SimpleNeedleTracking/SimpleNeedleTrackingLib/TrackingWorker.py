@@ -0,0 +1,172 @@
+import queue
+import threading
+
+from .TrackingEngine import NeedleTrackingEngine, getSpawnContext
+
+
+################################################################################################################################################
+# Latest-frame-wins queue
+################################################################################################################################################
+
+# Depth-1 frame queue: a new frame replaces (drops) the frame still waiting to be processed
+class LatestFrameQueue(object):
+
+  def __init__(self):
+    self.condition = threading.Condition()
+    self.frame = None
+    self.closed = False
+    self.droppedFrames = 0
+
+  # Store frame, return True if an older pending frame was dropped
+  def put(self, frame):
+    with self.condition:
+      dropped = (self.frame is not None)
+      if dropped:
+        self.droppedFrames += 1
+      self.frame = frame
+      self.condition.notify()
+    return dropped
+
+  # Wait for the pending frame and take it (None if the queue was closed or timeout expired)
+  def get(self, timeout=None):
+    with self.condition:
+      while (self.frame is None) and (not self.closed):
+        if not self.condition.wait(timeout):
+          return None
+      frame = self.frame
+      self.frame = None
+      return frame
+
+  # Wake up and release the consumer
+  def close(self):
+    with self.condition:
+      self.closed = True
+      self.frame = None
+      self.condition.notify_all()
+
+
+################################################################################################################################################
+# Worker loops
+################################################################################################################################################
+
+# Tracking loop of the worker thread
+def _runThreadWorker(engine, parameters, frameQueue, resultQueue):
+  while True:
+    frame = frameQueue.get()
+    if frame is None:
+      break
+    resultQueue.put(engine.trackNeedles(frame, parameters))
+  engine.shutdownUnwrapPool()
+
+# Tracking loop of the worker process (a None frame stops the loop)
+def _runProcessWorker(baseFrame, parameters, frameQueue, resultQueue):
+  engine = NeedleTrackingEngine()
+  engine.setBaseFrame(baseFrame, parameters)
+  while True:
+    frame = frameQueue.get()
+    if frame is None:
+      break
+    resultQueue.put(engine.trackNeedles(frame, parameters))
+  engine.shutdownUnwrapPool()
+
+
+################################################################################################################################################
+# Tracking worker
+################################################################################################################################################
+
+# Run the tracking engine in a background thread or process
+# Frames are handed over through a depth-1 queue (latest frame wins), so the tracker never processes stale frames.
+# Results are collected with getResults() by the owner (e.g. on the Qt main thread): one list per frame with the result of each needle
+# of frame.getTipPredictions(). The worker process is spawned with getSpawnContext() (PythonSlicer inside 3D Slicer).
+class TrackingWorker(object):
+
+  THREAD = 'Thread'
+  PROCESS = 'Process'
+
+  def __init__(self, mode='Thread'):
+    if mode not in (TrackingWorker.THREAD, TrackingWorker.PROCESS):
+      raise ValueError('Unknown tracking worker mode: %s' %(mode))
+    self.mode = mode
+    self.worker = None
+    self.frameQueue = None
+    self.resultQueue = None
+
+  # Return True if the worker is running
+  def isRunning(self):
+    return (self.worker is not None) and self.worker.is_alive()
+
+  # Start worker: base images are set from baseFrame in the worker's own engine
+  def start(self, baseFrame, parameters):
+    self.stop()
+    if self.mode == TrackingWorker.THREAD:
+      engine = NeedleTrackingEngine()
+      engine.setBaseFrame(baseFrame, parameters)
+      self.frameQueue = LatestFrameQueue()
+      self.resultQueue = queue.Queue()
+      self.worker = threading.Thread(target=_runThreadWorker, args=(engine, parameters, self.frameQueue, self.resultQueue), name='NeedleTrackingWorker')
+      self.worker.daemon = True
+    else:
+      context = getSpawnContext()
+      if context is None:
+        raise RuntimeError('No Python interpreter for the tracking process (PythonSlicer not found)')
+      self.frameQueue = context.Queue(maxsize=1)
+      self.resultQueue = context.Queue()
+      self.worker = context.Process(target=_runProcessWorker, args=(baseFrame, parameters, self.frameQueue, self.resultQueue), name='NeedleTrackingWorker')
+      self.worker.daemon = True
+    self.worker.start()
+
+  # Hand a frame to the worker, return True if an older pending frame was dropped
+  def submit(self, frame):
+    if not self.isRunning():
+      return False
+    if self.mode == TrackingWorker.THREAD:
+      return self.frameQueue.put(frame)
+    # Process queue: drop the pending frame to make room for the new one
+    try:
+      self.frameQueue.put_nowait(frame)
+      return False
+    except queue.Full:
+      pass
+    try:
+      self.frameQueue.get_nowait()
+    except queue.Empty:
+      pass
+    try:
+      self.frameQueue.put_nowait(frame)
+    except queue.Full:
+      pass  # Worker is still busy with an older frame: the new one is dropped instead
+    return True
+
+  # Return result lists of all frames processed so far (non-blocking)
+  def getResults(self):
+    results = []
+    if self.resultQueue is None:
+      return results
+    while True:
+      try:
+        results.append(self.resultQueue.get_nowait())
+      except queue.Empty:
+        break
+    return results
+
+  # Stop the worker and wait for it to finish the frame in progress
+  def stop(self, timeout=5.0):
+    if self.worker is None:
+      return
+    if self.mode == TrackingWorker.THREAD:
+      self.frameQueue.close()
+      self.worker.join(timeout)
+    else:
+      try:
+        self.frameQueue.get_nowait()  # Discard pending frame
+      except queue.Empty:
+        pass
+      try:
+        self.frameQueue.put(None, timeout=timeout)
+      except queue.Full:
+        pass
+      self.worker.join(timeout)
+      if self.worker.is_alive():
+        self.worker.terminate()
+      self.frameQueue.cancel_join_thread()
+    self.worker = None
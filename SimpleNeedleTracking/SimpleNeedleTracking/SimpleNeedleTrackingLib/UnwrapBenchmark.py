@@ -0,0 +1,134 @@
+# Benchmark of the unwrap and phase difference steps (Steps 1-2) on synthetic volumes
+#
+# Compares the masked-array implementation (np.ma phase images, masked difference and filled background) used before with
+# NeedleTrackingEngine.unwrap_phase_array/fillBackground (plain arrays and a precomputed bool mask) on the same data.
+# With --workers, also times the unwrap modes of the engine: '3D' and 'Slice' with each number of workers.
+#
+# Usage (from the SimpleNeedleTracking module directory):
+#   python -m SimpleNeedleTrackingLib.UnwrapBenchmark --matrix 256 --slices 1 3 5 --repeat 10
+#   python -m SimpleNeedleTrackingLib.UnwrapBenchmark --slices 4 8 --workers 1 2 4 8 --pool Thread
+
+import argparse
+import time
+
+import numpy as np
+from skimage.restoration import unwrap_phase
+
+from .TrackingEngine import NeedleTrackingEngine
+
+
+################################################################################################################################################
+# Masked-array reference
+################################################################################################################################################
+
+# Previous unwrap_phase_array: phase image masked with the inverted uint8 mask, masked array result
+def unwrapMaskedArray(array_p, array_mask):
+  array_p_masked = np.ma.array(array_p, mask=np.logical_not(array_mask).astype(int))
+  if array_p.shape[0] == 1:
+    array_p_unwraped = np.ma.copy(array_p_masked)
+    array_p_unwraped[0,:,:] = unwrap_phase(array_p_masked[0,:,:], wrap_around=(False,False))
+  else:
+    array_p_unwraped = unwrap_phase(array_p_masked, wrap_around=(False,False,False))
+  return array_p_unwraped
+
+# Previous Step 2: masked difference, background filled with the masked mean
+def differenceMaskedArray(numpy_img_unwraped_p, numpy_base_unwraped_p):
+  numpy_diff_p = numpy_img_unwraped_p - numpy_base_unwraped_p
+  return numpy_diff_p.filled(numpy_diff_p.mean())
+
+
+################################################################################################################################################
+# Synthetic data
+################################################################################################################################################
+
+# Return (base phase, frame phase, uint8 mask) of a [slices, matrix, matrix] volume: wrapped background phase ramp in [0, 2*pi],
+# frame with an added needle-like dipole, circular tissue mask
+def createVolumes(matrix, slices, seed=0):
+  random = np.random.RandomState(seed)
+  (z, y, x) = np.mgrid[0:slices, 0:matrix, 0:matrix].astype(np.float32)
+  ramp = 6*np.pi*(x + 0.5*y)/matrix + 0.3*z
+  (cy, cx) = (0.5*matrix, 0.4*matrix)
+  radius2 = (x - cx)**2 + (y - cy)**2 + 4.0
+  dipole = 3.0*(matrix/16.0)**2*((x - cx)**2 - (y - cy)**2)/radius2**2
+  noise = 0.02*random.standard_normal(ramp.shape).astype(np.float32)
+  base = np.mod(ramp + noise, 2*np.pi).astype(np.float32)
+  frame = np.mod(ramp + np.clip(dipole, -2.5, 2.5) + noise[::-1], 2*np.pi).astype(np.float32)
+  mask = (((x - 0.5*matrix)**2 + (y - 0.5*matrix)**2) < (0.45*matrix)**2).astype(np.uint8)
+  return (base, frame, mask)
+
+
+################################################################################################################################################
+# Benchmark
+################################################################################################################################################
+
+# Return minimum time (ms) of repeat calls
+def timeCall(function, repeat):
+  times = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    function()
+    times.append(time.perf_counter() - start)
+  return 1e3*min(times)
+
+# Return timings (ms) of the masked-array and plain-array Steps 1-2 of one volume size and the largest result difference
+def runBenchmark(engine, matrix, slices, repeat):
+  (base, frame, mask) = createVolumes(matrix, slices)
+  mask_bool = mask.astype(bool)
+  background = np.logical_not(mask_bool)
+  # Base phase is unwrapped once per sequence (not timed)
+  base_unwraped_ma = unwrapMaskedArray(base, mask)
+  base_unwraped = engine.unwrap_phase_array(base, background)
+  # Frame unwrapping
+  unwrapMA = timeCall(lambda: unwrapMaskedArray(frame, mask), repeat)
+  unwrapPlain = timeCall(lambda: engine.unwrap_phase_array(frame, background), repeat)
+  frame_unwraped_ma = unwrapMaskedArray(frame, mask)
+  frame_unwraped = engine.unwrap_phase_array(frame, background)
+  # Difference and background fill
+  differenceMA = timeCall(lambda: differenceMaskedArray(frame_unwraped_ma, base_unwraped_ma), repeat)
+  differencePlain = timeCall(lambda: engine.fillBackground(np.subtract(frame_unwraped, base_unwraped), mask_bool, background), repeat)
+  maximumDifference = float(np.max(np.abs(differenceMaskedArray(frame_unwraped_ma, base_unwraped_ma) -
+                                          engine.fillBackground(np.subtract(frame_unwraped, base_unwraped), mask_bool, background))))
+  return (unwrapMA, unwrapPlain, differenceMA, differencePlain, maximumDifference)
+
+# Return unwrap times (ms) of '3D' mode and of 'Slice' mode with each number of workers for one volume size
+def runModeBenchmark(matrix, slices, workers, pool, repeat):
+  (_, frame, mask) = createVolumes(matrix, slices)
+  background = np.logical_not(mask.astype(bool))
+  times = []
+  for (unwrapMode, unwrapWorkers) in [('3D', 1)] + [('Slice', count) for count in workers]:
+    engine = NeedleTrackingEngine()
+    engine.setUnwrapParameters(unwrapMode, unwrapWorkers, pool)
+    engine.unwrap_phase_array(frame, background)  # Start the pool
+    times.append(timeCall(lambda: engine.unwrap_phase_array(frame, background), repeat))
+    engine.shutdownUnwrapPool()
+  return times
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark masked-array and plain-array phase unwrapping/difference')
+  parser.add_argument('--matrix', type=int, default=256, help='Matrix size (pixels)')
+  parser.add_argument('--slices', type=int, nargs='+', default=[1, 3, 5], help='Numbers of slices')
+  parser.add_argument('--repeat', type=int, default=10, help='Repetitions per measurement (minimum is reported)')
+  parser.add_argument('--workers', type=int, nargs='+', help='Time the unwrap modes: 3D and Slice with these numbers of workers')
+  parser.add_argument('--pool', default='Thread', choices=['Thread', 'Process'], help='Worker pool of the Slice mode')
+  args = parser.parse_args(argv)
+
+  if args.workers:
+    print('%-14s%14s%s' %('volume', '3D', ''.join('%14s' %('Slice x%d' %(count)) for count in args.workers)))
+    for slices in args.slices:
+      times = runModeBenchmark(args.matrix, slices, args.workers, args.pool, args.repeat)
+      print('%-14s%s' %('%dx%dx%d' %(args.matrix, args.matrix, slices), ''.join('%11.2f ms' %(value) for value in times)))
+    return
+
+  engine = NeedleTrackingEngine()
+  print('%-14s%14s%14s%14s%14s%14s%12s' %('volume', 'unwrap ma', 'unwrap', 'diff ma', 'diff', 'steps 1-2 x', 'max diff'))
+  rows = []
+  for slices in args.slices:
+    (unwrapMA, unwrapPlain, differenceMA, differencePlain, maximumDifference) = runBenchmark(engine, args.matrix, slices, args.repeat)
+    speedup = (unwrapMA + differenceMA)/(unwrapPlain + differencePlain)
+    print('%-14s%11.2f ms%11.2f ms%11.2f ms%11.2f ms%14.2f%12.1e' %('%dx%dx%d' %(args.matrix, args.matrix, slices), unwrapMA, unwrapPlain,
+                                                                    differenceMA, differencePlain, speedup, maximumDifference))
+    rows.append((slices, unwrapMA, unwrapPlain, differenceMA, differencePlain, maximumDifference))
+  return rows
+
+if __name__ == '__main__':
+  main()
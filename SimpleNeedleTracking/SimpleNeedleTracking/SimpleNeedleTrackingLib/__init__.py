@@ -0,0 +1,58 @@
+# Slicer-free components of the SimpleNeedleTracking module
+from .TrackingEngine import (
+  ImageGeometry,
+  TrackingFrame,
+  TrackingParameters,
+  TrackingResult,
+  BaselineCache,
+  NeedleTrackingEngine,
+  FAILURE_NOT_INITIALIZED,
+  FAILURE_INVALID_ROI,
+  FAILURE_EMPTY_PHASE_DIFF,
+  FAILURE_NO_CENTROIDS,
+  FAILURE_TIP_TOO_FAR,
+  FAILURE_OUTSIDE_GATE,
+  FAILURE_OUTLIER,
+  FAILURE_FRAME_SKIPPED,
+  FAILURE_REASONS,
+  getSpawnContext,
+)
+from .StageProfiler import (
+  STAGES,
+  StageTimer,
+  StageProfiler,
+)
+from .AdaptiveROIPolicy import (
+  AdaptiveROIPolicy,
+)
+from .DebugImageWriter import (
+  DebugImageWriter,
+)
+from .IGTLImageReceiver import (
+  ImagePairBuffer,
+  IGTLImageReceiver,
+)
+from .RobotTipPrior import (
+  RobotTipPrior,
+)
+from .TipFilter import (
+  TipFilter,
+)
+from .TipHistory import (
+  TIP_HISTORY_DTYPE,
+  TipHistory,
+)
+from .TipPredictor import (
+  TipPredictor,
+)
+from .TrackingStatistics import (
+  STATUS_IDLE,
+  STATUS_OK,
+  STATUS_FALLING_BEHIND,
+  STATUS_DEGRADED,
+  TrackingStatistics,
+)
+from .TrackingWorker import (
+  LatestFrameQueue,
+  TrackingWorker,
+)
@@ -0,0 +1,5 @@
+# pytest: import SimpleNeedleTrackingLib from the module directory (3D Slicer adds it to the path itself)
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
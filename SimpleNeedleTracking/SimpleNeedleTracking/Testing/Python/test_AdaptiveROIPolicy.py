@@ -0,0 +1,61 @@
+import unittest
+
+from SimpleNeedleTrackingLib import AdaptiveROIPolicy, TrackingResult, FAILURE_INVALID_ROI, FAILURE_NO_CENTROIDS
+
+SPACING = (1.0, 1.0, 5.0)
+
+
+def detection(predictionError):
+  return TrackingResult(1, success=True, tip=(0.0, 0.0, 0.0), predictionError=predictionError)
+
+
+class AdaptiveROIPolicyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.policy = AdaptiveROIPolicy(growReasons=(FAILURE_NO_CENTROIDS,))
+
+  def test_initialSize(self):
+    self.assertEqual(self.policy.getSize(15, 11, 45), 15)
+    self.policy.reset()
+    self.assertEqual(self.policy.getSize(61, 11, 45), 45)
+    self.policy.reset()
+    self.assertEqual(self.policy.getSize(5, 11, 45), 11)
+
+  def test_shrinkAfterConsistentDetections(self):
+    self.policy.getSize(15, 11, 45)
+    # Consistent: prediction error within half of the ROI half width (0.5*0.5*15 mm)
+    self.assertIsNone(self.policy.update(detection(3.0), SPACING, 11, 45))
+    self.assertIsNone(self.policy.update(detection(3.0), SPACING, 11, 45))
+    self.assertEqual(self.policy.update(detection(3.0), SPACING, 11, 45), 'Shrink to 13 px: 3 consistent detections')
+    self.assertEqual(self.policy.getSize(15, 11, 45), 13)
+    for _ in range(6):
+      self.policy.update(detection(0.5), SPACING, 11, 45)
+    self.assertEqual(self.policy.getSize(15, 11, 45), 11)
+
+  def test_inconsistentDetectionRestartsCount(self):
+    self.policy.getSize(15, 11, 45)
+    self.policy.update(detection(3.0), SPACING, 11, 45)
+    self.policy.update(detection(3.0), SPACING, 11, 45)
+    self.assertIsNone(self.policy.update(detection(4.0), SPACING, 11, 45))
+    self.assertIsNone(self.policy.update(detection(3.0), SPACING, 11, 45))
+    self.assertEqual(self.policy.getSize(15, 11, 45), 15)
+
+  def test_growOnMiss(self):
+    self.policy.getSize(15, 11, 45)
+    self.assertEqual(self.policy.update(TrackingResult.failure(1, FAILURE_NO_CENTROIDS), SPACING, 11, 45),
+                     'Grow to 23 px: %s' %(FAILURE_NO_CENTROIDS))
+    self.assertEqual(self.policy.update(TrackingResult.failure(2, FAILURE_NO_CENTROIDS), SPACING, 11, 45),
+                     'Grow to 35 px: %s' %(FAILURE_NO_CENTROIDS))
+    self.policy.update(TrackingResult.failure(3, FAILURE_NO_CENTROIDS), SPACING, 11, 45)
+    self.assertEqual(self.policy.getSize(15, 11, 45), 45)
+    # Already at the maximum: no change reported
+    self.assertIsNone(self.policy.update(TrackingResult.failure(4, FAILURE_NO_CENTROIDS), SPACING, 11, 45))
+
+  def test_otherFailureKeepsSize(self):
+    self.policy.getSize(15, 11, 45)
+    self.assertIsNone(self.policy.update(TrackingResult.failure(1, FAILURE_INVALID_ROI), SPACING, 11, 45))
+    self.assertEqual(self.policy.getSize(15, 11, 45), 15)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,165 @@
+import socket
+import struct
+import time
+import unittest
+
+import numpy as np
+
+from SimpleNeedleTrackingLib import IGTLImageReceiver, ImageGeometry, ImagePairBuffer
+from SimpleNeedleTrackingLib.IGTLImageReceiver import (IGTL_COORDINATE_RAS, IGTL_HEADER_SIZE, IGTL_IMAGE_HEADER_FORMAT, IGTL_IMAGE_HEADER_SIZE,
+                                                       crc64, getImageGeometry, packImageMessage, packTimestamp, unpackHeader, unpackTimestamp)
+
+# Oblique geometry (LPS): rotation about the slice axis
+ANGLE = np.radians(30.0)
+GEOMETRY = ImageGeometry((0.8, 0.9, 4.0), (-50.0, 20.0, 10.0),
+                         (np.cos(ANGLE), -np.sin(ANGLE), 0.0, np.sin(ANGLE), np.cos(ANGLE), 0.0, 0.0, 0.0, 1.0))
+
+
+def image(value, shape=(2, 6, 8)):
+  return np.full(shape, value, dtype=np.float32)
+
+
+class ProtocolTest(unittest.TestCase):
+
+  def test_timestamp(self):
+    self.assertAlmostEqual(unpackTimestamp(packTimestamp(1234.5678)), 1234.5678, places=6)
+    self.assertEqual(packTimestamp(3.0), 3 << 32)
+
+  def test_crc64(self):
+    # CRC-64/ECMA-182 (not reflected, initial value 0) check value
+    self.assertEqual(crc64(b'123456789'), 0x6C40DF5F0B497347)
+    self.assertEqual(crc64(b''), 0)
+
+  def test_imageMessageRoundTrip(self):
+    array = np.arange(2*6*8, dtype=np.int16).reshape((2, 6, 8)) - 40
+    message = packImageMessage('Phase', array, GEOMETRY, 17.25)
+    (version, messageType, deviceName, timestamp, bodySize, crc) = unpackHeader(message[:IGTL_HEADER_SIZE])
+    body = message[IGTL_HEADER_SIZE:]
+    self.assertEqual((version, messageType, deviceName, timestamp), (1, 'IMAGE', 'Phase', 17.25))
+    self.assertEqual(bodySize, len(body))
+    self.assertEqual(bodySize, IGTL_IMAGE_HEADER_SIZE + array.nbytes)
+    self.assertEqual(crc, crc64(body))
+    values = struct.unpack_from(IGTL_IMAGE_HEADER_FORMAT, body)
+    self.assertEqual(values[5:8], (8, 6, 2))
+    geometry = getImageGeometry(values[5:8], values[8:20], IGTL_COORDINATE_RAS)
+    np.testing.assert_allclose(geometry.spacing, GEOMETRY.spacing, rtol=1e-6)
+    np.testing.assert_allclose(geometry.origin, GEOMETRY.origin, atol=1e-4)
+    np.testing.assert_allclose(geometry.direction, GEOMETRY.direction, atol=1e-6)
+    pixels = np.frombuffer(body, dtype='>i2', offset=IGTL_IMAGE_HEADER_SIZE).reshape(array.shape)
+    np.testing.assert_array_equal(pixels, array)
+
+  def test_unsupportedScalarType(self):
+    with self.assertRaises(ValueError):
+      packImageMessage('Phase', np.zeros((1, 2, 2), dtype=np.complex64), GEOMETRY, 0.0)
+
+  def test_putImage(self):
+    receiver = IGTLImageReceiver()
+    for (channel, value) in ((0, 100.0), (1, -1.5)):
+      message = packImageMessage(receiver.deviceNames[channel], image(value), GEOMETRY, 5.0, checksum=False)
+      receiver.putImage(channel, memoryview(message)[IGTL_HEADER_SIZE:], 5.0)
+    frame = receiver.takeFrame()
+    self.assertEqual(frame.timestamp, 5.0)
+    np.testing.assert_array_equal(frame.firstArray, image(100.0))
+    np.testing.assert_array_equal(frame.secondArray, image(-1.5))
+    np.testing.assert_allclose(frame.geometry.indexToRAS((3, 2, 1)), GEOMETRY.indexToRAS((3, 2, 1)), atol=1e-4)
+    self.assertEqual(receiver.getStatistics()['taken'], 1)
+
+
+class ImagePairBufferTest(unittest.TestCase):
+
+  def test_pairing(self):
+    pairBuffer = ImagePairBuffer(pairTolerance=0.05)
+    self.assertIsNone(pairBuffer.take())
+    self.assertFalse(pairBuffer.put(0, image(1.0), GEOMETRY, 1.00))
+    self.assertIsNone(pairBuffer.take())
+    self.assertTrue(pairBuffer.put(1, image(2.0), GEOMETRY, 1.02))
+    frame = pairBuffer.take()
+    self.assertEqual(frame.timestamp, 1.00)
+    self.assertEqual(frame.firstArray[0, 0, 0], 1.0)
+    self.assertEqual(frame.secondArray[0, 0, 0], 2.0)
+    self.assertIn('pull', frame.stageTimes)
+    self.assertIsNone(pairBuffer.take())
+    self.assertEqual((pairBuffer.pairedFrames, pairBuffer.takenFrames, pairBuffer.droppedFrames), (1, 1, 0))
+
+  def test_secondChannelFirst(self):
+    pairBuffer = ImagePairBuffer()
+    self.assertFalse(pairBuffer.put(1, image(2.0), GEOMETRY, 3.0))
+    self.assertTrue(pairBuffer.put(0, image(1.0), GEOMETRY, 3.0))
+    frame = pairBuffer.take()
+    self.assertEqual((frame.firstArray[0, 0, 0], frame.secondArray[0, 0, 0]), (1.0, 2.0))
+
+  def test_outsideTolerance(self):
+    pairBuffer = ImagePairBuffer(pairTolerance=0.05)
+    pairBuffer.put(0, image(1.0), GEOMETRY, 1.0)
+    self.assertFalse(pairBuffer.put(1, image(2.0), GEOMETRY, 1.2))
+    self.assertFalse(pairBuffer.put(1, image(2.0, (2, 4, 4)), GEOMETRY, 1.0))  # Different size
+    self.assertIsNone(pairBuffer.take())
+
+  def test_latestPairWins(self):
+    pairBuffer = ImagePairBuffer()
+    for timestamp in (1.0, 2.0, 3.0):
+      pairBuffer.put(0, image(timestamp), GEOMETRY, timestamp)
+      pairBuffer.put(1, image(-timestamp), GEOMETRY, timestamp)
+    frame = pairBuffer.take()
+    self.assertEqual(frame.timestamp, 3.0)
+    self.assertEqual(frame.secondArray[0, 0, 0], -3.0)
+    self.assertEqual((pairBuffer.pairedFrames, pairBuffer.takenFrames, pairBuffer.droppedFrames), (3, 1, 2))
+
+  def test_unmatchedImages(self):
+    pairBuffer = ImagePairBuffer()
+    pairBuffer.put(0, image(1.0), GEOMETRY, 1.0)   # Second image of this pair is lost
+    pairBuffer.put(0, image(2.0), GEOMETRY, 2.0)
+    pairBuffer.put(1, image(2.0), GEOMETRY, 2.0)
+    self.assertEqual(pairBuffer.unmatchedImages, 1)
+    self.assertEqual(pairBuffer.take().timestamp, 2.0)
+
+  def test_takenFrameStaysValid(self):
+    pairBuffer = ImagePairBuffer(slots=3)
+    pairBuffer.put(0, image(1.0), GEOMETRY, 1.0)
+    pairBuffer.put(1, image(1.0), GEOMETRY, 1.0)
+    frame = pairBuffer.take()
+    for timestamp in (2.0, 3.0, 4.0, 5.0):
+      pairBuffer.put(0, image(timestamp), GEOMETRY, timestamp)
+      pairBuffer.put(1, image(timestamp), GEOMETRY, timestamp)
+    np.testing.assert_array_equal(frame.firstArray, image(1.0))
+    np.testing.assert_array_equal(frame.secondArray, image(1.0))
+    self.assertEqual(pairBuffer.take().timestamp, 5.0)
+
+  def test_takeTimeout(self):
+    pairBuffer = ImagePairBuffer()
+    start = time.perf_counter()
+    self.assertIsNone(pairBuffer.take(timeout=0.05))
+    self.assertGreaterEqual(time.perf_counter() - start, 0.04)
+
+
+class IGTLImageReceiverTest(unittest.TestCase):
+
+  # Receive IMAGE messages from a local server (other device names and message types are skipped)
+  def test_receiveMessages(self):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('localhost', 0))
+    listener.listen(1)
+    listener.settimeout(5.0)
+    receiver = IGTLImageReceiver('localhost', listener.getsockname()[1], 'Magnitude', 'Phase', checkCRC=True)
+    receiver.start()
+    try:
+      (connection, _) = listener.accept()
+      with connection:
+        connection.sendall(packImageMessage('Other', image(0.0), GEOMETRY, 1.0))
+        connection.sendall(packImageMessage('Magnitude', image(10.0), GEOMETRY, 1.0))
+        connection.sendall(packImageMessage('Phase', image(0.5), GEOMETRY, 1.01))
+        frame = receiver.takeFrame(timeout=5.0)
+        statistics = receiver.getStatistics()
+    finally:
+      receiver.stop()
+      listener.close()
+    self.assertIsNotNone(frame)
+    self.assertAlmostEqual(frame.timestamp, 1.0)
+    np.testing.assert_array_equal(frame.firstArray, image(10.0))
+    np.testing.assert_array_equal(frame.secondArray, image(0.5))
+    self.assertEqual((statistics['first'], statistics['second'], statistics['skipped'], statistics['rejected']), (1, 1, 1, 0))
+    self.assertFalse(receiver.isRunning())
+
+
+if __name__ == '__main__':
+  unittest.main()
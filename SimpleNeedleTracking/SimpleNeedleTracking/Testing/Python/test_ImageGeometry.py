@@ -0,0 +1,68 @@
+import unittest
+
+import numpy as np
+import SimpleITK as sitk
+
+from SimpleNeedleTrackingLib import ImageGeometry
+
+
+# Oblique geometry (LPS): rotations about two axes, anisotropic spacing
+def obliqueGeometry():
+  (a, b) = (np.radians(25.0), np.radians(-40.0))
+  rotationZ = np.array([[np.cos(a), -np.sin(a), 0.0], [np.sin(a), np.cos(a), 0.0], [0.0, 0.0, 1.0]])
+  rotationX = np.array([[1.0, 0.0, 0.0], [0.0, np.cos(b), -np.sin(b)], [0.0, np.sin(b), np.cos(b)]])
+  return ImageGeometry((0.7, 0.9, 3.0), (-80.0, 35.0, 12.5), rotationZ.dot(rotationX).flatten())
+
+
+class ImageGeometryTest(unittest.TestCase):
+
+  def test_matrices(self):
+    geometry = obliqueGeometry()
+    np.testing.assert_allclose(geometry.getIndexToRASMatrix().dot(geometry.getRASToIndexMatrix()), np.eye(4), atol=1e-12)
+    np.testing.assert_array_equal(geometry.getIndexToRASMatrix()[3], (0.0, 0.0, 0.0, 1.0))
+
+  def test_matchesSimpleITK(self):
+    geometry = obliqueGeometry()
+    image = geometry.applyTo(sitk.Image(16, 16, 4, sitk.sitkFloat32))
+    for index in ((0, 0, 0), (3, 7, 1), (15, 2, 3)):
+      point = np.multiply(image.TransformIndexToPhysicalPoint(index), (-1.0, -1.0, 1.0))
+      np.testing.assert_allclose(geometry.indexToRAS(index), point, atol=1e-9)
+      np.testing.assert_allclose(geometry.indexToPhysicalPoint(index), image.TransformIndexToPhysicalPoint(index), atol=1e-9)
+    point = (70.0, -30.0, 20.0)
+    lps = (-point[0], -point[1], point[2])
+    np.testing.assert_allclose(geometry.rasToIndex(point), image.TransformPhysicalPointToContinuousIndex(lps), atol=1e-9)
+    np.testing.assert_array_equal(geometry.rasToNearestIndex(point), image.TransformPhysicalPointToIndex(lps))
+
+  def test_roundTrip(self):
+    geometry = obliqueGeometry()
+    indexes = np.random.default_rng(0).uniform(-5.0, 20.0, (50, 3))
+    points = geometry.indexToRAS(indexes)
+    self.assertEqual(points.shape, (50, 3))
+    np.testing.assert_allclose(geometry.rasToIndex(points), indexes, atol=1e-9)
+    # Array conversion equals conversion point by point
+    np.testing.assert_allclose(points[7], geometry.indexToRAS(tuple(indexes[7])), atol=1e-12)
+    self.assertEqual(geometry.indexToRAS((1, 2, 3)).shape, (3,))
+
+  def test_nearestIndex(self):
+    geometry = ImageGeometry((2.0, 2.0, 5.0), (0.0, 0.0, 0.0))
+    points = geometry.indexToRAS([(1.4, 2.6, 0.0), (1.5, -0.6, 2.49)])
+    indexes = geometry.rasToNearestIndex(points)
+    self.assertEqual(indexes.dtype.kind, 'i')
+    np.testing.assert_array_equal(indexes, [(1, 3, 0), (2, -1, 2)])
+
+  def test_fromImage(self):
+    geometry = obliqueGeometry()
+    copy = ImageGeometry.fromImage(geometry.applyTo(sitk.Image(4, 4, 2, sitk.sitkFloat32)))
+    np.testing.assert_allclose(copy.spacing, geometry.spacing)
+    np.testing.assert_allclose(copy.origin, geometry.origin)
+    np.testing.assert_allclose(copy.direction, geometry.direction, atol=1e-12)
+
+  def test_regionGeometry(self):
+    geometry = obliqueGeometry()
+    region = geometry.getRegionGeometry((5, 6, 1))
+    np.testing.assert_allclose(region.indexToRAS((2, 3, 1)), geometry.indexToRAS((7, 9, 2)), atol=1e-9)
+    np.testing.assert_allclose(region.rasToIndex(geometry.indexToRAS((7, 9, 2))), (2, 3, 1), atol=1e-9)
+
+
+if __name__ == '__main__':
+  unittest.main()
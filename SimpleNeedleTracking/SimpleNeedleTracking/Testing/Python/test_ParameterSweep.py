@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from SimpleNeedleTrackingLib import ParameterSweep
+from SimpleNeedleTrackingLib.PhantomGenerator import NeedlePhantom
+
+
+class ParameterSweepTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.directory = tempfile.mkdtemp()
+    NeedlePhantom(matrixSize=64, numberOfSlices=1, seed=4).writeSequence(cls.directory, 3, compress=False)
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.directory)
+
+  # Run a sweep of two sets on one worker, return ranked rows
+  def runSweep(self, *arguments):
+    path = lambda name: os.path.join(self.directory, name)
+    argv = ['--base', path('base_first.nrrd'), path('base_second.nrrd'), '--first', path('first_*.nrrd'), '--second', path('second_*.nrrd'),
+            '--prediction-csv', path('ground_truth.csv'), '--reference-csv', path('ground_truth.csv'), '--param', 'roiSize=15,25', '--workers', '1']
+    return ParameterSweep.main(argv + list(arguments))
+
+  def test_sweep(self):
+    rows = self.runSweep()
+    self.assertEqual(sorted(text for (_, text, _, _, _) in rows), ['', 'roiSize=15', 'roiSize=25'])
+    self.assertEqual([frame.timestamp for frame in ParameterSweep._benchmark.frames], [None, None, None])
+
+  def test_frameInterval(self):
+    self.runSweep('--frame-interval', '0.5')
+    self.assertEqual([frame.timestamp for frame in ParameterSweep._benchmark.frames], [0.0, 0.5, 1.0])
+
+  def test_timestamps(self):
+    path = os.path.join(self.directory, 'timestamps.csv')
+    with open(path, 'w', newline='') as csvFile:
+      csvFile.write('frame,timestamp\n0,10.0\n1,10.4\n2,11.1\n')
+    self.runSweep('--timestamp-csv', path)
+    self.assertEqual([frame.timestamp for frame in ParameterSweep._benchmark.frames], [10.0, 10.4, 11.1])
+
+
+if __name__ == '__main__':
+  unittest.main()
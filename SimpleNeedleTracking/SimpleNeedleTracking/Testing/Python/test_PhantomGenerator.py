@@ -0,0 +1,68 @@
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from SimpleNeedleTrackingLib.PhantomGenerator import NeedlePhantom
+
+
+class NeedlePhantomTest(unittest.TestCase):
+
+  def test_groundTruthPath(self):
+    phantom = NeedlePhantom(matrixSize=64, numberOfSlices=3, seed=0)
+    frames = phantom.getFrames(5)
+    tips = np.array([tipRAS for (_, tipRAS) in frames])
+    np.testing.assert_allclose(phantom.geometry.rasToIndex(tips[0]), phantom.startTip)
+    np.testing.assert_allclose(phantom.geometry.rasToIndex(tips[-1]), phantom.endTip)
+    steps = np.diff(tips, axis=0)
+    np.testing.assert_allclose(steps, np.tile(steps[0], (4, 1)), atol=1e-9)
+    for (frame, tipRAS) in frames:
+      self.assertEqual(frame.firstArray.shape, (3, 64, 64))
+      self.assertEqual(frame.firstArray.dtype, np.float32)
+      self.assertEqual(frame.tipPrediction, tipRAS)
+
+  def test_centeredGeometry(self):
+    phantom = NeedlePhantom(matrixSize=64, numberOfSlices=3, seed=0)
+    np.testing.assert_allclose(phantom.geometry.indexToRAS((31.5, 31.5, 1.0)), (0.0, 0.0, 0.0), atol=1e-9)
+
+  def test_inputModes(self):
+    phantom = NeedlePhantom(matrixSize=32, numberOfSlices=1, noiseLevel=0.0, seed=0)
+    image = phantom.getComplexImage()
+    magPhase = phantom.toFrame(image, 'MagPhase')
+    realImag = phantom.toFrame(image, 'RealImag')
+    np.testing.assert_allclose(magPhase.firstArray*np.exp(1j*magPhase.secondArray), realImag.firstArray + 1j*realImag.secondArray,
+                               rtol=1e-4, atol=1e-3)
+    self.assertLessEqual(np.abs(magPhase.secondArray).max(), np.pi + 1e-6)
+
+  def test_needleArtifact(self):
+    phantom = NeedlePhantom(matrixSize=64, numberOfSlices=1, noiseLevel=0.0, seed=0)
+    base = phantom.getComplexImage()
+    tipIndex = phantom.getTipIndex(1.0)
+    frame = phantom.getComplexImage(tipIndex)
+    (column, row) = (int(round(tipIndex[0])), int(round(tipIndex[1])))
+    self.assertLess(abs(frame[0, row, column]), 0.5*abs(base[0, row, column]))
+    np.testing.assert_allclose(frame[0, 5:10, -10:-5], base[0, 5:10, -10:-5], atol=0.05*phantom.signalLevel)
+
+  def test_seed(self):
+    first = NeedlePhantom(matrixSize=32, numberOfSlices=1, seed=4).getBaseFrame()
+    second = NeedlePhantom(matrixSize=32, numberOfSlices=1, seed=4).getBaseFrame()
+    np.testing.assert_array_equal(first.firstArray, second.firstArray)
+
+  def test_writeSequence(self):
+    directory = tempfile.mkdtemp()
+    try:
+      NeedlePhantom(matrixSize=32, numberOfSlices=1, seed=0).writeSequence(directory, 4, compress=False)
+      names = set(os.listdir(directory))
+      with open(os.path.join(directory, 'ground_truth.csv'), newline='') as csvFile:
+        rows = list(csv.DictReader(csvFile))
+    finally:
+      shutil.rmtree(directory)
+    self.assertTrue({'base_first.nrrd', 'base_second.nrrd', 'first_0003.nrrd', 'second_0003.nrrd', 'ground_truth.csv'} <= names)
+    self.assertEqual([int(row['frame']) for row in rows], [0, 1, 2, 3])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,188 @@
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import SimpleITK as sitk
+
+from SimpleNeedleTrackingLib import ImageGeometry, TrackingFrame
+from SimpleNeedleTrackingLib.PhantomGenerator import NeedlePhantom
+from SimpleNeedleTrackingLib.ReplayBenchmark import (ReplayBenchmark, loadBaseFrame, loadPointsCSV, loadTimestampsCSV, loadTrackingFrames,
+                                                     parseParameters)
+
+GEOMETRY = ImageGeometry((1.0, 1.0, 5.0), (-31.5, -31.5, 0.0))
+
+
+class ParseParametersTest(unittest.TestCase):
+
+  def test_types(self):
+    parameters = parseParameters('roiSize=30.0, roiUnwrap=True,errorThreshold=7,roiMargin=4', 'RealImag')
+    self.assertEqual(parameters.inputMode, 'RealImag')
+    self.assertEqual(parameters.roiSize, 30)
+    self.assertIsInstance(parameters.roiSize, int)
+    self.assertIs(parameters.roiUnwrap, True)
+    self.assertEqual(parameters.errorThreshold, 7.0)
+    self.assertEqual(parameters.roiMargin, 4)
+
+  def test_empty(self):
+    self.assertEqual(parseParameters('').roiSize, parseParameters(',').roiSize)
+
+  def test_unknownParameter(self):
+    with self.assertRaises(ValueError):
+      parseParameters('roiSise=30')
+
+
+class SequenceLoadingTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.directory = tempfile.mkdtemp()
+    for (name, value) in (('base_first', 100.0), ('base_second', 0.0)):
+      cls.writeImage(np.full((1, 8, 8), value, dtype=np.float32), name)
+    for index in range(3):
+      cls.writeImage(np.full((1, 8, 8), 100.0 + index, dtype=np.float32), 'first_%04d' %(index))
+      cls.writeImage(np.full((1, 8, 8), 0.1*index, dtype=np.float32), 'second_%04d' %(index))
+    with open(os.path.join(cls.directory, 'points.csv'), 'w', newline='') as csvFile:
+      csvFile.write('frame,R,A,S\n0,1.0,2.0,3.0\n1,4.0,5.0,6.0\n')
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.directory)
+
+  @classmethod
+  def writeImage(cls, array, name):
+    sitk.WriteImage(GEOMETRY.applyTo(sitk.GetImageFromArray(array)), os.path.join(cls.directory, name + '.nrrd'))
+
+  def getPatterns(self):
+    return (os.path.join(self.directory, 'first_*.nrrd'), os.path.join(self.directory, 'second_*.nrrd'))
+
+  def test_loadFrames(self):
+    frames = loadTrackingFrames(*self.getPatterns())
+    self.assertEqual(len(frames), 3)
+    self.assertEqual([float(frame.firstArray[0, 0, 0]) for frame in frames], [100.0, 101.0, 102.0])
+    self.assertEqual(frames[2].secondArray.shape, (1, 8, 8))
+    np.testing.assert_allclose(frames[0].geometry.origin, GEOMETRY.origin)
+    self.assertEqual([frame.timestamp for frame in frames], [None, None, None])
+    baseFrame = loadBaseFrame(os.path.join(self.directory, 'base_first.nrrd'), os.path.join(self.directory, 'base_second.nrrd'))
+    self.assertEqual(float(baseFrame.firstArray[0, 0, 0]), 100.0)
+
+  def test_sequenceFile(self):
+    # 4D image: one frame per volume
+    path = os.path.join(self.directory, 'sequence.nrrd')
+    sitk.WriteImage(sitk.JoinSeries([sitk.GetImageFromArray(np.full((2, 8, 8), float(index), dtype=np.float32)) for index in range(4)]), path)
+    frames = loadTrackingFrames(path, path)
+    self.assertEqual(len(frames), 4)
+    self.assertEqual(frames[3].firstArray.shape, (2, 8, 8))
+    self.assertEqual(float(frames[3].firstArray[0, 0, 0]), 3.0)
+
+  def test_mismatchedSeries(self):
+    with self.assertRaises(ValueError):
+      loadTrackingFrames(self.getPatterns()[0], os.path.join(self.directory, 'second_0000.nrrd'))
+
+  def test_frameInterval(self):
+    frames = loadTrackingFrames(*self.getPatterns(), frameInterval=0.5)
+    self.assertEqual([frame.timestamp for frame in frames], [0.0, 0.5, 1.0])
+
+  def test_timestamps(self):
+    path = os.path.join(self.directory, 'timestamps.csv')
+    with open(path, 'w', newline='') as csvFile:
+      csvFile.write('frame,timestamp\n0,10.0\n1,10.4\n2,11.1\n')
+    frames = loadTrackingFrames(*self.getPatterns(), frameInterval=0.5, timestamps=loadTimestampsCSV(path))
+    self.assertEqual([frame.timestamp for frame in frames], [10.0, 10.4, 11.1])
+    with self.assertRaises(ValueError):
+      loadTrackingFrames(*self.getPatterns(), timestamps=[0.0, 1.0])
+
+  def test_loadPoints(self):
+    np.testing.assert_array_equal(loadPointsCSV(os.path.join(self.directory, 'points.csv')), [(1.0, 2.0, 3.0), (4.0, 5.0, 6.0)])
+
+
+class ReplayBenchmarkReportTest(unittest.TestCase):
+
+  # Frames identical to the base frame: every frame fails (no needle), the report still covers all frames
+  @classmethod
+  def setUpClass(cls):
+    magnitude = np.full((1, 64, 64), 100.0, dtype=np.float32)
+    phase = np.zeros((1, 64, 64), dtype=np.float32)
+    cls.baseFrame = TrackingFrame(magnitude, phase, GEOMETRY)
+    cls.frames = [TrackingFrame(magnitude, phase, GEOMETRY) for _ in range(4)]
+    cls.predictions = np.array([(float(index), 0.0, 0.0) for index in range(4)])
+    cls.report = ReplayBenchmark(cls.baseFrame, cls.frames, cls.predictions).run(parseParameters(''), 'empty')
+
+  def test_summary(self):
+    summary = self.report.getSummary()
+    self.assertEqual(summary['name'], 'empty')
+    self.assertEqual((summary['frames'], summary['success'], summary['success_rate']), (4, 0, 0.0))
+    self.assertTrue(np.isnan(summary['tip_error_mean_mm']))
+    self.assertEqual(sum(self.report.getFailureCounts().values()), 4)
+    self.assertEqual(len(self.report.latencies), 4)
+
+  def test_singlePrediction(self):
+    report = ReplayBenchmark(self.baseFrame, self.frames, (1.0, 2.0, 3.0)).run(parseParameters(''))
+    self.assertEqual(report.predictions, [(1.0, 2.0, 3.0)]*4)
+
+  def test_missingPredictions(self):
+    with self.assertRaises(ValueError):
+      ReplayBenchmark(self.baseFrame, self.frames, self.predictions[:2])
+
+  def test_trajectoryCSV(self):
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, 'tips.csv')
+      self.report.writeTrajectoryCSV(path)
+      with open(path, newline='') as csvFile:
+        rows = list(csv.DictReader(csvFile))
+    finally:
+      shutil.rmtree(directory)
+    self.assertEqual([int(row['frame']) for row in rows], [0, 1, 2, 3])
+    for (row, prediction) in zip(rows, self.predictions):
+      self.assertEqual(row['success'], '0')
+      self.assertNotEqual(row['reason'], '')
+      self.assertEqual(row['R'], '')
+      np.testing.assert_allclose([float(row['prediction_%s' %(axis)]) for axis in 'RAS'], prediction)
+
+
+class ReplayBenchmarkAccuracyTest(unittest.TestCase):
+
+  # Fixed-mode accuracy on the default phantom with ground truth predictions (regression reference)
+  @classmethod
+  def setUpClass(cls):
+    phantom = NeedlePhantom(matrixSize=256, numberOfSlices=3, seed=11)
+    cls.baseFrame = phantom.getBaseFrame()
+    (frames, tips) = zip(*phantom.getFrames(20))
+    cls.frames = list(frames)
+    cls.tips = np.array(tips)
+    cls.report = ReplayBenchmark(cls.baseFrame, cls.frames, cls.tips, cls.tips).run(parseParameters(''), 'fixed')
+
+  def test_fixedAccuracy(self):
+    summary = self.report.getSummary()
+    self.assertEqual(summary['frames'], 20)
+    self.assertGreaterEqual(summary['success_rate'], 0.95)
+    self.assertLess(summary['tip_error_mean_mm'], 3.5)
+    self.assertLess(summary['tip_error_max_mm'], 6.0)
+
+  def test_referenceErrors(self):
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, 'tips.csv')
+      self.report.writeTrajectoryCSV(path)
+      with open(path, newline='') as csvFile:
+        rows = list(csv.DictReader(csvFile))
+    finally:
+      shutil.rmtree(directory)
+    errors = [float(row['reference_error']) for row in rows if row['success'] == '1']
+    np.testing.assert_allclose(errors, self.report.getTipErrors())
+    # Prediction columns: ROI center used by the engine
+    for (row, result) in zip(rows, self.report.results):
+      np.testing.assert_allclose([float(row['prediction_%s' %(axis)]) for axis in 'RAS'], result.tipPrediction, atol=1e-6)
+
+  def test_followTip(self):
+    report = ReplayBenchmark(self.baseFrame, self.frames[:6], self.tips[0], self.tips, followTip=True).run(parseParameters(''), 'follow')
+    for (index, result) in enumerate(report.results[:-1]):
+      if result.success:
+        self.assertEqual(tuple(report.predictions[index+1]), tuple(result.tip))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+
+import numpy as np
+
+from SimpleNeedleTrackingLib import ImageGeometry, RobotTipPrior
+
+
+# Pose with the needle axis along R (third column) and the origin at position (RAS)
+def pose(position):
+  return [[0, 0, 1, position[0]],
+          [1, 0, 0, position[1]],
+          [0, 1, 0, position[2]],
+          [0, 0, 0, 1]]
+
+
+class RobotTipPriorTest(unittest.TestCase):
+
+  def test_poseTip(self):
+    prior = RobotTipPrior(insertionDepth=5.0)
+    prior.setPose(pose((10.0, 20.0, 30.0)), receiveTime=100.0)
+    self.assertEqual(prior.getTipPrediction(now=100.5), ((15.0, 20.0, 30.0), RobotTipPrior.SOURCE_ROBOT))
+
+  def test_timeout(self):
+    prior = RobotTipPrior(maximumAge=2.0)
+    prior.setPose(pose((10.0, 20.0, 30.0)), receiveTime=100.0)
+    self.assertEqual(prior.getPoseAge(now=101.5), 1.5)
+    self.assertTrue(prior.isPoseFresh(now=102.0))
+    # Stale pose without detection: no prediction, the caller keeps its tip prediction node
+    self.assertFalse(prior.isPoseFresh(now=102.5))
+    self.assertEqual(prior.getTipPrediction(now=102.5), (None, None))
+    # Stale pose: last detection
+    prior.setDetection((1.0, 2.0, 3.0))
+    self.assertEqual(prior.getTipPrediction(now=102.5), ((1.0, 2.0, 3.0), RobotTipPrior.SOURCE_DETECTION))
+    # New pose: robot again
+    prior.setPose(pose((11.0, 20.0, 30.0)), receiveTime=103.0)
+    self.assertEqual(prior.getTipPrediction(now=103.1), ((11.0, 20.0, 30.0), RobotTipPrior.SOURCE_ROBOT))
+    self.assertEqual(prior.source, RobotTipPrior.SOURCE_ROBOT)
+
+  def test_stalePose(self):
+    prior = RobotTipPrior()
+    prior.setPose(pose((10.0, 20.0, 30.0)), stale=True)
+    self.assertIsNone(prior.getPoseAge(now=0.0))
+    self.assertFalse(prior.isPoseFresh(now=0.0))
+    prior.setDetection((1.0, 2.0, 3.0))
+    self.assertEqual(prior.getTipPrediction(now=0.0)[1], RobotTipPrior.SOURCE_DETECTION)
+
+  def test_invalidPose(self):
+    prior = RobotTipPrior()
+    prior.setPose(np.eye(4)*0.0, receiveTime=0.0)
+    self.assertIsNone(prior.getPoseAge(now=0.0))
+    prior.reset()
+    self.assertEqual(prior.getTipPrediction(now=0.0), (None, None))
+
+
+class RobotTipPriorImageTest(unittest.TestCase):
+
+  # 64x64x3 image, 1 mm pixels and 5 mm slices, first pixel at the origin (pixel centers: index -0.5 to size - 0.5)
+  def setUp(self):
+    self.geometry = ImageGeometry((1.0, 1.0, 5.0), (0.0, 0.0, 0.0))
+    self.shape = (3, 64, 64)
+
+  def isInside(self, lps, margin):
+    return RobotTipPrior.isInsideImage((-lps[0], -lps[1], lps[2]), self.geometry, self.shape, margin)
+
+  def test_inside(self):
+    self.assertTrue(self.isInside((10.0, 10.0, 5.0), 0.0))
+    self.assertTrue(self.isInside((63.5, -0.5, -2.5), 0.0))
+
+  # Frames are skipped while the robot tip lies more than the error threshold outside the image
+  def test_errorThreshold(self):
+    self.assertFalse(self.isInside((66.5, 10.0, 5.0), 2.0))
+    self.assertTrue(self.isInside((66.5, 10.0, 5.0), 4.0))
+    self.assertFalse(self.isInside((10.0, -5.0, 5.0), 4.0))
+    self.assertFalse(self.isInside((10.0, 10.0, 20.0), 5.0))
+    self.assertTrue(self.isInside((10.0, 10.0, 20.0), 10.0))
+
+  def test_direction(self):
+    geometry = ImageGeometry((1.0, 1.0, 5.0), (0.0, 0.0, 0.0), (0, 1, 0, -1, 0, 0, 0, 0, 1))
+    # Columns along A, rows along L
+    self.assertTrue(RobotTipPrior.isInsideImage((-10.0, 10.0, 0.0), geometry, self.shape))
+    self.assertFalse(RobotTipPrior.isInsideImage((10.0, 10.0, 0.0), geometry, self.shape))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+
+import numpy as np
+
+from SimpleNeedleTrackingLib import TipFilter
+
+
+class TipFilterTest(unittest.TestCase):
+
+  def test_unknownMode(self):
+    with self.assertRaises(ValueError):
+      TipFilter('Mean')
+
+  def test_firstDetection(self):
+    for mode in TipFilter.MODES:
+      self.assertEqual(TipFilter(mode).update((1.0, 2.0, 3.0)), (1.0, 2.0, 3.0))
+
+  def test_median(self):
+    tipFilter = TipFilter('Median', window=3, outlierDistance=0)
+    tipFilter.update((0.0, 0.0, 0.0))
+    tipFilter.update((1.0, 0.0, 0.0))
+    self.assertEqual(tipFilter.update((2.0, 0.0, 0.0)), (1.0, 0.0, 0.0))
+    self.assertEqual(tipFilter.update((9.0, 0.0, 0.0)), (2.0, 0.0, 0.0))
+    self.assertEqual(tipFilter.update((10.0, 0.0, 0.0)), (9.0, 0.0, 0.0))  # Oldest detections leave the window
+
+  def test_alphaBetaFollowsConstantVelocity(self):
+    tipFilter = TipFilter('AlphaBeta', outlierDistance=0)
+    for step in range(40):
+      tip = tipFilter.update((2.0*step, 0.0, 0.0), timestamp=0.5*step)
+    self.assertAlmostEqual(tip[0], 78.0, delta=0.1)
+    np.testing.assert_allclose(tipFilter.velocity, (4.0, 0.0, 0.0), atol=0.05)
+
+  def test_oneEuro(self):
+    # Smooth at rest: a small jitter is attenuated
+    tipFilter = TipFilter('OneEuro', outlierDistance=0)
+    tipFilter.update((0.0, 0.0, 0.0), timestamp=0.0)
+    jitter = tipFilter.update((1.0, 0.0, 0.0), timestamp=0.1)
+    self.assertGreater(jitter[0], 0.0)
+    self.assertLess(jitter[0], 0.5)
+    # Responsive while moving: less lag than the same low-pass filter without speed adaptation
+    adaptive = TipFilter('OneEuro', outlierDistance=0)
+    lowPass = TipFilter('OneEuro', outlierDistance=0, speedCoefficient=0.0)
+    for step in range(30):
+      tip = (10.0*step, 0.0, 0.0)
+      (adaptiveTip, lowPassTip) = (adaptive.update(tip, timestamp=0.1*step), lowPass.update(tip, timestamp=0.1*step))
+    self.assertLess(290.0 - adaptiveTip[0], 0.5*(290.0 - lowPassTip[0]))
+
+  def test_outlierRejection(self):
+    tipFilter = TipFilter('Median', window=5, outlierDistance=5.0, minimumSamples=3, maximumRejections=3)
+    for _ in range(3):
+      tipFilter.update((0.0, 0.0, 0.0))
+    self.assertEqual(tipFilter.getOutlierDistance((3.0, 4.0, 0.0)), 5.0)
+    self.assertIsNone(tipFilter.update((20.0, 0.0, 0.0)))
+    self.assertIsNone(tipFilter.update((20.0, 0.0, 0.0)))
+    # Third consecutive jump: the needle moved, the filter restarts from the detection
+    self.assertEqual(tipFilter.update((20.0, 0.0, 0.0)), (20.0, 0.0, 0.0))
+    self.assertEqual(tipFilter.count, 1)
+
+  def test_noRejectionBeforeMinimumSamples(self):
+    tipFilter = TipFilter('Median', outlierDistance=5.0, minimumSamples=3)
+    tipFilter.update((0.0, 0.0, 0.0))
+    self.assertIsNone(tipFilter.getOutlierDistance((20.0, 0.0, 0.0)))
+    self.assertIsNotNone(tipFilter.update((20.0, 0.0, 0.0)))
+
+  def test_rejectionCountResets(self):
+    tipFilter = TipFilter('Median', outlierDistance=5.0, maximumRejections=2)
+    for _ in range(3):
+      tipFilter.update((0.0, 0.0, 0.0))
+    self.assertIsNone(tipFilter.update((20.0, 0.0, 0.0)))
+    self.assertIsNotNone(tipFilter.update((1.0, 0.0, 0.0)))
+    self.assertIsNone(tipFilter.update((20.0, 0.0, 0.0)))
+
+  def test_timeStep(self):
+    tipFilter = TipFilter()
+    self.assertEqual(tipFilter.getTimeStep(1.0), 1.0)
+    tipFilter.update((0.0, 0.0, 0.0), timestamp=2.0)
+    self.assertEqual(tipFilter.getTimeStep(None), 1.0)
+    self.assertAlmostEqual(tipFilter.getTimeStep(2.25), 0.25)
+    self.assertEqual(tipFilter.getTimeStep(2.0), 1e-3)
+
+
+if __name__ == '__main__':
+  unittest.main()
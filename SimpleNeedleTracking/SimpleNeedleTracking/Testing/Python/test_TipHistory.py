@@ -0,0 +1,124 @@
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from SimpleNeedleTrackingLib import TIP_HISTORY_DTYPE, TipHistory, TrackingResult, FAILURE_NO_CENTROIDS, FAILURE_REASONS
+from SimpleNeedleTrackingLib.PhantomGenerator import NeedlePhantom
+from SimpleNeedleTrackingLib.ReplayBenchmark import ReplayBenchmark, parseParameters
+
+
+def success(frame, tip):
+  result = TrackingResult(frame, success=True, tip=tip, predictionError=1.5)
+  result.timestamp = 0.5*frame
+  result.tipPrediction = (0.0, 0.0, 0.0)
+  result.roiSize = 15
+  result.stageTimes['total'] = 0.02
+  return result
+
+
+class TipHistoryTest(unittest.TestCase):
+
+  def test_append(self):
+    history = TipHistory(10)
+    history.append(success(1, (1.0, 2.0, 3.0)), processingTime=7.0)
+    history.append(TrackingResult.failure(2, FAILURE_NO_CENTROIDS), needle=1, processingTime=8.0)
+    self.assertEqual(len(history), 2)
+    records = history.getRecords()
+    self.assertEqual(records.dtype, TIP_HISTORY_DTYPE)
+    self.assertTrue(records['success'][0])
+    np.testing.assert_array_equal(records['tip'][0], (1.0, 2.0, 3.0))
+    np.testing.assert_array_equal(records['rawTip'][0], (1.0, 2.0, 3.0))
+    self.assertEqual(records['acquisitionTime'][0], 0.5)
+    self.assertEqual(records['processingTime'][0], 7.0)
+    self.assertAlmostEqual(float(records['latency'][0]), 0.02, places=6)
+    self.assertEqual(records['roiSize'][0], 15)
+    self.assertEqual(records['blobCount'][0], -1)
+    self.assertFalse(records['success'][1])
+    self.assertEqual(records['needle'][1], 1)
+    self.assertEqual(records['failureCode'][1], FAILURE_REASONS.index(FAILURE_NO_CENTROIDS))
+    self.assertTrue(np.isnan(records['tip'][1]).all())
+    self.assertTrue(np.isnan(records['acquisitionTime'][1]))
+
+  def test_wraparound(self):
+    history = TipHistory(4)
+    for frame in range(10):
+      history.append(success(frame, (float(frame), 0.0, 0.0)))
+    self.assertEqual(len(history), 4)
+    self.assertEqual(list(history.getRecords()['frame']), [6, 7, 8, 9])
+    self.assertEqual(list(history.getLatest(2)['frame']), [8, 9])
+    self.assertEqual(len(history.getLatest(0)), 0)
+    history.clear()
+    self.assertEqual(len(history), 0)
+    self.assertEqual(len(history.getRecords()), 0)
+
+  def test_latestOfNeedle(self):
+    history = TipHistory(10)
+    for frame in range(3):
+      history.appendResults([success(frame, (0.0, 0.0, 0.0)), TrackingResult.failure(frame, FAILURE_NO_CENTROIDS)], processingTime=1.0)
+    latest = history.getLatest(2, needle=1)
+    self.assertEqual(list(latest['frame']), [1, 2])
+    self.assertFalse(latest['success'].any())
+
+
+class TipHistoryExportTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.history = TipHistory(3)
+    for frame in range(5):
+      self.history.append(success(frame, (float(frame), 2.0, 3.0)), processingTime=float(frame))
+    self.history.append(TrackingResult.failure(5, FAILURE_NO_CENTROIDS), processingTime=5.0)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_npy(self):
+    path = os.path.join(self.directory, 'history.npy')
+    self.history.export(path)
+    records = np.load(path)
+    self.assertEqual(list(records['frame']), [3, 4, 5])
+    loaded = TipHistory.load(path)
+    self.assertEqual(len(loaded), 3)
+    np.testing.assert_array_equal(loaded.getRecords()['tip'][:2], self.history.getRecords()['tip'][:2])
+    self.assertEqual(list(TipHistory.load(path, capacity=2).getRecords()['frame']), [4, 5])
+
+  def test_csv(self):
+    path = os.path.join(self.directory, 'history.CSV')
+    self.history.export(path)
+    with open(path, newline='') as csvFile:
+      rows = list(csv.DictReader(csvFile))
+    self.assertEqual([int(row['frame']) for row in rows], [3, 4, 5])
+    self.assertIn('tip_R', rows[0])
+    self.assertIn('mahalanobisDistance', rows[0])
+    self.assertNotIn('tip', rows[0])
+    self.assertEqual(float(rows[1]['tip_R']), 4.0)
+    self.assertEqual(rows[2]['success'], '0')
+    self.assertEqual(int(rows[2]['failureCode']), FAILURE_REASONS.index(FAILURE_NO_CENTROIDS))
+
+  def test_emptyCSV(self):
+    path = os.path.join(self.directory, 'empty.csv')
+    TipHistory(3).writeCSV(path)
+    with open(path, newline='') as csvFile:
+      self.assertEqual(len(list(csv.DictReader(csvFile))), 0)
+
+
+class BenchmarkTipHistoryTest(unittest.TestCase):
+
+  def test_replayHistory(self):
+    phantom = NeedlePhantom(matrixSize=256, numberOfSlices=3, seed=11)
+    baseFrame = phantom.getBaseFrame()
+    (frames, tips) = zip(*phantom.getFrames(4))
+    report = ReplayBenchmark(baseFrame, list(frames), tips, tips).run(parseParameters(''))
+    records = report.getTipHistory().getRecords()
+    self.assertEqual(len(records), 4)
+    self.assertEqual(int(records['success'].sum()), report.getNumberOfSuccesses())
+    np.testing.assert_allclose(records['prediction'], tips)
+    self.assertTrue(np.isnan(records['processingTime']).all())
+
+
+if __name__ == '__main__':
+  unittest.main()
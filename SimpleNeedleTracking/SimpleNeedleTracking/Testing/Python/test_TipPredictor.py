@@ -0,0 +1,87 @@
+import unittest
+
+import numpy as np
+
+from SimpleNeedleTrackingLib import TipPredictor
+from SimpleNeedleTrackingLib.PhantomGenerator import NeedlePhantom
+from SimpleNeedleTrackingLib.ReplayBenchmark import ReplayBenchmark, parseParameters
+
+
+class TipPredictorTest(unittest.TestCase):
+
+  def test_initialize(self):
+    predictor = TipPredictor()
+    self.assertFalse(predictor.isInitialized())
+    predictor.initialize((1.0, 2.0, 3.0), 10.0)
+    self.assertTrue(predictor.isInitialized())
+    self.assertEqual(predictor.getPosition(), (1.0, 2.0, 3.0))
+    self.assertEqual(predictor.getVelocity(), (0.0, 0.0, 0.0))
+
+  def test_constantVelocity(self):
+    predictor = TipPredictor()
+    velocity = np.array([2.0, -1.0, 0.5])
+    predictor.initialize((0.0, 0.0, 0.0), 0.0)
+    for step in range(1, 30):
+      predictor.predict(0.5*step)
+      predictor.update(0.5*step*velocity)
+    np.testing.assert_allclose(predictor.getVelocity(), velocity, atol=0.05)
+    np.testing.assert_allclose(predictor.predict(15.0), 15.0*velocity, atol=0.1)
+
+  def test_frameInterval(self):
+    predictor = TipPredictor(frameInterval=0.25)
+    self.assertEqual(predictor.getTimeStep(None), 0.25)
+    predictor.initialize((0.0, 0.0, 0.0))
+    predictor.state[3:] = (4.0, 0.0, 0.0)
+    np.testing.assert_allclose(predictor.predict(), (1.0, 0.0, 0.0))
+    predictor.initialize((0.0, 0.0, 0.0), 1.0)
+    self.assertEqual(predictor.getTimeStep(3.0), 2.0)
+    self.assertEqual(predictor.getTimeStep(0.5), 0.0)
+
+  def test_mahalanobisDistance(self):
+    predictor = TipPredictor(measurementNoise=2.0)
+    predictor.initialize((0.0, 0.0, 0.0))
+    # Innovation covariance: initial position variance plus measurement noise
+    self.assertAlmostEqual(predictor.getMahalanobisDistance((0.0, 0.0, 0.0)), 0.0)
+    self.assertAlmostEqual(predictor.getMahalanobisDistance((4.0*np.sqrt(2.0), 0.0, 0.0)), 2.0)
+    self.assertAlmostEqual(predictor.getMahalanobisDistance((0.0, -4.0*np.sqrt(2.0), 0.0)), 2.0)
+
+  def test_resetAfterMisses(self):
+    predictor = TipPredictor(maximumMisses=3)
+    predictor.initialize((0.0, 0.0, 0.0))
+    predictor.miss()
+    predictor.miss()
+    predictor.predict()
+    predictor.update((0.0, 0.0, 0.0))
+    predictor.miss()
+    predictor.miss()
+    self.assertTrue(predictor.isInitialized())
+    predictor.miss()
+    self.assertFalse(predictor.isInitialized())
+
+  def test_roiSize(self):
+    predictor = TipPredictor(measurementNoise=2.0)
+    predictor.initialize((0.0, 0.0, 0.0))
+    self.assertEqual(predictor.getROISize(15, (1.0, 1.0, 5.0), 3.4), 15)
+    for _ in range(20):
+      predictor.predict()
+    self.assertEqual(predictor.getROISize(15, (1.0, 1.0, 5.0), 3.4), 45)
+    self.assertEqual(predictor.getROISize(15, (1.0, 1.0, 5.0), 3.4, maximumScale=2.0), 30)
+
+
+class KalmanReplayTest(unittest.TestCase):
+
+  # Moving needle with a static tip prediction (first ground truth tip): the Kalman predictor has to follow the tip
+  def test_kalmanNotWorseThanFixed(self):
+    phantom = NeedlePhantom(matrixSize=256, numberOfSlices=3, seed=0)
+    baseFrame = phantom.getBaseFrame()  # Base first, same noise sequence as PhantomGenerator.writeSequence
+    (frames, tips) = zip(*phantom.getFrames(60))
+    benchmark = ReplayBenchmark(baseFrame, list(frames), tips[0], tips)
+    fixed = benchmark.run(parseParameters(''), 'fixed').getSummary()
+    kalman = benchmark.run(parseParameters('predictionMode=Kalman'), 'kalman').getSummary()
+    self.assertGreaterEqual(kalman['success_rate'], fixed['success_rate'])
+    self.assertLessEqual(kalman['tip_error_mean_mm'], fixed['tip_error_mean_mm'])
+    self.assertLess(kalman['tip_error_mean_mm'], 6.0)
+
+
+if __name__ == '__main__':
+  unittest.main()
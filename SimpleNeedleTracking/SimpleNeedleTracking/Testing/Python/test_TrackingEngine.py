@@ -0,0 +1,245 @@
+import unittest
+
+import numpy as np
+import SimpleITK as sitk
+
+from SimpleNeedleTrackingLib import (ImageGeometry, NeedleTrackingEngine, TrackingFrame, TrackingParameters, TrackingResult, FAILURE_EMPTY_PHASE_DIFF,
+                                     FAILURE_INVALID_ROI, FAILURE_NOT_INITIALIZED, FAILURE_NO_CENTROIDS, FAILURE_REASONS)
+from SimpleNeedleTrackingLib.PhantomGenerator import NeedlePhantom
+
+
+class TrackingResultTest(unittest.TestCase):
+
+  def test_bool(self):
+    self.assertTrue(TrackingResult(1, success=True, tip=(0.0, 0.0, 0.0)))
+    self.assertFalse(TrackingResult.failure(1, FAILURE_NO_CENTROIDS))
+    self.assertEqual(TrackingResult.failure(1, FAILURE_NO_CENTROIDS).reason, FAILURE_NO_CENTROIDS)
+
+  def test_failureCode(self):
+    self.assertEqual(TrackingResult(1, success=True, tip=(0.0, 0.0, 0.0)).getFailureCode(), 0)
+    self.assertEqual(TrackingResult.failure(1, FAILURE_NO_CENTROIDS).getFailureCode(), FAILURE_REASONS.index(FAILURE_NO_CENTROIDS))
+    self.assertEqual(TrackingResult.failure(1, 'Some other reason').getFailureCode(), -1)
+    self.assertEqual(FAILURE_REASONS[0], None)
+
+
+class ImageGeometryTest(unittest.TestCase):
+
+  def test_applyTo(self):
+    geometry = ImageGeometry((0.5, 0.5, 2.0), (10.0, 20.0, 30.0), (0, 1, 0, -1, 0, 0, 0, 0, 1))
+    copy = ImageGeometry.fromImage(geometry.applyTo(sitk.Image(4, 4, 2, sitk.sitkFloat32)))
+    self.assertEqual((copy.spacing, copy.origin, copy.direction), (geometry.spacing, geometry.origin, geometry.direction))
+
+  def test_indexToPhysicalPoint(self):
+    geometry = ImageGeometry((0.5, 0.5, 2.0), (10.0, 20.0, 30.0))
+    self.assertEqual(geometry.indexToPhysicalPoint((2, 4, 1)), (11.0, 22.0, 32.0))
+
+  def test_regionGeometry(self):
+    geometry = ImageGeometry((0.5, 0.5, 2.0), (10.0, 20.0, 30.0), (0, 1, 0, -1, 0, 0, 0, 0, 1))
+    region = geometry.getRegionGeometry((2, 4, 1))
+    self.assertEqual((region.spacing, region.direction), (geometry.spacing, geometry.direction))
+    np.testing.assert_allclose(region.indexToPhysicalPoint((1, 1, 0)), geometry.indexToPhysicalPoint((3, 5, 1)))
+    np.testing.assert_allclose(region.indexToRAS((0, 0, 0)), geometry.indexToRAS((2, 4, 1)))
+
+  def test_lpsToRAS(self):
+    geometry = ImageGeometry((1.0, 1.0, 1.0), (10.0, 20.0, 30.0))
+    np.testing.assert_allclose(geometry.indexToRAS((0, 0, 0)), (-10.0, -20.0, 30.0))
+
+
+class NeedleTrackingEngineTest(unittest.TestCase):
+
+  def test_notInitialized(self):
+    engine = NeedleTrackingEngine()
+    self.assertFalse(engine.isInitialized())
+    array = np.zeros((1, 8, 8), dtype=np.float32)
+    result = engine.getNeedle(array, array, ImageGeometry(), (0.0, 0.0, 0.0), TrackingParameters())
+    self.assertFalse(result.success)
+    self.assertEqual(result.reason, FAILURE_NOT_INITIALIZED)
+    self.assertEqual(result.getFailureCode(), FAILURE_REASONS.index(FAILURE_NOT_INITIALIZED))
+
+  def test_trackPhantomFrame(self):
+    phantom = NeedlePhantom(matrixSize=256, numberOfSlices=3, seed=3)
+    parameters = TrackingParameters()
+    engine = NeedleTrackingEngine()
+    engine.setBaseFrame(phantom.getBaseFrame(), parameters)
+    self.assertTrue(engine.isInitialized())
+    (frame, tipRAS) = phantom.getFrames(2)[1]
+    result = engine.trackFrame(frame, parameters)
+    self.assertTrue(result.success, result.reason)
+    self.assertLess(np.linalg.norm(np.subtract(result.tip, tipRAS)), 5.0)
+    self.assertIn('total', result.stageTimes)
+    self.assertEqual(result.getFailureCode(), 0)
+
+
+class GradientParityTest(unittest.TestCase):
+
+  # Step 4 gradient (scipy Gaussian derivatives of the whole stack) against the former per-slice
+  # sitk.GradientMagnitudeRecursiveGaussianImageFilter (sigma 1 mm), both rescaled to [0, 2*pi] as in the pipeline
+  def checkParity(self, spacing):
+    engine = NeedleTrackingEngine()
+    phantom = NeedlePhantom(matrixSize=128, numberOfSlices=3, spacing=spacing, seed=0)
+    tipIndex = phantom.getTipIndex(0.5)
+    (column, row) = (int(tipIndex[0]), int(tipIndex[1]))
+    # Needle phase shift around the tip with noise, rescaled like the Step 3 ROI
+    roi = phantom.getNeedleArtifact(tipIndex)[0][:, row-15:row+15, column-15:column+15]
+    roi = engine.rescaleArray(roi + 0.05*np.random.default_rng(0).standard_normal(roi.shape))
+    gradient = engine.rescaleArray(engine.getGradientMagnitudeArray(roi, spacing, (0.0, 1.0/spacing[1], 1.0/spacing[0])))
+    image = sitk.GetImageFromArray(roi)
+    image.SetSpacing(spacing)
+    gradientFilter = sitk.GradientMagnitudeRecursiveGaussianImageFilter()
+    reference = engine.rescaleArray(np.stack([sitk.GetArrayFromImage(gradientFilter.Execute(image[:,:,index])) for index in range(roi.shape[0])]))
+    self.assertLess(np.abs(gradient - reference).max(), 0.02)
+    self.assertAlmostEqual(float(gradient.mean()), float(reference.mean()), delta=0.002)
+    # Same blobs at the default Blob Threshold
+    blobThreshold = TrackingParameters().blobThreshold
+    self.assertGreater((reference > blobThreshold).sum(), 0)
+    np.testing.assert_array_equal(gradient > blobThreshold, reference > blobThreshold)
+
+  def test_isotropic(self):
+    self.checkParity((1.0, 1.0, 5.0))
+
+  def test_anisotropic(self):
+    self.checkParity((0.8, 0.6, 4.0))
+
+
+class PhaseDifferenceModeTest(unittest.TestCase):
+
+  # Complex conjugate difference (no unwrapping) against the unwrapped difference, background phase wrapping across the needle
+  def checkModes(self, inputMode):
+    phantom = NeedlePhantom(matrixSize=256, numberOfSlices=3, phaseWraps=8.0, seed=7)
+    baseFrame = phantom.getBaseFrame(inputMode)
+    frames = phantom.getFrames(5, inputMode)
+    (start, end) = (int(phantom.entryPoint[0]), int(phantom.endTip[0]))
+    row = int(phantom.endTip[1])
+    self.assertGreater(np.abs(np.diff(np.angle(phantom.background[1, row, start:end]))).max(), np.pi)
+    results = {}
+    for mode in ('Unwrap', 'Complex'):
+      parameters = TrackingParameters(inputMode=inputMode, phaseDifferenceMode=mode)
+      engine = NeedleTrackingEngine()
+      engine.setBaseFrame(baseFrame, parameters)
+      results[mode] = [engine.trackFrame(frame, parameters) for (frame, _) in frames]
+    for (unwrapResult, complexResult, (_, tipRAS)) in zip(results['Unwrap'], results['Complex'], frames):
+      self.assertTrue(unwrapResult.success, unwrapResult.reason)
+      self.assertTrue(complexResult.success, complexResult.reason)
+      self.assertLess(np.linalg.norm(np.subtract(complexResult.tip, unwrapResult.tip)), 1.0)
+      self.assertLess(np.linalg.norm(np.subtract(complexResult.tip, tipRAS)), 6.0)
+
+  def test_magPhase(self):
+    self.checkModes('MagPhase')
+
+  def test_realImag(self):
+    self.checkModes('RealImag')
+
+
+class MultipleNeedlesTest(unittest.TestCase):
+
+  # Two needles in the same frames (first needle from the left, second from the right), a third prediction in a needle-free
+  # area and a fourth one outside the image
+  @classmethod
+  def setUpClass(cls):
+    size = 256
+    cls.phantom = NeedlePhantom(matrixSize=size, numberOfSlices=3, seed=1)
+    cls.otherNeedle = NeedlePhantom(matrixSize=size, numberOfSlices=3, noiseLevel=0.0, entryPoint=(0.9*size, 0.3*size, 1.0),
+                                    startTip=(0.75*size, 0.3*size, 1.0), endTip=(0.6*size, 0.3*size, 1.0))
+    cls.baseFrame = cls.phantom.getBaseFrame()
+    cls.emptyPrediction = cls.phantom.indexToRAS((0.5*size, 0.75*size, 1.0))
+    cls.outsidePrediction = cls.phantom.indexToRAS((2.0*size, 0.5*size, 1.0))
+
+  # Return frame with both needles at normalized time t and the tips (RAS) of both needles
+  def getFrame(self, t):
+    (firstTip, secondTip) = (self.phantom.getTipIndex(t), self.otherNeedle.getTipIndex(t))
+    (phase, attenuation) = self.otherNeedle.getNeedleArtifact(secondTip)
+    frame = self.phantom.toFrame(self.phantom.getComplexImage(firstTip)*attenuation*np.exp(1j*phase), 'MagPhase')
+    return (frame, [self.phantom.indexToRAS(firstTip), self.phantom.indexToRAS(secondTip)])
+
+  def checkNeedles(self, parameters):
+    engine = NeedleTrackingEngine()
+    engine.setBaseFrame(self.baseFrame, parameters)
+    for t in (0.2, 0.8):
+      (frame, tips) = self.getFrame(t)
+      predictions = tips + [self.emptyPrediction, self.outsidePrediction]
+      results = engine.trackNeedles(TrackingFrame(frame.firstArray, frame.secondArray, frame.geometry, tipPredictions=predictions), parameters)
+      self.assertEqual(len(results), 4)
+      for (result, tip) in zip(results[:2], tips):
+        self.assertTrue(result.success, result.reason)
+        self.assertLess(np.linalg.norm(np.subtract(result.tip, tip)), 5.0)
+      self.assertFalse(results[2].success)
+      self.assertEqual(results[2].reason, FAILURE_EMPTY_PHASE_DIFF)
+      self.assertFalse(results[3].success)
+      self.assertEqual(results[3].reason, FAILURE_INVALID_ROI)
+      # Same tips as tracking each needle on its own
+      for (result, tip) in zip(results[:2], tips):
+        single = NeedleTrackingEngine()
+        single.setBaseFrame(self.baseFrame, parameters)
+        singleResult = single.trackFrame(TrackingFrame(frame.firstArray, frame.secondArray, frame.geometry, tip), parameters)
+        np.testing.assert_allclose(result.tip, singleResult.tip, atol=1e-6)
+
+  def test_unwrap(self):
+    self.checkNeedles(TrackingParameters())
+
+  def test_unwrapROI(self):
+    self.checkNeedles(TrackingParameters(roiUnwrap=True))
+
+  def test_complex(self):
+    self.checkNeedles(TrackingParameters(phaseDifferenceMode='Complex'))
+
+
+class RollingBaselineTest(unittest.TestCase):
+
+  def setUp(self):
+    self.phantom = NeedlePhantom(matrixSize=128, numberOfSlices=3, seed=2)
+    self.parameters = TrackingParameters(inputMode='RealImag', baselineMode='Rolling')
+    self.engine = NeedleTrackingEngine()
+    baseFrame = self.phantom.getBaseFrame('RealImag')
+    self.engine.setBaseFrame(baseFrame, self.parameters)
+    self.base = (baseFrame.firstArray + 1j*baseFrame.secondArray).astype(np.complex64)
+
+  # Blend the base rotated by a global phase offset (radians), tip in the image centre
+  def update(self, offset, weight, exclusion=10.0):
+    frame = self.base*np.complex64(np.exp(1j*offset))
+    tip = self.phantom.indexToRAS((64.0, 64.0, 1.0))
+    self.assertTrue(self.engine.updateRollingBaseline(frame.real, frame.imag, 'RealImag', [tip], weight, exclusion))
+    return frame
+
+  # Median phase of the frame relative to the rolling base, outside the exclusion zone
+  def getResidual(self, frame):
+    residual = np.angle(frame*np.conj(self.engine.baseline.numpy_base_c))
+    return float(np.median(np.abs(residual[:, :, :40])))
+
+  def test_exclusionZone(self):
+    weight = 0.25
+    frame = self.update(1.0, weight, exclusion=10.0)
+    base_c = self.engine.baseline.numpy_base_c
+    # 10 mm exclusion with 1 mm pixels: +/- 10 pixels around the tip index keep the base on all slices
+    radius = 10
+    zone = (slice(None), slice(64-radius, 64+radius+1), slice(64-radius, 64+radius+1))
+    np.testing.assert_array_equal(base_c[zone], self.base[zone])
+    blended = (1.0 - weight)*self.base + weight*frame
+    np.testing.assert_allclose(base_c[:, :, :64-radius], blended[:, :, :64-radius], atol=1e-5)
+    np.testing.assert_allclose(base_c[:, :, 64+radius+1:], blended[:, :, 64+radius+1:], atol=1e-5)
+    self.assertEqual(self.engine.baseline.updates, 1)
+    # Derived base phase follows the complex base
+    np.testing.assert_allclose(self.engine.baseline.numpy_base_p, np.angle(base_c) + np.pi, atol=1e-5)
+
+  # A phase step is absorbed like an exponential moving average: about exp(-1) of it is left after 1/weight frames
+  def test_stepDrift(self):
+    (weight, offset) = (0.05, 0.5)
+    for count in range(1, 61):
+      frame = self.update(offset, weight)
+      if count == 20:
+        self.assertLess(self.getResidual(frame), 0.4*offset)
+    self.assertLess(self.getResidual(frame), 0.06*offset)
+
+  # A slow ramp (0.01 rad/frame) settles to a lag of about drift*(1-weight)/weight instead of growing
+  def test_rampDrift(self):
+    (weight, drift) = (0.05, 0.01)
+    lags = []
+    for count in range(1, 81):
+      frame = self.update(count*drift, weight)
+      lags.append(self.getResidual(frame))
+    self.assertLess(lags[-1], drift/weight)
+    self.assertLess(abs(lags[-1] - lags[59]), 0.1*drift/weight)
+    self.assertGreater(lags[-1], 0.8*drift*(1.0 - weight)/weight)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,112 @@
+import csv
+import json
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+from SimpleNeedleTrackingLib import (TrackingResult, TrackingStatistics, FAILURE_NO_CENTROIDS, FAILURE_TIP_TOO_FAR, STATUS_DEGRADED,
+                                     STATUS_FALLING_BEHIND, STATUS_IDLE, STATUS_OK)
+
+
+def success(timestamp=None):
+  result = TrackingResult(1, success=True, tip=(0.0, 0.0, 0.0))
+  result.timestamp = timestamp
+  result.stageTimes['total'] = 0.02
+  return result
+
+
+def failure(reason):
+  return TrackingResult.failure(1, reason)
+
+
+class TrackingStatisticsTest(unittest.TestCase):
+
+  def test_counters(self):
+    statistics = TrackingStatistics()
+    statistics.addReceivedFrames(6)
+    statistics.addResults([success(10.0), failure(FAILURE_NO_CENTROIDS)], processingTime=10.5)
+    statistics.addResults([success(), success()])
+    statistics.addDroppedFrames(2)
+    statistics.addSkippedFrames()
+    values = statistics.getStatistics()
+    self.assertEqual((values['received'], values['processed'], values['dropped'], values['skipped'], values['pending']), (6, 2, 2, 1, 1))
+    self.assertEqual(values['successRate'], 0.75)
+    self.assertAlmostEqual(values['recentDropRate'], 0.5)
+    self.assertAlmostEqual(values['recentLatency'], 20.0)
+    self.assertAlmostEqual(values['recentLag'], 500.0)
+    self.assertEqual(dict(values['failures']), {FAILURE_NO_CENTROIDS: 1})
+    self.assertEqual(values['needles'][0]['successes'], 2)
+    self.assertEqual(dict(values['needles'][1]['failures']), {FAILURE_NO_CENTROIDS: 1})
+
+  def test_failureCounts(self):
+    statistics = TrackingStatistics()
+    statistics.addResults([failure(FAILURE_TIP_TOO_FAR)])
+    statistics.addResults([failure(FAILURE_NO_CENTROIDS)])
+    statistics.addResults([failure(FAILURE_TIP_TOO_FAR)])
+    statistics.addResults([failure('Some other reason')])
+    counts = statistics.getFailureCounts()
+    # Reasons in FAILURE_REASONS order, unknown reasons last
+    self.assertEqual(list(counts.items()), [(FAILURE_NO_CENTROIDS, 1), (FAILURE_TIP_TOO_FAR, 2), ('Some other reason', 1)])
+    self.assertEqual(statistics.getFailureCounts(0)['Unknown reason'], 1)
+
+  def test_status(self):
+    statistics = TrackingStatistics(windowSize=10)
+    self.assertEqual(statistics.getStatus(), STATUS_IDLE)
+    for _ in range(10):
+      statistics.addResults([success()])
+    self.assertEqual(statistics.getStatus(), STATUS_OK)
+    for _ in range(6):
+      statistics.addResults([failure(FAILURE_NO_CENTROIDS)])
+    self.assertEqual(statistics.getStatus(), STATUS_DEGRADED)
+    statistics.addDroppedFrames(3)
+    self.assertEqual(statistics.getStatus(), STATUS_FALLING_BEHIND)
+    statistics.reset()
+    self.assertEqual(statistics.getStatus(), STATUS_IDLE)
+    self.assertEqual(statistics.getStatistics()['processed'], 0)
+
+  def test_emptyRates(self):
+    values = TrackingStatistics().getStatistics()
+    self.assertTrue(math.isnan(values['successRate']))
+    self.assertTrue(math.isnan(values['recentLatency']))
+    self.assertIn('Idle', TrackingStatistics().formatStatistics())
+
+
+class TrackingStatisticsExportTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.statistics = TrackingStatistics()
+    self.statistics.addReceivedFrames(3)
+    self.statistics.addResults([success(), failure(FAILURE_NO_CENTROIDS)])
+    self.statistics.addResults([failure(FAILURE_TIP_TOO_FAR), success()])
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_json(self):
+    path = os.path.join(self.directory, 'health.json')
+    self.statistics.export(path)
+    with open(path) as file:
+      values = json.load(file)
+    self.assertEqual(values['processed'], 2)
+    self.assertEqual(values['pending'], 1)
+    self.assertIsNone(values['recentLag'])  # NaN is written as null
+    self.assertEqual(values['failures'], {FAILURE_NO_CENTROIDS: 1, FAILURE_TIP_TOO_FAR: 1})
+    self.assertEqual(values['needles'][1]['successes'], 1)
+
+  def test_csv(self):
+    path = os.path.join(self.directory, 'health.csv')
+    self.statistics.export(path)
+    with open(path, newline='') as csvFile:
+      rows = list(csv.reader(csvFile))
+    self.assertEqual(rows[0], ['counter', 'needle', 'value'])
+    self.assertIn(['processed', '', '2'], rows)
+    self.assertIn(['successes', '1', '1'], rows)
+    self.assertIn([FAILURE_NO_CENTROIDS, '2', '1'], rows)
+    self.assertIn([FAILURE_TIP_TOO_FAR, '1', '1'], rows)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,99 @@
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from SimpleNeedleTrackingLib import ImageGeometry, LatestFrameQueue, TrackingFrame, TrackingParameters, TrackingWorker
+from SimpleNeedleTrackingLib.PhantomGenerator import NeedlePhantom
+
+
+class LatestFrameQueueTest(unittest.TestCase):
+
+  def test_latestFrameWins(self):
+    frameQueue = LatestFrameQueue()
+    self.assertFalse(frameQueue.put('first'))
+    self.assertTrue(frameQueue.put('second'))
+    self.assertTrue(frameQueue.put('third'))
+    self.assertEqual(frameQueue.droppedFrames, 2)
+    self.assertEqual(frameQueue.get(timeout=0.1), 'third')
+    self.assertFalse(frameQueue.put('fourth'))
+    self.assertEqual(frameQueue.droppedFrames, 2)
+
+  def test_getTimeout(self):
+    frameQueue = LatestFrameQueue()
+    start = time.perf_counter()
+    self.assertIsNone(frameQueue.get(timeout=0.05))
+    self.assertGreaterEqual(time.perf_counter() - start, 0.04)
+
+  def test_getWaitsForFrame(self):
+    frameQueue = LatestFrameQueue()
+    timer = threading.Timer(0.05, frameQueue.put, args=('frame',))
+    timer.start()
+    self.assertEqual(frameQueue.get(timeout=5.0), 'frame')
+    timer.join()
+
+  def test_closeReleasesConsumer(self):
+    frameQueue = LatestFrameQueue()
+    frameQueue.put('pending')
+    frameQueue.close()
+    self.assertIsNone(frameQueue.get(timeout=0.1))
+    frames = []
+    consumer = threading.Thread(target=lambda: frames.append(frameQueue.get()))
+    consumer.start()
+    consumer.join(1.0)
+    self.assertFalse(consumer.is_alive())
+    self.assertEqual(frames, [None])
+
+
+class TrackingWorkerTest(unittest.TestCase):
+
+  def test_unknownMode(self):
+    with self.assertRaises(ValueError):
+      TrackingWorker('Fiber')
+
+  def test_threadWorker(self):
+    magnitude = np.full((1, 64, 64), 100.0, dtype=np.float32)
+    phase = np.zeros((1, 64, 64), dtype=np.float32)
+    baseFrame = TrackingFrame(magnitude, phase, ImageGeometry())
+    worker = TrackingWorker(TrackingWorker.THREAD)
+    worker.start(baseFrame, TrackingParameters())
+    try:
+      for timestamp in (1.0, 2.0):
+        worker.submit(TrackingFrame(magnitude, phase, ImageGeometry(), (-32.0, -32.0, 0.0), timestamp))
+        results = self.waitForResults(worker)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(len(results[0]), 1)  # One result per needle
+        self.assertEqual(results[0][0].timestamp, timestamp)
+    finally:
+      worker.stop()
+    self.assertFalse(worker.isRunning())
+
+  def test_trackPhantom(self):
+    phantom = NeedlePhantom(matrixSize=256, numberOfSlices=3, seed=5)
+    baseFrame = phantom.getBaseFrame()
+    (frame, tipRAS) = phantom.getFrames(2)[1]
+    worker = TrackingWorker(TrackingWorker.THREAD)
+    worker.start(baseFrame, TrackingParameters())
+    try:
+      worker.submit(frame)
+      results = self.waitForResults(worker)
+    finally:
+      worker.stop()
+    self.assertEqual(len(results), 1)
+    result = results[0][0]
+    self.assertTrue(result.success, result.reason)
+    self.assertLess(np.linalg.norm(np.subtract(result.tip, tipRAS)), 5.0)
+
+  # Return results of the worker, wait up to timeout seconds for the first one
+  def waitForResults(self, worker, timeout=30.0):
+    results = []
+    deadline = time.time() + timeout
+    while (not results) and (time.time() < deadline):
+      results = worker.getResults()
+      time.sleep(0.01)
+    return results
+
+
+if __name__ == '__main__':
+  unittest.main()